@@ -0,0 +1,59 @@
+from typing import Optional
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from app.schemas.message import DeadLetterItem, DeadLetterPage, DeadLetterReplayRequest, DeadLetterReplayResponse
+from app.services.dead_letters import REPLAY_TARGETS, find_dead_letters, replay_dead_letters
+from app.services.rabbitmq import RabbitMQService, get_rabbitmq_service
+from app.core.config import settings
+
+
+router = APIRouter()
+
+
+@router.get("/dlq", response_model=DeadLetterPage)
+async def list_dead_letters(
+    status_filter: Optional[str] = Query(None, alias="status", description="Status of the last failure."),
+    tipoNotificacao: Optional[str] = None,
+    desde: Optional[float] = Query(None, description="Only messages that reached the DLQ since this epoch time, in seconds."),
+    ate: Optional[float] = Query(None, description="Only messages that reached the DLQ until this epoch time, in seconds."),
+    erro: Optional[str] = Query(None, description="Substring of a failure reason, case-insensitive."),
+    limite: int = Query(50, ge=1, le=settings.NOTIFICATION_PAGE_MAX_SIZE),
+    cursor: Optional[str] = None,
+):
+    """Lists the stored dead messages, most recent first, with their failure history."""
+    try:
+        entries, next_cursor = await find_dead_letters(status_filter, tipoNotificacao, desde, ate, erro, limite, cursor)
+    except ValueError:
+        raise HTTPException(status_code=422, detail=f"Invalid cursor: {cursor}")
+    return DeadLetterPage(items=[DeadLetterItem(**entry) for entry in entries], proximoCursor=next_cursor)
+
+
+@router.post("/dlq/reprocessar", response_model=DeadLetterReplayResponse)
+async def replay(request: DeadLetterReplayRequest, rabbitmq_service: RabbitMQService = Depends(get_rabbitmq_service)):
+    """Publishes matching dead messages back to a stage, rate limited; returns when they were published.
+
+    Bounded by NOTIFICATION_BATCH_MAX_SIZE messages per call: larger replays
+    belong to ``python -m app.dlq replay``.
+    """
+    if request.destino not in REPLAY_TARGETS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Unknown replay target: {request.destino}. Allowed targets are: {', '.join(REPLAY_TARGETS)}",
+        )
+    if request.limite > settings.NOTIFICATION_BATCH_MAX_SIZE:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"A replay through the API is limited to {settings.NOTIFICATION_BATCH_MAX_SIZE} messages",
+        )
+    summary = await replay_dead_letters(
+        rabbitmq_service,
+        target=request.destino,
+        rate=request.taxa,
+        batch_size=request.lote,
+        limit=request.limite,
+        status=request.status,
+        channel=request.tipoNotificacao,
+        since=request.desde,
+        until=request.ate,
+        error=request.erro,
+    )
+    return DeadLetterReplayResponse(**summary)
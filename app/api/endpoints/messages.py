@@ -1,58 +1,384 @@
-from fastapi import APIRouter, HTTPException, status, Depends
+import asyncio
+import json
+import time
+from typing import Optional
+from fastapi import APIRouter, HTTPException, Query, Request, Response, WebSocket, WebSocketDisconnect, status, Depends
+from fastapi.responses import StreamingResponse
+from pydantic import ValidationError
 from app.schemas.message import (
+    NotificationBatchItemResult,
+    NotificationBatchResponse,
     NotificationCreate,
+    NotificationCountsResponse,
     NotificationCreateResponse,
+    NotificationIndexItem,
+    NotificationPage,
     NotificationStatusResponse,
 )
+from app.services.backpressure import backpressure
 from app.services.rabbitmq import RabbitMQService, get_rabbitmq_service
-from app.core import storage
+from app.services.status_events import StatusEventBus, StatusSubscription, get_status_events
+from app.services.topology import publish_batch_to_stage, publish_to_stage
+from app.core import claim_check, metrics, storage
+from app.core.exceptions import ContentNotFoundError, PublishNackError
 from app.core.config import settings
+from app.core.status_cache import notification_cache
 from uuid import uuid4
 
 
 router = APIRouter()
 
+NDJSON_CONTENT_TYPES = ("application/x-ndjson", "application/jsonl")
 
-@router.post("/notificar", response_model=NotificationCreateResponse, status_code=status.HTTP_202_ACCEPTED)
-async def create_notification(notification: NotificationCreate, rabbitmq_service: RabbitMQService = Depends(get_rabbitmq_service)):
-    if notification.tipoNotificacao not in settings.ALLOWED_NOTIFICATION_TYPES:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail=f"Unsupported notification type: {notification.tipoNotificacao}. Allowed types are: {', '.join(settings.ALLOWED_NOTIFICATION_TYPES)}"
-        )
 
+def _unsupported_type_detail(tipo_notificacao: str) -> str:
+    return f"Unsupported notification type: {tipo_notificacao}. Allowed types are: {', '.join(settings.ALLOWED_NOTIFICATION_TYPES)}"
+
+def _build_notification_data(notification: NotificationCreate) -> dict:
     trace_id = uuid4()
     mensagem_id = notification.mensagemId or uuid4()
-    data = {
+    return {
         'mensagemId': str(mensagem_id),
         'conteudoMensagem': notification.conteudoMensagem,
         'channel': notification.tipoNotificacao,
+        'prioridade': notification.prioridade,
         'status': 'RECEBIDO',
-        'traceId': str(trace_id)
+        'traceId': str(trace_id),
+        # Epoch seconds of receipt, carried along the pipeline to measure end-to-end latency
+        'recebidoEm': time.time(),
     }
-    storage.set_notification(str(trace_id), data)
 
+def _batch_too_large():
+    return HTTPException(
+        status_code=413,
+        detail=f"Batch too large. Maximum batch size is {settings.NOTIFICATION_BATCH_MAX_SIZE} items."
+    )
+
+async def _read_batch_items(request: Request) -> list:
+    """Reads the raw batch items from a JSON array or an NDJSON stream."""
+    content_type = request.headers.get("content-type", "").split(";")[0].strip()
+    if content_type in NDJSON_CONTENT_TYPES:
+        # NDJSON is parsed line by line while streaming so huge lots are rejected early
+        items = []
+        pending = b""
+        async for chunk in request.stream():
+            pending += chunk
+            *lines, pending = pending.split(b"\n")
+            items.extend(line for line in lines if line.strip())
+            if len(items) > settings.NOTIFICATION_BATCH_MAX_SIZE:
+                raise _batch_too_large()
+        if pending.strip():
+            items.append(pending)
+    else:
+        try:
+            items = await request.json()
+        except ValueError:
+            raise HTTPException(status_code=422, detail="Invalid JSON body")
+        if not isinstance(items, list):
+            raise HTTPException(status_code=422, detail="Expected a JSON array of notifications")
+    if len(items) > settings.NOTIFICATION_BATCH_MAX_SIZE:
+        raise _batch_too_large()
+    return items
+
+def _validate_batch_item(raw) -> NotificationCreate:
+    """Validates one batch item, raising ValueError with a readable message."""
+    if isinstance(raw, bytes):
+        try:
+            raw = json.loads(raw)
+        except ValueError:
+            raise ValueError("Invalid JSON")
     try:
-        await rabbitmq_service.publish_message(
-            message=data,
-            routing_key=settings.NOTIFICATION_INPUT_QUEUE,
-            exchange_name=f"{settings.NOTIFICATION_INPUT_QUEUE}_exchange"
+        notification = NotificationCreate.model_validate(raw)
+    except ValidationError as e:
+        raise ValueError("; ".join(f"{'.'.join(map(str, err['loc'])) or 'body'}: {err['msg']}" for err in e.errors()))
+    if notification.tipoNotificacao not in settings.ALLOWED_NOTIFICATION_TYPES:
+        raise ValueError(_unsupported_type_detail(notification.tipoNotificacao))
+    return notification
+
+
+def _shed_load(status_code: int, detail: str) -> HTTPException:
+    return HTTPException(
+        status_code=status_code,
+        detail=detail,
+        headers={"Retry-After": str(settings.BACKPRESSURE_RETRY_AFTER_SECONDS)},
+    )
+
+@router.post("/notificar", response_model=NotificationCreateResponse, status_code=status.HTTP_202_ACCEPTED)
+async def create_notification(notification: NotificationCreate, rabbitmq_service: RabbitMQService = Depends(get_rabbitmq_service)):
+    if notification.tipoNotificacao not in settings.ALLOWED_NOTIFICATION_TYPES:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=_unsupported_type_detail(notification.tipoNotificacao)
         )
+
+    shed = await backpressure.check(rabbitmq_service, notification.tipoNotificacao, notification.prioridade)
+    if shed is not None:
+        raise _shed_load(*shed)
+
+    data = _build_notification_data(notification)
+    trace_id = data['traceId']
+    # A client retry of the same mensagemId gets the original traceId back and is not published again
+    original_trace_id = await storage.claim_message_id(data['mensagemId'], trace_id)
+    if original_trace_id is not None:
+        metrics.NOTIFICATIONS_DEDUPLICATED.labels(data['channel']).inc()
+        return NotificationCreateResponse(mensagemId=data['mensagemId'], traceId=original_trace_id)
+    try:
+        await claim_check.check_in([data])
+        await storage.set_notification(trace_id, data)
+    except Exception as e:
+        # Without its record the claim would turn every client retry into a ghost duplicate
+        await storage.release_message_id(data['mensagemId'], trace_id)
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Internal server error"
+        ) from e
+
+    try:
+        await publish_to_stage(rabbitmq_service, data, settings.NOTIFICATION_INPUT_QUEUE)
+    except PublishNackError as e:
+        await storage.set_status(trace_id, "FALHA_ENVIO")
+        await storage.release_message_id(data['mensagemId'], trace_id)
+        notification_cache.invalidate(trace_id)
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Notification was not confirmed by the message broker"
+        ) from e
     except Exception as e:
-        data["status"] = "FALHA_ENVIO"
-        storage.set_notification(str(trace_id), data)
+        await storage.set_status(trace_id, "FALHA_ENVIO")
+        await storage.release_message_id(data['mensagemId'], trace_id)
+        notification_cache.invalidate(trace_id)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Internal server error"
         ) from e
 
-    return NotificationCreateResponse(mensagemId=mensagem_id, traceId=trace_id)
+    metrics.NOTIFICATIONS_RECEIVED.labels(data['channel']).inc()
+    return NotificationCreateResponse(mensagemId=data['mensagemId'], traceId=trace_id)
+
+@router.post("/notificar/lote", response_model=NotificationBatchResponse, status_code=status.HTTP_202_ACCEPTED)
+async def create_notification_batch(request: Request, response: Response, rabbitmq_service: RabbitMQService = Depends(get_rabbitmq_service)):
+    """Accepts a JSON array or an NDJSON stream of notifications.
+
+    Valid items are stored in one pipelined write and published together;
+    invalid, shed or unpublished items are reported individually. A batch
+    whose valid items were all shed is rejected as a whole with 429/503.
+    """
+    raw_items = await _read_batch_items(request)
+
+    results = []
+    accepted = []
+    shed_codes = []
+    for index, raw in enumerate(raw_items):
+        try:
+            notification = _validate_batch_item(raw)
+        except ValueError as e:
+            results.append(NotificationBatchItemResult(index=index, error=str(e)))
+            continue
+        shed = await backpressure.check(rabbitmq_service, notification.tipoNotificacao, notification.prioridade)
+        if shed is not None:
+            shed_codes.append(shed[0])
+            results.append(NotificationBatchItemResult(index=index, error=shed[1]))
+            continue
+        data = _build_notification_data(notification)
+        accepted.append((index, data))
+        results.append(NotificationBatchItemResult(index=index, mensagemId=data['mensagemId'], traceId=data['traceId']))
+
+    if shed_codes:
+        if not accepted:
+            raise _shed_load(max(shed_codes), "Notification batch rejected to shed load. Retry later.")
+        response.headers["Retry-After"] = str(settings.BACKPRESSURE_RETRY_AFTER_SECONDS)
+
+    if accepted:
+        # mensagemIds seen before (or earlier in this batch) resolve to their original traceId
+        original_trace_ids = await storage.claim_message_ids((data['mensagemId'], data['traceId']) for _, data in accepted)
+        for (index, data), original_trace_id in zip(accepted, original_trace_ids):
+            if original_trace_id is not None:
+                results[index] = NotificationBatchItemResult(index=index, mensagemId=data['mensagemId'], traceId=original_trace_id)
+                metrics.NOTIFICATIONS_DEDUPLICATED.labels(data['channel']).inc()
+        accepted = [item for item, original_trace_id in zip(accepted, original_trace_ids) if original_trace_id is None]
+
+    if accepted:
+        try:
+            await claim_check.check_in([data for _, data in accepted])
+            await storage.set_notifications({data['traceId']: data for _, data in accepted})
+        except Exception as e:
+            await asyncio.gather(*(storage.release_message_id(data['mensagemId'], data['traceId']) for _, data in accepted))
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail="Internal server error"
+            ) from e
+        errors = await publish_batch_to_stage(rabbitmq_service, [data for _, data in accepted], settings.NOTIFICATION_INPUT_QUEUE)
+        failed = [(index, data) for (index, data), error in zip(accepted, errors) if error is not None]
+        if failed:
+            await asyncio.gather(*(storage.set_status(data['traceId'], "FALHA_ENVIO") for _, data in failed))
+            await asyncio.gather(*(storage.release_message_id(data['mensagemId'], data['traceId']) for _, data in failed))
+            for _, data in failed:
+                notification_cache.invalidate(data['traceId'])
+            for index, _ in failed:
+                results[index].error = "Failed to publish notification"
+        for (_, data), error in zip(accepted, errors):
+            if error is None:
+                metrics.NOTIFICATIONS_RECEIVED.labels(data['channel']).inc()
+
+    rejected = sum(1 for result in results if result.error)
+    return NotificationBatchResponse(accepted=len(results) - rejected, rejected=rejected, results=results)
 
 @router.get("/notificacao/status/{traceId}", response_model=NotificationStatusResponse)
 async def get_status(traceId: str):
-    info = storage.get_notification(traceId)
+    info = await notification_cache.get(traceId)
     if info is None:
         raise HTTPException(status_code=404, detail="Notification not found")
     if 'channel' in info:
         info['tipoNotificacao'] = info.pop('channel')
+    content_dropped = settings.STORAGE_DROP_CONTENT_AFTER_DISPATCH and info['status'] == "ENVIADO_SUCESSO"
+    if not content_dropped:
+        try:
+            info = await claim_check.check_out(info)
+        except ContentNotFoundError:
+            pass  # expired from the content store: reported like a dropped content
     return NotificationStatusResponse(**info)
+
+def _invalid_cursor(cursor: str):
+    return HTTPException(status_code=422, detail=f"Invalid cursor: {cursor}")
+
+@router.get("/notificacoes", response_model=NotificationPage)
+async def list_notifications_by_status(
+    status_filter: str = Query(..., alias="status"),
+    tipoNotificacao: Optional[str] = None,
+    desde: Optional[float] = Query(None, description="Only notifications that entered the status since this epoch time, in seconds."),
+    limite: int = Query(50, ge=1, le=settings.NOTIFICATION_PAGE_MAX_SIZE),
+    cursor: Optional[str] = None,
+):
+    """Lists the notifications currently in a status, most recent transition first, from the status index."""
+    try:
+        entries, next_cursor = await storage.list_by_status(status_filter, tipoNotificacao, desde, limite, cursor)
+    except ValueError:
+        raise _invalid_cursor(cursor)
+    items = [
+        NotificationIndexItem(traceId=trace_id, tipoNotificacao=channel, status=status_filter, registradoEm=entered_at)
+        for trace_id, channel, entered_at in entries
+    ]
+    return NotificationPage(items=items, proximoCursor=next_cursor)
+
+@router.get("/notificacoes/mensagem/{mensagemId}", response_model=NotificationPage)
+async def list_notifications_by_message_id(
+    mensagemId: str,
+    limite: int = Query(50, ge=1, le=settings.NOTIFICATION_PAGE_MAX_SIZE),
+    cursor: Optional[str] = None,
+):
+    """Lists the notifications created for a mensagemId, newest first, with their current status."""
+    try:
+        entries, next_cursor = await storage.list_by_message_id(mensagemId, limite, cursor)
+    except ValueError:
+        raise _invalid_cursor(cursor)
+    statuses = await storage.get_statuses([trace_id for trace_id, _ in entries])
+    items = [
+        NotificationIndexItem(traceId=trace_id, tipoNotificacao=current[1], status=current[0], registradoEm=received_at)
+        for (trace_id, received_at), current in zip(entries, statuses)
+        if current is not None  # expired records
+    ]
+    return NotificationPage(items=items, proximoCursor=next_cursor)
+
+@router.get("/notificacoes/contagem", response_model=NotificationCountsResponse)
+async def count_notifications():
+    """Counts the stored notifications per status and channel from the status indexes."""
+    counts = await storage.status_counts()
+    return NotificationCountsResponse(
+        total=sum(n for channels in counts.values() for n in channels.values()),
+        contagens=counts,
+    )
+
+def _status_event(trace_id: str, status: str) -> dict:
+    return {"traceId": trace_id, "status": status}
+
+async def _sse_status_stream(subscription: StatusSubscription, trace_id: str, current_status: str, version: int):
+    """Sends the current status, then each newer one, and ends at a terminal status."""
+    try:
+        yield f"event: status\ndata: {json.dumps(_status_event(trace_id, current_status))}\n\n"
+        while current_status not in storage.TERMINAL_STATUSES:
+            event = await subscription.get(timeout=settings.STATUS_STREAM_KEEPALIVE_SECONDS)
+            if event is None:
+                yield ": keepalive\n\n"
+                continue
+            _, event_version, event_status = event
+            # Events published before the initial read are stale
+            if event_version <= version:
+                continue
+            version, current_status = event_version, event_status
+            yield f"event: status\ndata: {json.dumps(_status_event(trace_id, current_status))}\n\n"
+    finally:
+        await subscription.close()
+
+@router.get("/notificacao/status/{traceId}/stream")
+async def stream_status(traceId: str, events: StatusEventBus = Depends(get_status_events)):
+    """Streams the status changes of a notification as Server-Sent Events."""
+    # Subscribing before reading the status guarantees no change is missed in between
+    subscription = await events.subscribe([traceId])
+    current = await storage.get_status(traceId)
+    if current is None:
+        await subscription.close()
+        raise HTTPException(status_code=404, detail="Notification not found")
+    return StreamingResponse(
+        _sse_status_stream(subscription, traceId, *current),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@router.websocket("/notificacao/status/ws")
+async def status_websocket(websocket: WebSocket, events: StatusEventBus = Depends(get_status_events)):
+    """Multiplexes the status changes of many notifications over one WebSocket.
+
+    Clients send ``{"action": "subscribe" | "unsubscribe", "traceIds": [...]}``
+    and receive ``{"traceId": ..., "status": ...}`` for the current status of
+    each subscribed notification and for every later change.
+    """
+    await websocket.accept()
+    subscription = await events.subscribe()
+    versions = {}
+
+    async def receive_commands():
+        while True:
+            command = await websocket.receive_json()
+            trace_ids = command.get("traceIds") if isinstance(command, dict) else None
+            action = command.get("action") if isinstance(command, dict) else None
+            if action not in ("subscribe", "unsubscribe") or not isinstance(trace_ids, list):
+                await websocket.send_json({"error": 'Expected {"action": "subscribe" | "unsubscribe", "traceIds": [...]}'})
+                continue
+            trace_ids = [str(trace_id) for trace_id in trace_ids]
+            if action == "unsubscribe":
+                await subscription.remove(*trace_ids)
+                for trace_id in trace_ids:
+                    versions.pop(trace_id, None)
+                continue
+            new = [trace_id for trace_id in trace_ids if trace_id not in subscription.trace_ids]
+            if len(subscription.trace_ids) + len(new) > settings.STATUS_STREAM_MAX_TRACE_IDS:
+                await websocket.send_json({"error": f"Too many subscriptions. Maximum is {settings.STATUS_STREAM_MAX_TRACE_IDS} traceIds."})
+                continue
+            await subscription.add(*new)
+            for trace_id in new:
+                current = await storage.get_status(trace_id)
+                if current is None:
+                    await subscription.remove(trace_id)
+                    await websocket.send_json({"traceId": trace_id, "error": "Notification not found"})
+                    continue
+                versions[trace_id] = current[1]
+                await websocket.send_json(_status_event(trace_id, current[0]))
+
+    async def send_events():
+        while True:
+            trace_id, version, event_status = await subscription.get()
+            if trace_id in versions and version > versions[trace_id]:
+                versions[trace_id] = version
+                await websocket.send_json(_status_event(trace_id, event_status))
+
+    tasks = [asyncio.create_task(receive_commands()), asyncio.create_task(send_events())]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            if not isinstance(task.exception(), WebSocketDisconnect):
+                task.result()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await subscription.close()
@@ -0,0 +1,239 @@
+"""Repeatable load benchmark of the notification pipeline.
+
+Drives N notifications through every stage on the in-memory broker and
+storage backends, with the simulated failures seeded, and reports
+throughput, per-stage latency percentiles and memory usage::
+
+    python -m app.bench --count 10000 --seed 42 --json > result.json
+"""
+import argparse
+import asyncio
+import functools
+import json
+import random
+import resource
+import time
+import tracemalloc
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from app.api.endpoints.messages import _build_notification_data
+from app.core import claim_check, storage
+from app.core.config import settings
+from app.core.log import configure_logging
+from app.core.priority import stage_lanes
+from app.schemas.message import NotificationCreate
+from app.services.dispatcher import close_dispatchers
+from app.services.fused import FusedRabbitMQService
+from app.services.memory_broker import InMemoryRabbitMQService
+from app.services.retry import declare_retry_topology
+from app.services.topology import declare_stage, publish_batch_to_stage, shard_queues
+from app.worker import TASK_FUNCTIONS, process_message, resolve_consumer_limits, stage_handlers, stage_limiter
+
+
+@contextmanager
+def override_settings(**values):
+    previous = {name: getattr(settings, name) for name in values}
+    for name, value in values.items():
+        setattr(settings, name, value)
+    try:
+        yield
+    finally:
+        for name, value in previous.items():
+            setattr(settings, name, value)
+
+
+def percentiles(values: list) -> dict:
+    """Nearest-rank percentiles, in milliseconds."""
+    if not values:
+        return {"count": 0}
+    ordered = sorted(values)
+
+    def rank(p):
+        return ordered[min(len(ordered) - 1, max(0, round(p / 100 * len(ordered)) - 1))] * 1000
+
+    return {
+        "count": len(ordered),
+        "p50_ms": rank(50),
+        "p90_ms": rank(90),
+        "p99_ms": rank(99),
+        "max_ms": ordered[-1] * 1000,
+    }
+
+
+class StageTimer:
+    """Records how long each stage takes and when each notification last left a stage."""
+
+    def __init__(self):
+        self.durations = defaultdict(list)
+        self.finished_at = {}
+
+    def wrap(self, task_func):
+        durations = self.durations[task_func.__name__]
+
+        @functools.wraps(task_func)
+        async def timed(data, rabbitmq_service, headers=None):
+            started = time.perf_counter()
+            try:
+                await task_func(data, rabbitmq_service, headers=headers)
+            finally:
+                durations.append(time.perf_counter() - started)
+                self.finished_at[data.get("traceId")] = time.time()
+
+        return timed
+
+
+async def _ingest(rabbitmq_service: InMemoryRabbitMQService, count: int, batch_size: int) -> list:
+    """Stores and publishes the notifications like POST /api/notificar/lote does."""
+    received_at = {}
+    channels = settings.ALLOWED_NOTIFICATION_TYPES
+    for start in range(0, count, batch_size):
+        batch = [
+            _build_notification_data(NotificationCreate(conteudoMensagem=f"Benchmark {i}", tipoNotificacao=channels[i % len(channels)]))
+            for i in range(start, min(start + batch_size, count))
+        ]
+        await claim_check.check_in(batch)
+        await storage.set_notifications({data["traceId"]: data for data in batch})
+        await publish_batch_to_stage(rabbitmq_service, batch, settings.NOTIFICATION_INPUT_QUEUE)
+        received_at.update((data["traceId"], data["recebidoEm"]) for data in batch)
+    return received_at
+
+
+async def _final_statuses(trace_ids: list) -> Counter:
+    statuses = Counter()
+    for trace_id in trace_ids:
+        data = await storage.get_notification(trace_id)
+        statuses[data["status"] if data else None] += 1
+    return statuses
+
+
+async def run_benchmark(
+    count: int = 1000,
+    seed: int = 42,
+    batch_size: int = 100,
+    prefetch: int = None,
+    concurrency: int = None,
+    latency_scale: float = 0.0,
+    retry_backoff: float = 0.0,
+    dispatch_wait_ms: float = 0.0,
+    write_behind: bool = False,
+    fused: bool = False,
+    timeout: float = 300.0,
+) -> dict:
+    random.seed(seed)
+    overrides = dict(
+        STORAGE_BACKEND="memory",
+        SIMULATED_LATENCY_SCALE=latency_scale,
+        RETRY_BACKOFF_BASE_SECONDS=retry_backoff,
+        DISPATCH_BATCH_WAIT_MS=dispatch_wait_ms,
+    )
+    with override_settings(**overrides):
+        rabbitmq_service = InMemoryRabbitMQService()
+        fused_service = FusedRabbitMQService(rabbitmq_service, settings.WORKER_FUSED_QUEUE_SIZE) if fused else None
+        task_service = fused_service or rabbitmq_service
+        timer = StageTimer()
+        await storage.close()
+        try:
+            await storage.clear_storage()
+            await declare_retry_topology(rabbitmq_service)
+            for queue_name, task_func in TASK_FUNCTIONS.items():
+                await declare_stage(rabbitmq_service, queue_name)
+                prefetch_count, max_concurrency = resolve_consumer_limits(queue_name, prefetch, concurrency)
+                timed = timer.wrap(task_func)
+                limiter = stage_limiter(queue_name, max_concurrency) if fused_service else None
+                handlers = stage_handlers(queue_name, lambda msg, tf=timed: process_message(msg, tf, task_service), max_concurrency, limiter)
+                for priority, lane in stage_lanes(queue_name).items():
+                    handler = handlers[lane]
+                    if fused_service:
+                        fused_service.add_stage(lane, timed, max_concurrency, limiter, priority)
+                    for consumed_queue in shard_queues(lane):
+                        await rabbitmq_service.start_consumer(consumed_queue, handler, prefetch_count=prefetch_count)
+            if write_behind:
+                storage.start_write_behind()
+
+            started = time.perf_counter()
+            received_at = await _ingest(rabbitmq_service, count, batch_size)
+            ingest_seconds = time.perf_counter() - started
+            await rabbitmq_service.join(timeout)
+            await storage.stop_write_behind()
+            elapsed = time.perf_counter() - started
+
+            statuses = await _final_statuses(list(received_at))
+        finally:
+            if fused_service:
+                await fused_service.close()
+            await close_dispatchers()
+            await rabbitmq_service.close()
+            await storage.close()
+
+    end_to_end = [timer.finished_at[trace_id] - at for trace_id, at in received_at.items() if trace_id in timer.finished_at]
+    return {
+        "count": count,
+        "seed": seed,
+        "codec": settings.MESSAGE_CODEC,
+        "write_behind": write_behind,
+        "fused": fused,
+        "elapsed_seconds": elapsed,
+        "ingest_seconds": ingest_seconds,
+        "notifications_per_second": count / elapsed if elapsed else 0.0,
+        "messages_per_second": rabbitmq_service.published / elapsed if elapsed else 0.0,
+        "published": rabbitmq_service.published,
+        "dead_lettered": rabbitmq_service.dead_lettered,
+        "stages": {stage: percentiles(durations) for stage, durations in timer.durations.items()},
+        "end_to_end": percentiles(end_to_end),
+        "final_statuses": dict(statuses),
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def format_report(result: dict) -> str:
+    lines = [
+        f"Notifications: {result['count']} (seed {result['seed']}, codec {result['codec']}, write-behind {result['write_behind']}, fused {result['fused']})",
+        f"Elapsed: {result['elapsed_seconds']:.3f}s (ingest {result['ingest_seconds']:.3f}s)",
+        f"Throughput: {result['notifications_per_second']:.1f} notifications/s, {result['messages_per_second']:.1f} msgs/s ({result['published']} published)",
+        f"Max RSS: {result['max_rss_mb']:.1f} MB",
+    ]
+    if "tracemalloc_peak_mb" in result:
+        lines.append(f"Python allocations peak: {result['tracemalloc_peak_mb']:.1f} MB")
+    lines.append(f"{'stage':<32}{'count':>8}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for stage, stats in [*result["stages"].items(), ("end_to_end", result["end_to_end"])]:
+        if stats["count"]:
+            lines.append(f"{stage:<32}{stats['count']:>8}{stats['p50_ms']:>10.2f}{stats['p90_ms']:>10.2f}{stats['p99_ms']:>10.2f}{stats['max_ms']:>10.2f}")
+    lines.append("Final statuses: " + ", ".join(f"{status}={n}" for status, n in sorted(result["final_statuses"].items(), key=str)))
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the notification pipeline on the in-memory broker and storage.")
+    parser.add_argument("--count", type=int, default=1000, help="Number of notifications to send.")
+    parser.add_argument("--seed", type=int, default=42, help="Seed of the simulated failures.")
+    parser.add_argument("--batch-size", type=int, default=100, help="Notifications stored and published per ingestion batch.")
+    parser.add_argument("--prefetch", type=int, help="Prefetch count for every queue.")
+    parser.add_argument("--concurrency", type=int, help="Max concurrent handlers for every queue.")
+    parser.add_argument("--latency-scale", type=float, default=0.0, help="Multiplier of the stages' simulated processing time.")
+    parser.add_argument("--retry-backoff", type=float, default=0.0, help="Base retry backoff, in seconds (0 keeps runs with the same seed identical).")
+    parser.add_argument("--dispatch-wait-ms", type=float, default=0.0, help="Max wait to fill a provider batch, in ms (0 keeps runs with the same seed identical).")
+    parser.add_argument("--write-behind", action="store_true", help="Enable write-behind batching of status updates.")
+    parser.add_argument("--fused", action="store_true", help="Hand messages between the stages over in memory (fused mode).")
+    parser.add_argument("--tracemalloc", action="store_true", help="Also report the peak of Python allocations (slower).")
+    parser.add_argument("--log-level", default="CRITICAL", help="Log level of the pipeline (logging is off by default).")
+    parser.add_argument("--json", action="store_true", help="Print the result as JSON.")
+    args = parser.parse_args()
+
+    configure_logging(args.log_level)
+    if args.tracemalloc:
+        tracemalloc.start()
+    result = asyncio.run(run_benchmark(
+        count=args.count,
+        seed=args.seed,
+        batch_size=args.batch_size,
+        prefetch=args.prefetch,
+        concurrency=args.concurrency,
+        latency_scale=args.latency_scale,
+        retry_backoff=args.retry_backoff,
+        dispatch_wait_ms=args.dispatch_wait_ms,
+        write_behind=args.write_behind,
+        fused=args.fused,
+    ))
+    if args.tracemalloc:
+        result["tracemalloc_peak_mb"] = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+    print(json.dumps(result, indent=2) if args.json else format_report(result))
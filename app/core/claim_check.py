@@ -0,0 +1,171 @@
+import gzip
+import hashlib
+from collections import OrderedDict
+from typing import Optional
+from app.core import metrics, storage
+from app.core.config import settings
+from app.core.exceptions import ContentNotFoundError
+
+# Large message contents (e.g. campaign HTML emails) are checked in to the
+# content store once and the notification carries a small reference instead
+# of them through every queue hop and the Redis record. Identical contents
+# share one stored blob; the channel stage checks the content out right
+# before handing the notification to the provider.
+CONTENT_KEY = storage.CONTENT_KEY
+CONTENT_REF_KEY = "conteudoRef"
+
+_STORED = metrics.CLAIM_CHECK.labels("stored")
+_DEDUPLICATED = metrics.CLAIM_CHECK.labels("deduplicated")
+_FETCHED = metrics.CLAIM_CHECK.labels("fetched")
+_CACHED = metrics.CLAIM_CHECK.labels("cached")
+_MISSING = metrics.CLAIM_CHECK.labels("missing")
+
+
+class NoCompression:
+    name = "none"
+
+    def compress(self, data: bytes) -> bytes:
+        return data
+
+    def decompress(self, data: bytes) -> bytes:
+        return data
+
+
+class GzipCompression:
+    name = "gzip"
+
+    def compress(self, data: bytes) -> bytes:
+        # mtime=0 keeps the output of identical contents identical
+        return gzip.compress(data, mtime=0)
+
+    def decompress(self, data: bytes) -> bytes:
+        return gzip.decompress(data)
+
+
+class ZstdCompression:
+    name = "zstd"
+
+    def __init__(self):
+        try:
+            import zstandard
+        except ImportError as e:
+            raise ImportError("CLAIM_CHECK_COMPRESSION=zstd requires the 'zstd' extra (zstandard).") from e
+        self._compressor = zstandard.ZstdCompressor()
+        self._decompressor = zstandard.ZstdDecompressor()
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data)
+
+    def decompress(self, data: bytes) -> bytes:
+        return self._decompressor.decompress(data)
+
+
+COMPRESSIONS = {compression.name: compression for compression in (NoCompression, GzipCompression, ZstdCompression)}
+_instances = {}
+
+
+def get_compression(name: str):
+    compression = _instances.get(name)
+    if compression is None:
+        if name not in COMPRESSIONS:
+            raise ValueError(f"Unknown claim check compression '{name}'. Available compressions: {', '.join(COMPRESSIONS)}")
+        compression = _instances[name] = COMPRESSIONS[name]()
+    return compression
+
+
+def content_id(ref: dict) -> str:
+    return f"{ref['sha256']}.{ref['encoding']}"
+
+
+def referenced_contents(data: dict) -> list:
+    """Returns the ids of the checked-in contents a notification refers to."""
+    ref = data.get(CONTENT_REF_KEY)
+    return [content_id(ref)] if ref else []
+
+
+async def check_in(notifications: list):
+    """Replaces contents of at least CLAIM_CHECK_THRESHOLD_BYTES by a reference, in place.
+
+    The contents are stored in one pipelined round trip, each distinct
+    content once.
+    """
+    threshold = settings.CLAIM_CHECK_THRESHOLD_BYTES
+    if threshold <= 0:
+        return
+    compression = get_compression(settings.CLAIM_CHECK_COMPRESSION)
+    contents = {}
+    checked_in = 0
+    for data in notifications:
+        content = data.get(CONTENT_KEY)
+        if content is None:
+            continue
+        raw = content.encode()
+        if len(raw) < threshold:
+            continue
+        ref = {"sha256": hashlib.sha256(raw).hexdigest(), "encoding": compression.name, "bytes": len(raw)}
+        if content_id(ref) not in contents:
+            contents[content_id(ref)] = compression.compress(raw)
+        data[CONTENT_REF_KEY] = ref
+        data[CONTENT_KEY] = None
+        checked_in += 1
+    if contents:
+        stored = await storage.store_contents(contents)
+        _STORED.inc(stored)
+        _DEDUPLICATED.inc(checked_in - stored)
+
+
+class ContentCache:
+    """Bounded LRU of checked-out contents, so a campaign body is fetched once per process."""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+
+    def get(self, key: str) -> Optional[str]:
+        content = self._entries.get(key)
+        if content is not None:
+            self._entries.move_to_end(key)
+        return content
+
+    def put(self, key: str, content: str):
+        if self.max_entries <= 0:
+            return
+        self._entries[key] = content
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+content_cache = ContentCache(settings.CLAIM_CHECK_CACHE_SIZE)
+
+
+async def check_out(data: dict) -> dict:
+    """Returns the notification with its content fetched back from the content store.
+
+    Raises ContentNotFoundError if the content expired from the store.
+    """
+    ref = data.get(CONTENT_REF_KEY)
+    if not ref or data.get(CONTENT_KEY) is not None:
+        return data
+    key = content_id(ref)
+    content = content_cache.get(key)
+    if content is not None:
+        _CACHED.inc()
+    else:
+        blob = await storage.get_content(key)
+        if blob is None:
+            _MISSING.inc()
+            raise ContentNotFoundError(f"Content {key} is no longer in the content store")
+        _FETCHED.inc()
+        content = get_compression(ref["encoding"]).decompress(blob).decode()
+        content_cache.put(key, content)
+    return {**data, CONTENT_KEY: content}
+
+
+metrics.GaugeCallback("claim_check_cache_entries", "Checked-out contents held by the local content cache.", (), lambda: {(): len(content_cache)})
@@ -0,0 +1,86 @@
+import json
+from typing import Optional
+from app.core.config import settings
+
+JSON_CONTENT_TYPE = "application/json"
+MSGPACK_CONTENT_TYPE = "application/msgpack"
+
+
+class JsonCodec:
+    name = "json"
+    content_type = JSON_CONTENT_TYPE
+
+    def encode(self, data) -> bytes:
+        return json.dumps(data).encode()
+
+    def decode(self, payload: bytes):
+        return json.loads(payload)
+
+
+class OrjsonCodec:
+    # orjson emits plain JSON, so consumers using stdlib json can still read it
+    name = "orjson"
+    content_type = JSON_CONTENT_TYPE
+
+    def __init__(self):
+        try:
+            import orjson
+        except ImportError as e:
+            raise ImportError("MESSAGE_CODEC=orjson requires the 'fast-codecs' extra (orjson).") from e
+        self._orjson = orjson
+
+    def encode(self, data) -> bytes:
+        return self._orjson.dumps(data)
+
+    def decode(self, payload: bytes):
+        return self._orjson.loads(payload)
+
+
+class MsgpackCodec:
+    name = "msgpack"
+    content_type = MSGPACK_CONTENT_TYPE
+
+    def __init__(self):
+        try:
+            import msgpack
+        except ImportError as e:
+            raise ImportError("MESSAGE_CODEC=msgpack requires the 'fast-codecs' extra (msgpack).") from e
+        self._msgpack = msgpack
+
+    def encode(self, data) -> bytes:
+        return self._msgpack.packb(data)
+
+    def decode(self, payload: bytes):
+        return self._msgpack.unpackb(payload)
+
+
+CODECS = {codec.name: codec for codec in (JsonCodec, OrjsonCodec, MsgpackCodec)}
+_instances = {}
+
+
+def _get(name: str):
+    codec = _instances.get(name)
+    if codec is None:
+        if name not in CODECS:
+            raise ValueError(f"Unknown message codec '{name}'. Available codecs: {', '.join(CODECS)}")
+        codec = _instances[name] = CODECS[name]()
+    return codec
+
+
+def get_codec():
+    """Returns the codec selected by MESSAGE_CODEC, used to encode outgoing payloads."""
+    return _get(settings.MESSAGE_CODEC)
+
+
+def codec_for_content_type(content_type: Optional[str]):
+    """Returns the codec able to decode a payload declared with the given content type.
+
+    Payloads without a (known) content type come from producers that predate
+    codec selection and are JSON.
+    """
+    if content_type in (MSGPACK_CONTENT_TYPE, "application/x-msgpack"):
+        return _get(MsgpackCodec.name)
+    codec = get_codec()
+    if codec.content_type == JSON_CONTENT_TYPE:
+        return codec
+    return _get(JsonCodec.name)
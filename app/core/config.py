@@ -1,3 +1,4 @@
+from typing import Optional
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
@@ -6,15 +7,156 @@ class Settings(BaseSettings):
     RABBITMQ_PORT: int = 5672
     RABBITMQ_USER: str = "guest"
     RABBITMQ_PASS: str = "guest"
+    RABBITMQ_CHANNEL_POOL_SIZE: int = 10
+
+    # Publisher confirms: persistent messages, many unconfirmed publishes in flight per window
+    RABBITMQ_PUBLISHER_CONFIRMS: bool = True
+    RABBITMQ_CONFIRM_CHANNELS: int = 2
+    RABBITMQ_CONFIRM_WINDOW: int = 256
+    RABBITMQ_CONFIRM_TIMEOUT: float = 10.0
+    RABBITMQ_PUBLISH_RETRIES: int = 3
+    RABBITMQ_PUBLISH_RETRY_BACKOFF: float = 0.1
 
     REDIS_HOST: str = "redis"
     REDIS_PORT: int = 6379
     REDIS_DB: int = 0
+    REDIS_MAX_CONNECTIONS: int = 50
+    REDIS_POOL_TIMEOUT: float = 5.0
+    REDIS_SOCKET_TIMEOUT: float = 5.0
+    REDIS_SOCKET_CONNECT_TIMEOUT: float = 5.0
+    # "redis" or "memory": an in-process Redis emulation (requires the 'memory' extra), used by benchmarks
+    STORAGE_BACKEND: str = "redis"
+    # Namespace of the notification keys, so clear_storage and reports never touch other data in the DB
+    REDIS_KEY_PREFIX: str = "notificacao:"
+    # Retention of notification records by status, in seconds (0 keeps them forever)
+    NOTIFICATION_INFLIGHT_TTL_SECONDS: int = 7 * 24 * 3600
+    NOTIFICATION_TERMINAL_TTL_SECONDS: int = 24 * 3600
+    # Drop the message content from the record once it was sent, keeping only its status
+    STORAGE_DROP_CONTENT_AFTER_DISPATCH: bool = False
+    # Secondary indexes (by status and channel, by mensagemId) behind the listing and count endpoints
+    STORAGE_INDEXES_ENABLED: bool = True
+    # Window, in seconds, in which a repeated mensagemId returns the original traceId (0 disables it)
+    IDEMPOTENCY_TTL_SECONDS: int = 24 * 3600
+    # Claim check: message contents of at least this many bytes (0 disables it) are stored once in
+    # Redis, keyed by their SHA-256 and compressed ("none", "gzip" or "zstd"), and only a reference
+    # travels through the queues; the channel stage fetches them back, caching the last few locally
+    CLAIM_CHECK_THRESHOLD_BYTES: int = 0
+    CLAIM_CHECK_COMPRESSION: str = "gzip"
+    CLAIM_CHECK_TTL_SECONDS: int = 7 * 24 * 3600
+    CLAIM_CHECK_CACHE_SIZE: int = 256
+
+    # Write-behind batching of status updates (worker only)
+    STATUS_WRITE_BEHIND_ENABLED: bool = False
+    STATUS_WRITE_BEHIND_BATCH_SIZE: int = 500
+    STATUS_WRITE_BEHIND_FLUSH_INTERVAL: float = 0.05
+    STATUS_WRITE_BEHIND_MAX_PENDING: int = 10000
+
+    # Payload codec for broker messages and stored notifications: "json", "orjson" or "msgpack"
+    MESSAGE_CODEC: str = "json"
 
     NOTIFICATION_INPUT_QUEUE: str = "fila.notificacao.entrada"
     NOTIFICATION_RETRY_QUEUE: str = "fila.notificacao.retry"
     NOTIFICATION_VALIDATION_QUEUE: str = "fila.notificacao.validacao"
     NOTIFICATION_DLQ: str = "fila.notificacao.dlq"
+    # Share of the handler slots of a stage each priority lane gets while both have messages waiting
+    PRIORITY_LANE_WEIGHTS: dict[str, int] = {"alta": 4, "normal": 1}
+    # Each channel of ALLOWED_NOTIFICATION_TYPES is dispatched from its own queue: prefix + channel
+    NOTIFICATION_CHANNEL_QUEUE_PREFIX: str = "fila.notificacao.envio."
+    # Shards per queue of the input, validation and channel stages (lane queues included, e.g.
+    # {"fila.notificacao.entrada": 4}); sharded queues need the rabbitmq_consistent_hash_exchange plugin
+    QUEUE_SHARDS: dict[str, int] = {}
+
+    # Per-channel dispatch: provider per channel ("fake" or "package.module:ClassName"; default "fake"),
+    # sends batched per provider call by size or wait, and rate limits in sends per second shared by
+    # every worker process (channels without a limit are not throttled; the burst defaults to one second)
+    DISPATCH_PROVIDERS: dict[str, str] = {}
+    DISPATCH_BATCH_SIZE: int = 50
+    DISPATCH_BATCH_WAIT_MS: float = 20.0
+    DISPATCH_RATE_LIMITS: dict[str, float] = {}
+    DISPATCH_RATE_BURST: dict[str, int] = {}
+    # Share of the notifications the fake provider fails
+    FAKE_PROVIDER_FAILURE_RATE: float = 0.05
+
+    # Consumer QoS: prefetch count and max concurrent handlers, with optional per-queue overrides
+    WORKER_DEFAULT_PREFETCH: int = 10
+    WORKER_DEFAULT_CONCURRENCY: int = 10
+    WORKER_QUEUE_PREFETCH: dict[str, int] = {}
+    WORKER_QUEUE_CONCURRENCY: dict[str, int] = {}
+    # Fused mode: stages hosted in the same worker hand messages over in memory instead of via the broker
+    WORKER_FUSED_STAGES: bool = False
+    WORKER_FUSED_QUEUE_SIZE: int = 100
+    # Shard numbers of the sharded queues this worker consumes (empty: all of them)
+    WORKER_SHARDS: list[int] = []
+    # Skip deliveries a stage already finished for a traceId (broker redeliveries, duplicate publishes);
+    # finished deliveries are remembered in a local LRU of this size backed by the notification records
+    WORKER_DEDUP_ENABLED: bool = True
+    WORKER_DEDUP_CACHE_SIZE: int = 100000
+
+    # Worker shutdown and multi-process supervisor
+    WORKER_SHUTDOWN_TIMEOUT: float = 30.0
+    WORKER_RESTART_BACKOFF_SECONDS: float = 1.0
+    WORKER_RESTART_BACKOFF_MAX_SECONDS: float = 30.0
+    WORKER_RESTART_RESET_SECONDS: float = 60.0
+    # Crashes in a row (each before WORKER_RESTART_RESET_SECONDS of uptime) that the health endpoint reports as a crash loop
+    WORKER_CRASH_LOOP_FAILURES: int = 3
+    WORKER_HEALTH_PORT: Optional[int] = None
+    # Port of the worker's /metrics endpoint; with several processes each child uses port + its index
+    WORKER_METRICS_PORT: Optional[int] = None
+
+    # Delayed retries through per-attempt TTL queues that dead-letter back to the retry queue.
+    # Changing the backoff changes the delay queues' x-message-ttl, so existing
+    # delay queues must be deleted before the new values can be declared.
+    RETRY_MAX_ATTEMPTS: int = 3
+    RETRY_BACKOFF_BASE_SECONDS: float = 3.0
+    RETRY_BACKOFF_MULTIPLIER: float = 2.0
+    RETRY_BACKOFF_MAX_SECONDS: float = 60.0
+    RETRY_BACKOFF_JITTER: float = 0.1
+
+    # Dead messages are kept this long for inspection and replay; replays publish this many messages
+    # per batch, at most this many per second by default
+    DLQ_RETENTION_SECONDS: int = 14 * 24 * 3600
+    DLQ_REPLAY_BATCH_SIZE: int = 100
+    DLQ_REPLAY_RATE: float = 50.0
+
+    # Load shedding of the ingestion API (0 disables a watermark). With more messages waiting in the
+    # input stage than the high watermark, normal-priority notifications get 429; past the critical
+    # watermark, or while publishes take BACKPRESSURE_PUBLISH_LATENCY_MS on average, every notification
+    # gets 503. BACKPRESSURE_CHANNEL_WATERMARKS sheds a single tipoNotificacao with 429 when its
+    # dispatch queue is that deep. Depths are read from the broker at most every REFRESH seconds.
+    BACKPRESSURE_QUEUE_HIGH_WATERMARK: int = 0
+    BACKPRESSURE_QUEUE_CRITICAL_WATERMARK: int = 0
+    BACKPRESSURE_PUBLISH_LATENCY_MS: float = 0.0
+    BACKPRESSURE_CHANNEL_WATERMARKS: dict[str, int] = {}
+    BACKPRESSURE_REFRESH_SECONDS: float = 1.0
+    BACKPRESSURE_RETRY_AFTER_SECONDS: int = 5
+
+    NOTIFICATION_BATCH_MAX_SIZE: int = 1000
+    # Largest page of the listing endpoints
+    NOTIFICATION_PAGE_MAX_SIZE: int = 500
+
+    # Status streaming (SSE / WebSocket): events buffered per subscriber, keepalive and resubscribe delays
+    STATUS_STREAM_MAX_PENDING: int = 100
+    STATUS_STREAM_KEEPALIVE_SECONDS: float = 15.0
+    STATUS_STREAM_RECONNECT_SECONDS: float = 1.0
+    STATUS_STREAM_RECONNECT_MAX_SECONDS: float = 30.0
+    # Max traceIds a single WebSocket connection can watch at once
+    STATUS_STREAM_MAX_TRACE_IDS: int = 1000
+
+    # In-process cache of the status endpoint; a TTL of 0 disables caching of that kind of status
+    STATUS_CACHE_MAX_ENTRIES: int = 10000
+    STATUS_CACHE_TERMINAL_TTL: float = 300.0
+    STATUS_CACHE_INFLIGHT_TTL: float = 0.5
+
+    # Logging of the API and the workers: "text" or "json" lines, written by a background thread
+    # when LOG_ASYNC is on. LOG_SAMPLE_RATES keeps a fraction of the records of a level below WARNING
+    # (e.g. {"INFO": 0.01}); warnings and errors are always logged.
+    LOG_LEVEL: str = "INFO"
+    LOG_FORMAT: str = "text"
+    LOG_ASYNC: bool = True
+    LOG_SAMPLE_RATES: dict[str, float] = {}
+
+    # Multiplier of the simulated processing time of the stages (0 disables it, e.g. in benchmarks)
+    SIMULATED_LATENCY_SCALE: float = 1.0
 
     ALLOWED_NOTIFICATION_TYPES: list[str] = ["email", "sms", "push"]
 
@@ -0,0 +1,52 @@
+from collections import OrderedDict
+from app.core import metrics, storage
+from app.core.config import settings
+
+
+class ProcessedSet:
+    """Deliveries a stage already finished, keyed by (traceId, step).
+
+    The shared marks live in the notification records, so they are seen by
+    every worker and expire with the record. A bounded LRU in front of them
+    answers repeats handled by this process without a Redis round trip.
+    A delivery is only marked once its stage returns, so one interrupted
+    midway is still processed again.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+
+    def _remember(self, key: tuple):
+        if self.max_entries <= 0:
+            return
+        self._entries[key] = True
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def contains(self, trace_id: str, step: str) -> bool:
+        key = (trace_id, step)
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return True
+        if await storage.is_processed(trace_id, step):
+            self._remember(key)
+            return True
+        return False
+
+    async def add(self, trace_id: str, step: str):
+        # Notifications without a record (expired or never stored) are not tracked
+        if await storage.mark_processed(trace_id, step):
+            self._remember((trace_id, step))
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+processed_set = ProcessedSet(settings.WORKER_DEDUP_CACHE_SIZE)
+
+metrics.GaugeCallback("worker_dedup_entries", "Finished deliveries held by the local dedup cache.", (), lambda: {(): len(processed_set)})
@@ -0,0 +1,10 @@
+class PublishNackError(Exception):
+    """Raised when the broker does not confirm a published message after all retries."""
+
+
+class ProviderError(Exception):
+    """Raised when a notification provider did not accept a notification."""
+
+
+class ContentNotFoundError(Exception):
+    """Raised when the content referenced by a claim check is no longer in the content store."""
@@ -0,0 +1,109 @@
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+from typing import Dict, Optional
+from app.core.config import settings
+
+# The traceId of the message being handled is bound to the running task by
+# the worker, so every record logged while handling it carries the traceId
+# as a field instead of formatting it into each message.
+TRACE_ID_FIELD = "traceId"
+TEXT_FORMAT = "%(asctime)s %(levelname)s %(name)s [traceId: %(traceId)s] %(message)s"
+
+_trace_id = contextvars.ContextVar("trace_id", default=None)
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def bind_trace_id(trace_id: Optional[str]) -> contextvars.Token:
+    return _trace_id.set(trace_id)
+
+
+def reset_trace_id(token: contextvars.Token):
+    _trace_id.reset(token)
+
+
+class TraceIdFilter(logging.Filter):
+    """Adds the bound traceId to each record, unless the call passed one in ``extra``."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not hasattr(record, TRACE_ID_FIELD):
+            setattr(record, TRACE_ID_FIELD, _trace_id.get() or "-")
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps a fraction of the records of the levels in ``rates``; WARNING and above are always kept."""
+
+    def __init__(self, rates: Dict[str, float]):
+        super().__init__()
+        self.rates = {logging.getLevelName(level.upper()): rate for level, rate in rates.items()}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.rates.get(record.levelno, 1.0)
+        return rate >= 1 or random.random() < rate
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": record.created,
+            "level": record.levelname,
+            "logger": record.name,
+            TRACE_ID_FIELD: getattr(record, TRACE_ID_FIELD, None),
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Enqueues records as they are, so the message is only formatted by the listener thread.
+
+    The stock QueueHandler formats the record before enqueueing it, which
+    would keep the formatting on the event loop.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+def configure_logging(level: Optional[str] = None):
+    """Sets up the root logger from the LOG_* settings, replacing its handlers; safe to call again."""
+    global _listener
+    stop_logging()
+    stream = logging.StreamHandler(sys.stderr)
+    stream.setFormatter(JsonFormatter() if settings.LOG_FORMAT == "json" else logging.Formatter(TEXT_FORMAT))
+    if settings.LOG_ASYNC:
+        records = queue.SimpleQueue()
+        handler = DeferredQueueHandler(records)
+        _listener = logging.handlers.QueueListener(records, stream)
+        _listener.start()
+    else:
+        handler = stream
+    # Run by the logging call itself: sampling first, so a dropped record is never enqueued
+    handler.addFilter(SamplingFilter(settings.LOG_SAMPLE_RATES))
+    handler.addFilter(TraceIdFilter())
+    root = logging.getLogger()
+    for existing in root.handlers[:]:
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel((level or settings.LOG_LEVEL).upper())
+
+
+def stop_logging():
+    """Writes out the records still queued and stops the listener thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(stop_logging)
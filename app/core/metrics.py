@@ -0,0 +1,115 @@
+import logging
+import time
+from typing import Optional
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, generate_latest, start_http_server
+from prometheus_client import Histogram as _Histogram
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.registry import Collector
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = CONTENT_TYPE_LATEST
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Histogram(_Histogram):
+    """prometheus_client Histogram defaulting to buckets that also resolve millisecond latencies."""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS, **kwargs):
+        super().__init__(name, documentation, labelnames, buckets=buckets, **kwargs)
+
+
+class GaugeCallback(Collector):
+    """Gauge whose samples are read from a callback at scrape time.
+
+    The callback returns a mapping of label values tuples to numbers.
+    """
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple, callback, registry: Optional[CollectorRegistry] = REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.callback = callback
+        if registry is not None:
+            registry.register(self)
+
+    def _family(self) -> GaugeMetricFamily:
+        return GaugeMetricFamily(self.name, self.documentation, labels=self.labelnames)
+
+    def describe(self):
+        return [self._family()]
+
+    def collect(self):
+        family = self._family()
+        try:
+            values = self.callback() or {}
+        except Exception as e:
+            logger.warning(f"Failed to collect metric {self.name}: {e}")
+            values = {}
+        for label_values, value in values.items():
+            family.add_metric([str(label) for label in label_values], value)
+        yield family
+
+
+def render(registry: CollectorRegistry = REGISTRY) -> bytes:
+    """Returns the registry in the Prometheus text exposition format."""
+    return generate_latest(registry)
+
+
+def start_metrics_server(port: int, registry: CollectorRegistry = REGISTRY):
+    """Serves the registry at /metrics from a background thread; returns the server to shut it down."""
+    server, _ = start_http_server(port, registry=registry)
+    logger.info(f"Metrics endpoint listening on port {port}.")
+    return server
+
+
+# Pipeline metrics shared by the API and the workers
+STAGE_DURATION = Histogram("notification_stage_duration_seconds", "Time spent in each pipeline stage function.", ("stage",))
+STAGE_MESSAGES = Counter("notification_stage_messages_total", "Messages handled by each pipeline stage function.", ("stage", "outcome"))
+STAGE_IN_FLIGHT = Gauge("notification_stage_in_flight", "Messages currently being handled by each stage function.", ("stage",))
+END_TO_END = Histogram(
+    "notification_end_to_end_seconds",
+    "Time from RECEBIDO to a terminal status, by priority lane.",
+    ("status", "priority"),
+    buckets=(0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0),
+)
+RETRIES_SCHEDULED = Counter("notification_retries_scheduled_total", "Delayed retries scheduled, by attempt.", ("attempt",))
+DLQ_MESSAGES = Counter("notification_dlq_messages_total", "Messages sent to the DLQ, by the stage that gave up.", ("stage",))
+DLQ_REPLAYED = Counter("notification_dlq_replayed_total", "Dead messages published again by a replay, by target stage and outcome.", ("target", "outcome"))
+NOTIFICATIONS_RECEIVED = Counter("notifications_received_total", "Notifications accepted by the API.", ("channel",))
+NOTIFICATIONS_DEDUPLICATED = Counter("notifications_deduplicated_total", "Repeated mensagemIds answered with the original traceId.", ("channel",))
+CLAIM_CHECK = Counter("notification_claim_check_total", "Message contents moved to or read back from the content store, by operation.", ("operation",))
+PUBLISH_DURATION = Histogram("rabbitmq_publish_duration_seconds", "Time to publish a message (including the confirm in confirm mode).", ("exchange",))
+PUBLISH_ERRORS = Counter("rabbitmq_publish_errors_total", "Publishes that failed.", ("exchange",))
+REDIS_DURATION = Histogram("redis_operation_duration_seconds", "Latency of storage operations against Redis.", ("operation",))
+
+
+class StageMetrics:
+    """Pre-resolved children of the stage metrics, so the hot path does no label lookups."""
+
+    __slots__ = ("duration", "in_flight", "success", "error", "requeued", "duplicate")
+
+    def __init__(self, stage: str):
+        self.duration = STAGE_DURATION.labels(stage)
+        self.in_flight = STAGE_IN_FLIGHT.labels(stage)
+        self.success = STAGE_MESSAGES.labels(stage, "success")
+        self.error = STAGE_MESSAGES.labels(stage, "error")
+        self.requeued = STAGE_MESSAGES.labels(stage, "requeued")
+        self.duplicate = STAGE_MESSAGES.labels(stage, "duplicate")
+
+
+_stage_metrics = {}
+
+
+def stage_metrics(stage: str) -> StageMetrics:
+    metrics = _stage_metrics.get(stage)
+    if metrics is None:
+        metrics = _stage_metrics[stage] = StageMetrics(stage)
+    return metrics
+
+
+def observe_end_to_end(data: dict, status: str):
+    """Records the time since the notification was received by the API, if known."""
+    received_at = data.get("recebidoEm")
+    if received_at:
+        END_TO_END.labels(status, data.get("prioridade") or "normal").observe(max(time.time() - received_at, 0.0))
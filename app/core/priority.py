@@ -0,0 +1,109 @@
+import asyncio
+import time
+from collections import deque
+from typing import Dict, Optional
+from app.core import metrics
+from app.core.config import settings
+
+# Notifications with prioridade "alta" (e.g. OTPs, password resets) travel
+# through their own "<queue>.alta" lane of the latency-sensitive stages, so
+# they do not wait behind the backlog of bulk traffic in the normal lane
+HIGH_PRIORITY = "alta"
+DEFAULT_PRIORITY = "normal"
+PRIORITIES = (HIGH_PRIORITY, DEFAULT_PRIORITY)
+
+LANE_WAIT = metrics.Histogram(
+    "notification_lane_wait_seconds",
+    "Time a delivered message waited for a handler slot of its stage, by priority lane.",
+    ("queue", "priority"),
+)
+
+
+def has_lanes(queue_name: str) -> bool:
+    return (
+        queue_name in (settings.NOTIFICATION_INPUT_QUEUE, settings.NOTIFICATION_VALIDATION_QUEUE)
+        or queue_name.startswith(settings.NOTIFICATION_CHANNEL_QUEUE_PREFIX)
+    )
+
+
+def lane_queue(queue_name: str, priority: Optional[str]) -> str:
+    """Returns the queue of the given priority lane; the normal lane is the stage queue itself."""
+    if priority in (None, DEFAULT_PRIORITY) or not has_lanes(queue_name):
+        return queue_name
+    return f"{queue_name}.{priority}"
+
+
+def stage_lanes(queue_name: str) -> Dict[str, str]:
+    """Maps each priority lane of a stage to its queue."""
+    if not has_lanes(queue_name):
+        return {DEFAULT_PRIORITY: queue_name}
+    return {priority: lane_queue(queue_name, priority) for priority in PRIORITIES}
+
+
+class WeightedFairLimiter:
+    """Shares the handler slots of a stage between its priority lanes.
+
+    At most ``max_concurrency`` handlers run at once. When a slot frees up
+    and messages of several lanes are waiting, lanes are picked by smooth
+    weighted round robin: with weights {"alta": 4, "normal": 1} the normal
+    lane still gets one slot in five under a high-priority flood, and any
+    lane gets every slot while the others are idle.
+    """
+
+    def __init__(self, max_concurrency: int, weights: Dict[str, int], queue_name: str = ""):
+        self.weights = weights
+        self._free = max_concurrency
+        self._waiters = {lane: deque() for lane in weights}
+        self._current = {lane: 0 for lane in weights}
+        self._wait = {lane: LANE_WAIT.labels(queue_name, lane) for lane in weights}
+
+    def _next_lane(self) -> Optional[str]:
+        waiting = [lane for lane, waiters in self._waiters.items() if waiters]
+        if not waiting:
+            return None
+        for lane in waiting:
+            self._current[lane] += self.weights[lane]
+        chosen = max(waiting, key=self._current.__getitem__)
+        self._current[chosen] -= sum(self.weights[lane] for lane in waiting)
+        return chosen
+
+    async def acquire(self, lane: str):
+        if self._free > 0:
+            self._free -= 1
+            return
+        slot = asyncio.get_running_loop().create_future()
+        self._waiters[lane].append(slot)
+        try:
+            await slot
+        except asyncio.CancelledError:
+            if slot.done() and not slot.cancelled():
+                # The slot was handed over just before the cancellation
+                self.release()
+            else:
+                self._waiters[lane].remove(slot)
+            raise
+
+    def release(self):
+        while True:
+            lane = self._next_lane()
+            if lane is None:
+                self._free += 1
+                return
+            slot = self._waiters[lane].popleft()
+            if not slot.done():
+                slot.set_result(None)
+                return
+
+    def wrap(self, lane: str, handler):
+        wait = self._wait[lane]
+
+        async def limited_handler(message):
+            started = time.perf_counter()
+            await self.acquire(lane)
+            wait.observe(time.perf_counter() - started)
+            try:
+                await handler(message)
+            finally:
+                self.release()
+
+        return limited_handler
@@ -0,0 +1,31 @@
+import asyncio
+from typing import Optional
+from app.core import storage
+
+
+class TokenBucket:
+    """Rate limit shared by every worker process, kept in Redis.
+
+    Refills ``rate`` tokens per second up to ``capacity``. Requests larger
+    than the capacity are taken in capacity-sized parts.
+    """
+
+    def __init__(self, name: str, rate: float, capacity: Optional[int] = None):
+        if rate <= 0:
+            raise ValueError("The rate of a token bucket must be positive.")
+        self.name = name
+        self.rate = rate
+        self.capacity = capacity or max(1, int(rate))
+
+    async def acquire(self, tokens: int = 1) -> float:
+        """Waits until ``tokens`` tokens were taken; returns how long it waited, in seconds."""
+        waited = 0.0
+        while tokens > 0:
+            part = min(tokens, self.capacity)
+            wait = await storage.take_tokens(self.name, self.rate, self.capacity, part)
+            if wait <= 0:
+                tokens -= part
+                continue
+            await asyncio.sleep(wait)
+            waited += wait
+        return waited
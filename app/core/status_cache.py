@@ -0,0 +1,99 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+from app.core import metrics, storage
+from app.core.config import settings
+
+CACHE_REQUESTS = metrics.Counter("status_cache_requests_total", "Status cache lookups by result.", ("result",))
+_HITS = CACHE_REQUESTS.labels("hit")
+_MISSES = CACHE_REQUESTS.labels("miss")
+_COALESCED = CACHE_REQUESTS.labels("coalesced")
+_INVALIDATIONS = metrics.Counter("status_cache_invalidations_total", "Status cache entries dropped before their TTL by a status change.")
+
+
+class NotificationCache:
+    """Bounded LRU cache of notifications in front of ``storage.get_notification``.
+
+    Terminal statuses never change again and are kept for ``terminal_ttl``
+    seconds; in-flight ones only for ``inflight_ttl`` seconds, which bounds
+    how stale a cached status can be. Status change events only reach the
+    process for traceIds someone is streaming, so ``on_status_event`` drops
+    those entries early (as do the API's own writes through ``invalidate``),
+    but every other entry lives out its TTL. Concurrent misses for the same
+    traceId share a single storage lookup.
+    """
+
+    def __init__(self, max_entries: int, terminal_ttl: float, inflight_ttl: float):
+        self.max_entries = max_entries
+        self.terminal_ttl = terminal_ttl
+        self.inflight_ttl = inflight_ttl
+        self._entries = OrderedDict()  # traceId -> (expires_at, notification)
+        self._loading = {}  # traceId -> future of the running lookup
+
+    async def get(self, trace_id: str) -> Optional[Dict[str, any]]:
+        entry = self._entries.get(trace_id)
+        if entry is not None:
+            if entry[0] > time.monotonic():
+                self._entries.move_to_end(trace_id)
+                _HITS.inc()
+                return dict(entry[1])
+            del self._entries[trace_id]
+
+        loading = self._loading.get(trace_id)
+        if loading is not None:
+            _COALESCED.inc()
+            data = await asyncio.shield(loading)
+            return dict(data) if data is not None else None
+
+        _MISSES.inc()
+        loading = self._loading[trace_id] = asyncio.get_running_loop().create_future()
+        try:
+            data = await storage.get_notification(trace_id)
+        except Exception as e:
+            loading.set_exception(e)
+            # Waiters get the error; mark it retrieved so a lone lookup does not warn
+            loading.exception()
+            raise
+        else:
+            loading.set_result(data)
+            if data is not None and self._loading.get(trace_id) is loading:
+                self._store(trace_id, data)
+        finally:
+            if self._loading.get(trace_id) is loading:
+                del self._loading[trace_id]
+        return dict(data) if data is not None else None
+
+    def _store(self, trace_id: str, data: Dict[str, any]):
+        ttl = self.terminal_ttl if data.get(storage.STATUS_FIELD) in storage.TERMINAL_STATUSES else self.inflight_ttl
+        if ttl <= 0:
+            return
+        self._entries[trace_id] = (time.monotonic() + ttl, data)
+        self._entries.move_to_end(trace_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, trace_id: str):
+        # A lookup running now may have read the old status, so its result is not cached
+        self._loading.pop(trace_id, None)
+        if self._entries.pop(trace_id, None) is not None:
+            _INVALIDATIONS.inc()
+
+    def on_status_event(self, trace_id: str, version: int, status: str):
+        self.invalidate(trace_id)
+
+    def clear(self):
+        self._entries.clear()
+        self._loading.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+notification_cache = NotificationCache(
+    max_entries=settings.STATUS_CACHE_MAX_ENTRIES,
+    terminal_ttl=settings.STATUS_CACHE_TERMINAL_TTL,
+    inflight_ttl=settings.STATUS_CACHE_INFLIGHT_TTL,
+)
+
+metrics.GaugeCallback("status_cache_entries", "Notifications held by the status cache.", (), lambda: {(): len(notification_cache)})
@@ -1,29 +1,692 @@
-import redis
-from typing import Dict, Optional
 import json
+import time
+import redis.asyncio as redis
+from typing import Dict, Iterable, Optional, Tuple
+from app.core import metrics
+from app.core.codec import codec_for_content_type, get_codec
 from app.core.config import settings
+from app.core.write_behind import StatusWriteBuffer
 
-# Conexão com Redis usando configurações do ambiente
-r = redis.Redis(
-    host=settings.REDIS_HOST,
-    port=settings.REDIS_PORT,
-    db=settings.REDIS_DB
-)
+# Statuses that end the pipeline; late or redelivered stages must not overwrite them.
+# DLQ_RECEIVED is not one: a DLQ replay (app.dlq) sends the notification back in.
+TERMINAL_STATUSES = ("ENVIADO_SUCESSO",)
+
+# Records live under "<REDIS_KEY_PREFIX>n:<traceId>", apart from the other keys
+# kept under the prefix (mensagem:, conteudo:, ratelimit:, idx:, dlq:), so a
+# traceId can never name one of them
+RECORD_KEY_SEGMENT = "n:"
+
+# Each notification is a hash: the immutable payload is serialized once in the
+# "data" field and the status lives in its own field, so a transition is a
+# single server-side operation instead of GET + decode + encode + SET.
+DATA_FIELD = "data"
+STATUS_FIELD = "status"
+# Content type of the codec that encoded "data", so records survive a codec change
+CONTENT_TYPE_FIELD = "ct"
+
+# Every applied status change bumps the record's version and is published as
+# "<version> <status>" on the notification's own channel, so listeners only
+# receive the traceIds they subscribed to and can discard stale events
+VERSION_FIELD = "v"
+STATUS_CHANNEL_PREFIX = "notificacao:status:"
+
+# Records of finished notifications only keep what the status endpoint needs:
+# the message content has its own field so it can be dropped after dispatch
+CONTENT_FIELD = "c"
+CONTENT_KEY = "conteudoMensagem"
+
+# Secondary indexes, kept in step with every write so queries never SCAN:
+#   idx:status:<status>:<channel>  sorted set of the traceIds currently in a
+#                                  status, scored by when they entered it
+#   idx:pares                      set of the "<status>|<channel>" pairs in use
+#   idx:mensagem:<mensagemId>      sorted set of the traceIds of a mensagemId
+# A record expires TTL seconds after entering its status, so entries scored
+# before now - TTL point to expired records: reads skip them and writes prune them.
+CHANNEL_FIELD = "ch"
+INDEX_PAIR_SEPARATOR = "|"
+
+# The status script derives the index keys of the old and new status from the
+# record's status and channel itself, so a transition stays one round trip.
+# Those keys are not in KEYS: on Redis Cluster every key must then share a slot,
+# which a REDIS_KEY_PREFIX with a hash tag (e.g. "{notificacao}:") guarantees.
+# KEYS[1] = notification key; with indexes also KEYS[2] = set of the indexed pairs
+# ARGV[1] = status channel, ARGV[2] = TTL in seconds of the new status (0: no expiry),
+# ARGV[3] = "1" to drop the content field, ARGV[4] = index key prefix ("": no indexes),
+# ARGV[5] = traceId, ARGV[6] = new status, ARGV[7] = condition mode ("", "if" or "unless"),
+# ARGV[8..] = statuses
+SET_STATUS_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+local current = redis.call('HGET', KEYS[1], 'status')
+if ARGV[7] ~= '' then
+    local listed = false
+    for i = 8, #ARGV do
+        if ARGV[i] == current then
+            listed = true
+            break
+        end
+    end
+    if (ARGV[7] == 'if' and not listed) or (ARGV[7] == 'unless' and listed) then
+        return 0
+    end
+end
+redis.call('HSET', KEYS[1], 'status', ARGV[6])
+if ARGV[3] == '1' then
+    redis.call('HDEL', KEYS[1], '""" + CONTENT_FIELD + """')
+end
+local ttl = tonumber(ARGV[2])
+if ttl > 0 then
+    redis.call('EXPIRE', KEYS[1], ttl)
+else
+    redis.call('PERSIST', KEYS[1])
+end
+if ARGV[4] ~= '' then
+    local channel = redis.call('HGET', KEYS[1], '""" + CHANNEL_FIELD + """') or ''
+    if current then
+        redis.call('ZREM', ARGV[4] .. 'status:' .. current .. ':' .. channel, ARGV[5])
+    end
+    local time = redis.call('TIME')
+    local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+    local index = ARGV[4] .. 'status:' .. ARGV[6] .. ':' .. channel
+    redis.call('ZADD', index, now, ARGV[5])
+    if ttl > 0 then
+        redis.call('ZREMRANGEBYSCORE', index, '-inf', '(' .. (now - ttl))
+    end
+    redis.call('SADD', KEYS[2], ARGV[6] .. '""" + INDEX_PAIR_SEPARATOR + """' .. channel)
+end
+local version = redis.call('HINCRBY', KEYS[1], 'v', 1)
+redis.call('PUBLISH', ARGV[1], version .. ' ' .. ARGV[6])
+return 1
+"""
+
+# mensagemId -> traceId index: within the idempotency window a repeated
+# mensagemId gets the traceId of its first notification back
+# KEYS[1] = index key, ARGV[1] = new traceId, ARGV[2] = window in seconds
+CLAIM_MESSAGE_ID_SCRIPT = """
+local existing = redis.call('GET', KEYS[1])
+if existing then
+    return existing
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+return false
+"""
+
+# Stages that finished a delivery mark it in the notification's own hash, so
+# the marks expire with the record and cost no extra keys
+PROCESSED_FIELD_PREFIX = "p:"
+MARK_PROCESSED_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+redis.call('HSET', KEYS[1], ARGV[1], 1)
+return 1
+"""
+
+# Token bucket shared by every process, stored as "<tokens> <updated at>" and
+# refilled from the server clock, so workers on different hosts agree on it.
+# Returns the seconds to wait before the requested tokens are available
+# (0: they were taken now).
+# KEYS[1] = bucket key, ARGV[1] = rate (tokens/s), ARGV[2] = capacity, ARGV[3] = tokens
+TAKE_TOKENS_SCRIPT = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local rate, capacity, requested = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local tokens = capacity
+local state = redis.call('GET', KEYS[1])
+if state then
+    local sep = string.find(state, ' ')
+    local updated = tonumber(string.sub(state, sep + 1))
+    tokens = math.min(capacity, tonumber(string.sub(state, 1, sep - 1)) + math.max(0, now - updated) * rate)
+end
+local wait = 0
+if tokens >= requested then
+    tokens = tokens - requested
+else
+    wait = (requested - tokens) / rate
+end
+redis.call('SET', KEYS[1], tokens .. ' ' .. now, 'PX', math.ceil(capacity / rate * 1000) + 1000)
+return tostring(wait)
+"""
+
+_SET_NOTIFICATION_DURATION = metrics.REDIS_DURATION.labels("set_notification")
+_SET_NOTIFICATIONS_DURATION = metrics.REDIS_DURATION.labels("set_notifications")
+_GET_NOTIFICATION_DURATION = metrics.REDIS_DURATION.labels("get_notification")
+_SET_STATUS_DURATION = metrics.REDIS_DURATION.labels("set_status")
+_FLUSH_STATUS_DURATION = metrics.REDIS_DURATION.labels("flush_status_batch")
+
+_client: Optional[redis.Redis] = None
+_set_status_script = None
+_claim_message_id_script = None
+_mark_processed_script = None
+_take_tokens_script = None
+_write_buffer: Optional[StatusWriteBuffer] = None
+# Data of the in-memory backend outlives its clients, like a Redis server would
+_memory_server = None
+
+def _memory_client() -> redis.Redis:
+    global _memory_server
+    try:
+        import fakeredis
+    except ImportError as e:
+        raise ImportError("STORAGE_BACKEND=memory requires the 'memory' extra (fakeredis[lua]).") from e
+    if _memory_server is None:
+        _memory_server = fakeredis.FakeServer()
+    return fakeredis.FakeAsyncRedis(server=_memory_server)
+
+def _register_scripts(client: redis.Redis):
+    global _set_status_script, _claim_message_id_script, _mark_processed_script, _take_tokens_script
+    _set_status_script = client.register_script(SET_STATUS_SCRIPT)
+    _claim_message_id_script = client.register_script(CLAIM_MESSAGE_ID_SCRIPT)
+    _mark_processed_script = client.register_script(MARK_PROCESSED_SCRIPT)
+    _take_tokens_script = client.register_script(TAKE_TOKENS_SCRIPT)
+
+def get_client() -> redis.Redis:
+    """Returns the shared asyncio Redis client, creating its connection pool on first use."""
+    global _client
+    if _client is None and settings.STORAGE_BACKEND == "memory":
+        _client = _memory_client()
+        _register_scripts(_client)
+    elif _client is None:
+        # Blocking pool: callers wait for a free connection instead of failing when it is exhausted
+        pool = redis.BlockingConnectionPool(
+            host=settings.REDIS_HOST,
+            port=settings.REDIS_PORT,
+            db=settings.REDIS_DB,
+            max_connections=settings.REDIS_MAX_CONNECTIONS,
+            timeout=settings.REDIS_POOL_TIMEOUT,
+            socket_timeout=settings.REDIS_SOCKET_TIMEOUT,
+            socket_connect_timeout=settings.REDIS_SOCKET_CONNECT_TIMEOUT,
+        )
+        _client = redis.Redis.from_pool(pool)
+        _register_scripts(_client)
+    return _client
+
+async def close():
+    global _client, _set_status_script, _claim_message_id_script, _mark_processed_script, _take_tokens_script
+    await stop_write_behind()
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+        _set_status_script = _claim_message_id_script = _mark_processed_script = _take_tokens_script = None
+
+def _key(trace_id: str) -> str:
+    return f"{settings.REDIS_KEY_PREFIX}{RECORD_KEY_SEGMENT}{trace_id}"
+
+def _ttl_for(status: str) -> int:
+    if status in TERMINAL_STATUSES:
+        return settings.NOTIFICATION_TERMINAL_TTL_SECONDS
+    return settings.NOTIFICATION_INFLIGHT_TTL_SECONDS
+
+def _status_index_key(status: str, channel: str) -> str:
+    return f"{settings.REDIS_KEY_PREFIX}idx:status:{status}:{channel}"
+
+def _message_index_key(mensagem_id: str) -> str:
+    return f"{settings.REDIS_KEY_PREFIX}idx:mensagem:{mensagem_id}"
+
+def _pairs_key() -> str:
+    return f"{settings.REDIS_KEY_PREFIX}idx:pares"
+
+def _notification_fields(data: Dict[str, any]) -> Dict[str, any]:
+    codec = get_codec()
+    payload = {k: v for k, v in data.items() if k not in (STATUS_FIELD, CONTENT_KEY)}
+    fields = {
+        DATA_FIELD: codec.encode(payload),
+        STATUS_FIELD: data.get(STATUS_FIELD, ""),
+        CONTENT_TYPE_FIELD: codec.content_type,
+        # Kept apart from "data" so the status script can maintain the per-channel indexes
+        CHANNEL_FIELD: data.get("channel") or "",
+    }
+    if data.get(CONTENT_KEY) is not None:
+        fields[CONTENT_FIELD] = data[CONTENT_KEY]
+    return fields
+
+def _write_notification(client, trace_id: str, data: Dict[str, any]):
+    key = _key(trace_id)
+    client.hset(key, mapping=_notification_fields(data))
+    status = data.get(STATUS_FIELD, "")
+    ttl = _ttl_for(status)
+    if ttl > 0:
+        client.expire(key, ttl)
+    if settings.STORAGE_INDEXES_ENABLED:
+        channel = data.get("channel") or ""
+        received_at = data.get("recebidoEm") or time.time()
+        client.zadd(_status_index_key(status, channel), {trace_id: received_at})
+        client.sadd(_pairs_key(), f"{status}{INDEX_PAIR_SEPARATOR}{channel}")
+        if data.get("mensagemId"):
+            message_index = _message_index_key(data["mensagemId"])
+            client.zadd(message_index, {trace_id: received_at})
+            # Outlives every record it lists: each new notification of the mensagemId renews it
+            if settings.NOTIFICATION_INFLIGHT_TTL_SECONDS > 0:
+                client.expire(message_index, settings.NOTIFICATION_INFLIGHT_TTL_SECONDS)
+
+async def set_notification(trace_id: str, data: Dict[str, any]):
+    started = time.perf_counter()
+    async with get_client().pipeline(transaction=False) as pipe:
+        _write_notification(pipe, trace_id, data)
+        await pipe.execute()
+    _SET_NOTIFICATION_DURATION.observe(time.perf_counter() - started)
+
+async def set_notifications(notifications: Dict[str, Dict[str, any]]):
+    """Stores many notifications, keyed by traceId, in a single pipelined round trip."""
+    async with get_client().pipeline(transaction=False) as pipe:
+        for trace_id, data in notifications.items():
+            _write_notification(pipe, trace_id, data)
+        started = time.perf_counter()
+        await pipe.execute()
+        _SET_NOTIFICATIONS_DURATION.observe(time.perf_counter() - started)
+
+async def get_notification(trace_id: str) -> Optional[Dict[str, any]]:
+    started = time.perf_counter()
+    stored = await get_client().hgetall(_key(trace_id))
+    _GET_NOTIFICATION_DURATION.observe(time.perf_counter() - started)
+    if not stored:
+        return None
+    content_type = stored.get(CONTENT_TYPE_FIELD.encode())
+    codec = codec_for_content_type(content_type.decode() if content_type else None)
+    data = codec.decode(stored[DATA_FIELD.encode()])
+    data[STATUS_FIELD] = stored[STATUS_FIELD.encode()].decode()
+    # Records written before the content had its own field keep it inside "data"
+    content = stored.get(CONTENT_FIELD.encode())
+    if content is not None:
+        data[CONTENT_KEY] = content.decode()
+    else:
+        data.setdefault(CONTENT_KEY, None)
+    return data
+
+async def get_status(trace_id: str) -> Optional[Tuple[str, int]]:
+    """Returns (status, version) of a notification without reading its payload."""
+    status, version = await get_client().hmget(_key(trace_id), [STATUS_FIELD, VERSION_FIELD])
+    if status is None:
+        return None
+    return status.decode(), int(version or 0)
+
+def parse_status_event(payload: bytes) -> Tuple[int, str]:
+    """Parses a status change published on a notification channel into (version, status)."""
+    version, _, status = payload.decode().partition(" ")
+    return int(version), status
+
+async def clear_storage():
+    """Deletes every notification record, leaving other keys of the DB alone."""
+    client = get_client()
+    batch = []
+    async for key in client.scan_iter(match=f"{settings.REDIS_KEY_PREFIX}*", count=1000):
+        batch.append(key)
+        if len(batch) >= 1000:
+            await client.unlink(*batch)
+            batch = []
+    if batch:
+        await client.unlink(*batch)
+
+async def record_sizes(sample: int = 1000) -> Dict[str, Dict[str, any]]:
+    """Measures up to ``sample`` notification records, grouped into "terminal" and "in_flight".
+
+    For each group returns the number of records sampled and their average
+    size in bytes: ``payload_bytes`` sums the key, field names and values,
+    ``memory_bytes`` is what Redis reports with MEMORY USAGE (None when the
+    server does not support it) and includes the per-key overhead.
+    """
+    client = get_client()
+    keys = []
+    async for key in client.scan_iter(match=_key("*"), count=1000, _type="hash"):
+        keys.append(key)
+        if len(keys) >= sample:
+            break
+    async with client.pipeline(transaction=False) as pipe:
+        for key in keys:
+            pipe.hgetall(key)
+        records = await pipe.execute()
+    try:
+        async with client.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.memory_usage(key, samples=0)
+            memory = await pipe.execute()
+    except redis.ResponseError:
+        memory = [None] * len(keys)
+
+    groups = {}
+    for key, stored, used in zip(keys, records, memory):
+        if not stored:
+            continue  # expired or deleted since the scan
+        status = stored.get(STATUS_FIELD.encode(), b"").decode()
+        group = groups.setdefault("terminal" if status in TERMINAL_STATUSES else "in_flight", {"records": 0, "payload": 0, "memory": 0, "measured": 0})
+        group["records"] += 1
+        group["payload"] += len(key) + sum(len(field) + len(value) for field, value in stored.items())
+        if used is not None:
+            group["memory"] += used
+            group["measured"] += 1
+    return {
+        name: {
+            "records": group["records"],
+            "payload_bytes": group["payload"] / group["records"],
+            "memory_bytes": group["memory"] / group["measured"] if group["measured"] else None,
+        }
+        for name, group in groups.items()
+    }
+
+def _content_key(content_id: str) -> str:
+    return f"{settings.REDIS_KEY_PREFIX}conteudo:{content_id}"
+
+async def store_contents(contents: Dict[str, bytes]) -> int:
+    """Stores content blobs keyed by id unless already stored; returns how many were new.
+
+    Blobs already in the store only get their TTL (CLAIM_CHECK_TTL_SECONDS)
+    renewed, so a body shared by many notifications is sent to Redis once.
+    """
+    ttl = settings.CLAIM_CHECK_TTL_SECONDS
+    client = get_client()
+    async with client.pipeline(transaction=False) as pipe:
+        for content_id in contents:
+            if ttl > 0:
+                pipe.expire(_content_key(content_id), ttl)
+            else:
+                pipe.exists(_content_key(content_id))
+        stored = await pipe.execute()
+    missing = [content_id for content_id, found in zip(contents, stored) if not found]
+    if missing:
+        async with client.pipeline(transaction=False) as pipe:
+            for content_id in missing:
+                pipe.set(_content_key(content_id), contents[content_id], ex=ttl if ttl > 0 else None, nx=True)
+            await pipe.execute()
+    return len(missing)
 
-def set_notification(trace_id: str, data: Dict[str, any]):
-    r.set(trace_id, json.dumps(data))
+async def get_content(content_id: str) -> Optional[bytes]:
+    return await get_client().get(_content_key(content_id))
 
-def get_notification(trace_id: str) -> Optional[Dict[str, any]]:
-    stored = r.get(trace_id)
-    if stored:
-        return json.loads(stored)
-    return None
+def _message_id_key(mensagem_id: str) -> str:
+    return f"{settings.REDIS_KEY_PREFIX}mensagem:{mensagem_id}"
 
-def clear_storage():
-    r.flushdb()
+async def claim_message_ids(claims: Iterable[Tuple[str, str]]) -> list:
+    """Indexes (mensagemId, traceId) pairs in one pipelined round trip.
 
-def set_status(trace_id: str, status: str):
-    data = get_notification(trace_id)
-    if data:
-        data['status'] = status
-        set_notification(trace_id, data)
+    Returns, for each pair, the traceId already indexed for that mensagemId
+    within ``IDEMPOTENCY_TTL_SECONDS`` (the pair was not indexed), or None if
+    the pair was claimed now. Later pairs see the earlier ones, so a mensagemId
+    repeated in the same call resolves to its first traceId. A window of 0
+    disables the index.
+    """
+    claims = list(claims)
+    if settings.IDEMPOTENCY_TTL_SECONDS <= 0:
+        return [None] * len(claims)
+    get_client()
+    async with _client.pipeline(transaction=False) as pipe:
+        for mensagem_id, trace_id in claims:
+            await _claim_message_id_script(
+                keys=[_message_id_key(mensagem_id)], args=[trace_id, settings.IDEMPOTENCY_TTL_SECONDS], client=pipe
+            )
+        existing = await pipe.execute()
+    return [trace_id.decode() if trace_id is not None else None for trace_id in existing]
+
+async def claim_message_id(mensagem_id: str, trace_id: str) -> Optional[str]:
+    return (await claim_message_ids([(mensagem_id, trace_id)]))[0]
+
+async def release_message_id(mensagem_id: str, trace_id: str):
+    """Drops the index entry of a notification that was not accepted, so the client can retry it."""
+    key = _message_id_key(mensagem_id)
+    client = get_client()
+    if await client.get(key) == trace_id.encode():
+        await client.delete(key)
+
+async def is_processed(trace_id: str, step: str) -> bool:
+    return bool(await get_client().hexists(_key(trace_id), f"{PROCESSED_FIELD_PREFIX}{step}"))
+
+async def mark_processed(trace_id: str, step: str) -> bool:
+    """Records that ``step`` finished for the notification; False if its record does not exist."""
+    get_client()
+    return bool(await _mark_processed_script(keys=[_key(trace_id)], args=[f"{PROCESSED_FIELD_PREFIX}{step}"]))
+
+async def take_tokens(bucket: str, rate: float, capacity: int, tokens: int) -> float:
+    """Takes ``tokens`` from a shared token bucket; returns the seconds to wait if they are not available yet."""
+    get_client()
+    wait = await _take_tokens_script(keys=[f"{settings.REDIS_KEY_PREFIX}ratelimit:{bucket}"], args=[rate, capacity, tokens])
+    return float(wait)
+
+def _min_score(status: str, since: Optional[float] = None):
+    # Entries older than the status TTL belong to expired records
+    ttl = _ttl_for(status)
+    oldest = time.time() - ttl if ttl > 0 else None
+    bounds = [bound for bound in (oldest, since) if bound is not None]
+    return max(bounds) if bounds else "-inf"
+
+async def _index_page(key: str, min_score, limit: int, cursor: Optional[Tuple[float, str]], max_score="+inf") -> list:
+    """Returns up to ``limit`` (traceId, score) entries of an index, newest first, after ``cursor``."""
+    client = get_client()
+    if cursor is not None:
+        max_score = cursor[0]
+    page, offset = [], 0
+    while len(page) < limit:
+        batch = await client.zrevrangebyscore(key, max_score, min_score, start=offset, num=limit, withscores=True)
+        for member, score in batch:
+            trace_id = member.decode()
+            # Entries sharing the cursor's score come in reverse traceId order; skip those already returned
+            if cursor is not None and score == cursor[0] and trace_id >= cursor[1]:
+                continue
+            page.append((trace_id, score))
+        if len(batch) < limit:
+            break
+        offset += limit
+    return page[:limit]
+
+def parse_cursor(cursor: Optional[str]) -> Optional[Tuple[float, str]]:
+    """Parses a cursor returned by the list functions; raises ValueError if it is malformed."""
+    if not cursor:
+        return None
+    score, sep, trace_id = cursor.partition(":")
+    if not sep or not trace_id:
+        raise ValueError(f"Invalid cursor '{cursor}'")
+    return float(score), trace_id
+
+def format_cursor(trace_id: str, score: float) -> str:
+    """Returns the cursor continuing a listing after the entry ``(trace_id, score)``."""
+    return f"{score!r}:{trace_id}"
+
+def _next_cursor(page: list, limit: int) -> Optional[str]:
+    if len(page) < limit:
+        return None
+    trace_id, score = page[-1][:2]
+    return format_cursor(trace_id, score)
+
+async def _index_pairs() -> list:
+    pairs = await get_client().smembers(_pairs_key())
+    return [tuple(pair.decode().split(INDEX_PAIR_SEPARATOR, 1)) for pair in pairs]
+
+async def list_by_status(
+    status: str,
+    channel: Optional[str] = None,
+    since: Optional[float] = None,
+    limit: int = 50,
+    cursor: Optional[str] = None,
+) -> Tuple[list, Optional[str]]:
+    """Lists the notifications currently in ``status``, most recent transition first.
+
+    Returns ``([(traceId, channel, entered_at), ...], next_cursor)``; each call
+    reads at most ``limit`` entries per channel index, whatever the total.
+    """
+    position = parse_cursor(cursor)
+    channels = [channel] if channel is not None else sorted(c for s, c in await _index_pairs() if s == status)
+    min_score = _min_score(status, since)
+    entries = []
+    for indexed_channel in channels:
+        page = await _index_page(_status_index_key(status, indexed_channel), min_score, limit, position)
+        entries.extend((trace_id, indexed_channel, score) for trace_id, score in page)
+    entries.sort(key=lambda entry: (entry[2], entry[0]), reverse=True)
+    entries = entries[:limit]
+    return entries, _next_cursor([(trace_id, score) for trace_id, _, score in entries], limit)
+
+async def list_by_message_id(mensagem_id: str, limit: int = 50, cursor: Optional[str] = None) -> Tuple[list, Optional[str]]:
+    """Lists the notifications of a mensagemId, newest first: ``([(traceId, received_at), ...], next_cursor)``."""
+    page = await _index_page(_message_index_key(mensagem_id), "-inf", limit, parse_cursor(cursor))
+    return page, _next_cursor(page, limit)
+
+async def get_statuses(trace_ids: list) -> list:
+    """Returns (status, channel) of each notification, or None for the ones that expired, in one round trip."""
+    async with get_client().pipeline(transaction=False) as pipe:
+        for trace_id in trace_ids:
+            pipe.hmget(_key(trace_id), [STATUS_FIELD, CHANNEL_FIELD])
+        stored = await pipe.execute()
+    return [(status.decode(), (channel or b"").decode()) if status is not None else None for status, channel in stored]
+
+async def status_counts() -> Dict[str, Dict[str, int]]:
+    """Counts the notifications per status and channel from the indexes, without touching the records."""
+    pairs = await _index_pairs()
+    async with get_client().pipeline(transaction=False) as pipe:
+        for status, channel in pairs:
+            pipe.zcount(_status_index_key(status, channel), _min_score(status), "+inf")
+        counts = await pipe.execute()
+    result = {}
+    for (status, channel), count in zip(pairs, counts):
+        if count:
+            result.setdefault(status, {})[channel] = count
+    return result
+
+def _dead_letter_key(trace_id: str) -> str:
+    return f"{settings.REDIS_KEY_PREFIX}dlq:{trace_id}"
+
+def _dead_letter_index_key() -> str:
+    return f"{settings.REDIS_KEY_PREFIX}idx:dlq"
+
+async def store_dead_letter(trace_id: str, entry: Dict[str, any], content_ids: Iterable[str] = ()):
+    """Keeps a dead message for DLQ_RETENTION_SECONDS, indexed by ``entry["registradoEm"]``.
+
+    Stored as a JSON string under its own "dlq:" keys. The claim-checked
+    contents the message refers to (``content_ids``) are kept at least as
+    long, so a replay can still check them out.
+    """
+    retention = settings.DLQ_RETENTION_SECONDS
+    index = _dead_letter_index_key()
+    async with get_client().pipeline(transaction=False) as pipe:
+        pipe.set(_dead_letter_key(trace_id), json.dumps(entry), ex=retention if retention > 0 else None)
+        pipe.zadd(index, {trace_id: entry["registradoEm"]})
+        for content_id in content_ids:
+            if retention > 0:
+                # GT never shortens a longer TTL, nor adds one to a content kept forever
+                pipe.expire(_content_key(content_id), retention, gt=True)
+            else:
+                pipe.persist(_content_key(content_id))
+        if retention > 0:
+            pipe.zremrangebyscore(index, "-inf", f"({time.time() - retention}")
+        await pipe.execute()
+
+async def get_dead_letters(trace_ids: list) -> list:
+    async with get_client().pipeline(transaction=False) as pipe:
+        for trace_id in trace_ids:
+            pipe.get(_dead_letter_key(trace_id))
+        stored = await pipe.execute()
+    return [json.loads(entry) if entry is not None else None for entry in stored]
+
+async def list_dead_letters(
+    since: Optional[float] = None,
+    until: Optional[float] = None,
+    limit: int = 50,
+    cursor: Optional[str] = None,
+) -> Tuple[list, Optional[str]]:
+    """Lists dead messages by the time they reached the DLQ, newest first: ``([(traceId, dead_at), ...], next_cursor)``."""
+    retention = settings.DLQ_RETENTION_SECONDS
+    bounds = [bound for bound in (since, time.time() - retention if retention > 0 else None) if bound is not None]
+    page = await _index_page(
+        _dead_letter_index_key(),
+        max(bounds) if bounds else "-inf",
+        limit,
+        parse_cursor(cursor),
+        max_score=until if until is not None else "+inf",
+    )
+    return page, _next_cursor(page, limit)
+
+async def delete_dead_letters(trace_ids: list):
+    if not trace_ids:
+        return
+    async with get_client().pipeline(transaction=False) as pipe:
+        pipe.delete(*[_dead_letter_key(trace_id) for trace_id in trace_ids])
+        pipe.zrem(_dead_letter_index_key(), *trace_ids)
+        await pipe.execute()
+
+def status_channel(trace_id: str) -> str:
+    return f"{STATUS_CHANNEL_PREFIX}{trace_id}"
+
+def _status_script_args(status: str, expected: Optional[Iterable[str]], unless: Optional[Iterable[str]]) -> list:
+    if expected is not None and unless is not None:
+        raise ValueError("Use either 'expected' or 'unless', not both.")
+    if expected is not None:
+        return [status, "if", *expected]
+    if unless is not None:
+        return [status, "unless", *unless]
+    return [status, ""]
+
+def _status_script_call(trace_id: str, args: list) -> dict:
+    """Prepends the channel, retention, content handling and indexing of the new status to the script args."""
+    status = args[0]
+    drop_content = settings.STORAGE_DROP_CONTENT_AFTER_DISPATCH and status == "ENVIADO_SUCESSO"
+    keys, index_prefix = [_key(trace_id)], ""
+    if settings.STORAGE_INDEXES_ENABLED:
+        keys.append(_pairs_key())
+        index_prefix = f"{settings.REDIS_KEY_PREFIX}idx:"
+    return {
+        "keys": keys,
+        "args": [status_channel(trace_id), _ttl_for(status), "1" if drop_content else "0", index_prefix, trace_id, *args],
+    }
+
+async def set_status(
+    trace_id: str,
+    status: str,
+    *,
+    expected: Optional[Iterable[str]] = None,
+    unless: Optional[Iterable[str]] = None,
+) -> bool:
+    """Atomically updates the status of an existing notification in one round trip.
+
+    With ``expected`` the update only applies if the current status is one of
+    them (compare-and-set); with ``unless`` it is skipped if the current status
+    is one of them. Returns whether the status was written.
+
+    When write-behind is enabled the update is only buffered; ``True`` then
+    means it was accepted and the conditions are evaluated by Redis on flush.
+    """
+    args = _status_script_args(status, expected, unless)
+    if _write_buffer is not None:
+        return await _write_buffer.put(trace_id, args)
+    get_client()
+    started = time.perf_counter()
+    applied = await _set_status_script(**_status_script_call(trace_id, args))
+    _SET_STATUS_DURATION.observe(time.perf_counter() - started)
+    return bool(applied)
+
+async def _flush_status_batch(batch):
+    client = get_client()
+    async with client.pipeline(transaction=False) as pipe:
+        for trace_id, args in batch:
+            await _set_status_script(**_status_script_call(trace_id, args), client=pipe)
+        started = time.perf_counter()
+        await pipe.execute()
+        _FLUSH_STATUS_DURATION.observe(time.perf_counter() - started)
+
+def start_write_behind() -> StatusWriteBuffer:
+    """Enables write-behind batching of set_status calls for the running event loop."""
+    global _write_buffer
+    if _write_buffer is None:
+        _write_buffer = StatusWriteBuffer(
+            _flush_status_batch,
+            max_batch_size=settings.STATUS_WRITE_BEHIND_BATCH_SIZE,
+            flush_interval=settings.STATUS_WRITE_BEHIND_FLUSH_INTERVAL,
+            max_pending=settings.STATUS_WRITE_BEHIND_MAX_PENDING,
+        )
+        _write_buffer.start()
+    return _write_buffer
+
+async def stop_write_behind():
+    """Flushes every buffered status write and disables write-behind."""
+    global _write_buffer
+    if _write_buffer is not None:
+        buffer, _write_buffer = _write_buffer, None
+        await buffer.close()
+
+def write_behind_stats() -> Optional[Dict[str, any]]:
+    if _write_buffer is None:
+        return None
+    return {**_write_buffer.stats, "pending": _write_buffer.pending}
+
+metrics.GaugeCallback(
+    "status_write_behind",
+    "Write-behind buffer statistics of status updates.",
+    ("stat",),
+    lambda: {(name,): value for name, value in (write_behind_stats() or {}).items()},
+)
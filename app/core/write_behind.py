@@ -0,0 +1,163 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+Batch = List[Tuple[str, list]]
+
+
+def _condition_holds(args: list, current_status: str) -> bool:
+    mode, statuses = args[1], args[2:]
+    if mode == "if":
+        return current_status in statuses
+    if mode == "unless":
+        return current_status not in statuses
+    return True
+
+
+class StatusWriteBuffer:
+    """Coalesces status writes per traceId and flushes them in batches.
+
+    Writes are flushed when ``max_batch_size`` traceIds are pending or every
+    ``flush_interval`` seconds, whichever comes first. At most ``max_pending``
+    traceIds are buffered; further writers wait for the next flush (backpressure).
+    A batch that fails to flush is put back ahead of newer writes for the next
+    flush, as far as ``max_pending`` allows; writes that do not fit, or that are
+    still pending when the buffer is closed, are dropped, logged and counted
+    in ``stats["dropped_writes"]``.
+    """
+
+    def __init__(
+        self,
+        flush_batch: Callable[[Batch], Awaitable[None]],
+        max_batch_size: int,
+        flush_interval: float,
+        max_pending: int,
+    ):
+        self._flush_batch = flush_batch
+        self.max_batch_size = max_batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._pending: dict = {}
+        self._not_full = asyncio.Condition()
+        self._flush_needed = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task: asyncio.Task = None
+        self._closing = False
+        self.stats = {
+            "writes": 0,
+            "coalesced": 0,
+            "flushes": 0,
+            "flushed_writes": 0,
+            "flush_errors": 0,
+            "dropped_writes": 0,
+            "last_batch_size": 0,
+            "max_batch_size": 0,
+            "last_flush_seconds": 0.0,
+            "max_flush_seconds": 0.0,
+            "total_flush_seconds": 0.0,
+        }
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def put(self, trace_id: str, args: list) -> bool:
+        """Buffers ``[status, mode, *statuses]`` set_status script args for a traceId.
+
+        A write coalesced over a pending one has its condition checked against
+        the pending status and is dropped (returning False) if it would not apply.
+        """
+        async with self._not_full:
+            while trace_id not in self._pending and len(self._pending) >= self.max_pending:
+                self._flush_needed.set()
+                await self._not_full.wait()
+            self.stats["writes"] += 1
+            pending = self._pending.get(trace_id)
+            if pending is not None:
+                # Only the latest status per traceId needs to reach Redis
+                self.stats["coalesced"] += 1
+                if not _condition_holds(args, pending[0]):
+                    return False
+                # The pending write's condition still guards the merged write
+                args = [args[0], *pending[1:]]
+            self._pending[trace_id] = args
+            if len(self._pending) >= self.max_batch_size:
+                self._flush_needed.set()
+            return True
+
+    async def _run(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._flush_needed.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_needed.clear()
+            await self.flush()
+
+    async def _take_batch(self) -> Batch:
+        async with self._not_full:
+            batch = []
+            for trace_id in list(self._pending)[:self.max_batch_size]:
+                batch.append((trace_id, self._pending.pop(trace_id)))
+            self._not_full.notify_all()
+            return batch
+
+    async def flush(self):
+        async with self._flush_lock:
+            while self._pending:
+                batch = await self._take_batch()
+                started = time.perf_counter()
+                try:
+                    await self._flush_batch(batch)
+                except Exception as e:
+                    self.stats["flush_errors"] += 1
+                    logger.error(f"Failed to flush {len(batch)} buffered status writes: {e}", exc_info=True)
+                    await self._requeue(batch)
+                    return
+                elapsed = time.perf_counter() - started
+                self.stats["flushes"] += 1
+                self.stats["flushed_writes"] += len(batch)
+                self.stats["last_batch_size"] = len(batch)
+                self.stats["max_batch_size"] = max(self.stats["max_batch_size"], len(batch))
+                self.stats["last_flush_seconds"] = elapsed
+                self.stats["max_flush_seconds"] = max(self.stats["max_flush_seconds"], elapsed)
+                self.stats["total_flush_seconds"] += elapsed
+
+    async def _requeue(self, batch: Batch):
+        """Puts back the writes of a failed batch that were not superseded meanwhile, within ``max_pending``."""
+        async with self._not_full:
+            unsuperseded = [(trace_id, args) for trace_id, args in batch if trace_id not in self._pending]
+            retried = dict(unsuperseded[:max(self.max_pending - len(self._pending), 0)])
+            dropped = len(unsuperseded) - len(retried)
+            # The retried writes are older than the pending ones, so they are flushed first
+            self._pending = {**retried, **self._pending}
+        if dropped:
+            self._drop(dropped, "the buffer is full")
+
+    def _drop(self, count: int, reason: str):
+        self.stats["dropped_writes"] += count
+        logger.error(f"Dropped {count} buffered status writes because {reason}; those status changes are lost.")
+
+    async def close(self):
+        """Stops the background flusher and forces a final flush.
+
+        Writes that still cannot be flushed are dropped and logged.
+        """
+        self._closing = True
+        if self._task is not None:
+            # Wake the flusher instead of cancelling it so an in-progress batch is not lost
+            self._flush_needed.set()
+            await self._task
+            self._task = None
+        await self.flush()
+        if self._pending:
+            count = len(self._pending)
+            self._pending.clear()
+            self._drop(count, "they could not be flushed on close")
@@ -0,0 +1,92 @@
+"""Inspection and replay of the dead messages kept from the DLQ.
+
+Lists the dead messages matching the filters, or publishes them back to a
+stage at a controlled rate once the cause of their failure is fixed::
+
+    python -m app.dlq list --channel email --error timeout --since 1700000000
+    python -m app.dlq replay --channel email --error timeout --target entrada --rate 20
+"""
+import argparse
+import asyncio
+import json
+from app.core import storage
+from app.core.config import settings
+from app.services.dead_letters import REPLAY_TARGETS, find_dead_letters, replay_dead_letters
+from app.services.rabbitmq import RabbitMQService
+
+
+def _filters(args) -> dict:
+    return {"status": args.status, "channel": args.channel, "since": args.since, "until": args.until, "error": args.error}
+
+
+async def list_command(args) -> dict:
+    try:
+        entries, cursor = await find_dead_letters(limit=args.limit, cursor=args.cursor, **_filters(args))
+    finally:
+        await storage.close()
+    return {"items": entries, "cursor": cursor}
+
+
+async def replay_command(args) -> dict:
+    rabbitmq_service = RabbitMQService()
+    await rabbitmq_service.connect()
+    try:
+        return await replay_dead_letters(
+            rabbitmq_service,
+            target=args.target,
+            rate=args.rate,
+            batch_size=args.batch_size,
+            limit=args.limit,
+            **_filters(args),
+        )
+    finally:
+        await rabbitmq_service.close()
+        await storage.close()
+
+
+def format_entries(result: dict) -> str:
+    if not result["items"]:
+        return "No dead messages found."
+    lines = [f"{'traceId':<38}{'channel':<10}{'attempts':>9}  {'status':<28}reason"]
+    for entry in result["items"]:
+        lines.append(
+            f"{entry['traceId']:<38}{entry['tipoNotificacao'] or '':<10}{entry['tentativas']:>9}  {entry['status'] or '':<28}{entry['motivo']}"
+        )
+    if result["cursor"]:
+        lines.append(f"More with --cursor {result['cursor']}")
+    return "\n".join(lines)
+
+
+def format_summary(summary: dict) -> str:
+    return (
+        f"Replayed {summary['reprocessadas']} dead messages to '{summary['destino']}' "
+        f"({summary['falhas']} failed to publish, {summary['aguardandoSegundos']:.1f}s waiting for the rate limit)"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect and replay the dead messages kept from the DLQ.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    for name, help_text in (("list", "List dead messages."), ("replay", "Publish dead messages back to a stage.")):
+        command = commands.add_parser(name, help=help_text)
+        command.add_argument("--status", help="Status of the last failure, e.g. FALHA_ENVIO_FINAL.")
+        command.add_argument("--channel", help="tipoNotificacao of the messages.")
+        command.add_argument("--since", type=float, help="Only messages that reached the DLQ since this epoch time.")
+        command.add_argument("--until", type=float, help="Only messages that reached the DLQ until this epoch time.")
+        command.add_argument("--error", help="Substring of a failure reason, case-insensitive.")
+        command.add_argument("--json", action="store_true", help="Print the result as JSON.")
+    commands.choices["list"].add_argument("--limit", type=int, default=50, help="Messages per page.")
+    commands.choices["list"].add_argument("--cursor", help="Cursor returned by the previous page.")
+    replay = commands.choices["replay"]
+    replay.add_argument("--target", choices=list(REPLAY_TARGETS), default="entrada", help="Stage to publish the messages to.")
+    replay.add_argument("--rate", type=float, default=settings.DLQ_REPLAY_RATE, help="Messages published per second.")
+    replay.add_argument("--batch-size", type=int, default=settings.DLQ_REPLAY_BATCH_SIZE, help="Messages published per batch.")
+    replay.add_argument("--limit", type=int, default=1000, help="Most messages to replay.")
+    args = parser.parse_args()
+
+    if args.command == "list":
+        result = asyncio.run(list_command(args))
+        print(json.dumps(result, indent=2) if args.json else format_entries(result))
+    else:
+        result = asyncio.run(replay_command(args))
+        print(json.dumps(result, indent=2) if args.json else format_summary(result))
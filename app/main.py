@@ -1,44 +1,71 @@
-from fastapi import FastAPI
-from app.api.endpoints import messages
+import logging
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Response
+from app.api.endpoints import dlq, messages
+from app.core import metrics, storage
 from app.core.config import settings
+from app.core.log import configure_logging, stop_logging
 from app.services.rabbitmq import RabbitMQService
-from aio_pika import ExchangeType
-app = FastAPI(
-    title="RabbitMQ FastAPI Project",
-    description="API for managing RabbitMQ messages with FastAPI and aio-pika",
-    version="0.0.1",
-)
+from app.services.dispatcher import channel_queue
+from app.services.retry import declare_retry_topology
+from app.services.topology import declare_stage
 
-rabbitmq_service: RabbitMQService = None
+logger = logging.getLogger(__name__)
 
 ALL_QUEUES = [
     settings.NOTIFICATION_INPUT_QUEUE,
     settings.NOTIFICATION_RETRY_QUEUE,
     settings.NOTIFICATION_VALIDATION_QUEUE,
     settings.NOTIFICATION_DLQ,
+    *(channel_queue(channel) for channel in settings.ALLOWED_NOTIFICATION_TYPES),
 ]
 
-@app.on_event("startup")
-async def startup_event():
-    global rabbitmq_service
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    configure_logging()
+    # A single long-lived publisher is shared by every request
     rabbitmq_service = RabbitMQService()
     await rabbitmq_service.connect()
 
+    # Priority lanes and shards included, so nothing published before the workers start is dropped
     for queue_name in ALL_QUEUES:
-        exchange_name = f"{queue_name}_exchange"
-        await rabbitmq_service.declare_exchange(exchange_name, ExchangeType.DIRECT, durable=True)
-        await rabbitmq_service.declare_queue(queue_name, durable=True)
-        await rabbitmq_service.bind_queue(queue_name, exchange_name, routing_key=queue_name)
-    print("RabbitMQ topology declared by FastAPI app.")
-
-@app.on_event("shutdown")
-async def shutdown_event():
-    if rabbitmq_service:
+        await declare_stage(rabbitmq_service, queue_name)
+    await declare_retry_topology(rabbitmq_service)
+    logger.info("RabbitMQ topology declared by FastAPI app.")
+
+    app.state.rabbitmq_service = rabbitmq_service
+    try:
+        yield
+    finally:
         await rabbitmq_service.close()
-        print("RabbitMQ connection closed.")
+        logger.info("RabbitMQ connection closed.")
+        status_events = getattr(app.state, "status_events", None)
+        if status_events:
+            await status_events.close()
+        await storage.close()
+        stop_logging()
+
+app = FastAPI(
+    title="RabbitMQ FastAPI Project",
+    description="API for managing RabbitMQ messages with FastAPI and aio-pika",
+    version="0.0.1",
+    lifespan=lifespan,
+)
 
 @app.get("/health", tags=["Health Check"])
 async def health_check():
     return {"status": "ok"}
 
+@app.get("/health/rabbitmq", tags=["Health Check"])
+async def rabbitmq_health_check():
+    rabbitmq_service = getattr(app.state, "rabbitmq_service", None)
+    if rabbitmq_service is None:
+        return {"connected": False, "channel_pool": None}
+    return rabbitmq_service.health()
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics_endpoint():
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
 app.include_router(messages.router, prefix="/api", tags=["Messages"])
+app.include_router(dlq.router, prefix="/api", tags=["DLQ"])
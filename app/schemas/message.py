@@ -1,11 +1,13 @@
 from pydantic import BaseModel, Field
 from uuid import UUID, uuid4
-from typing import Optional
+from typing import Dict, List, Literal, Optional
 
 class NotificationCreate(BaseModel):
     mensagemId: Optional[UUID] = Field(default_factory=uuid4)
     conteudoMensagem: str
     tipoNotificacao: str
+    # "alta" for transactional messages (OTP, password reset) that must not wait behind bulk traffic
+    prioridade: Literal["alta", "normal"] = "normal"
 
 class NotificationCreateResponse(BaseModel):
     mensagemId: UUID
@@ -14,6 +16,78 @@ class NotificationCreateResponse(BaseModel):
 class NotificationStatusResponse(BaseModel):
     traceId: UUID
     mensagemId: UUID
-    conteudoMensagem: str
+    # None once the content was dropped after dispatch (STORAGE_DROP_CONTENT_AFTER_DISPATCH)
+    conteudoMensagem: Optional[str] = None
+    tipoNotificacao: str
+    prioridade: str = "normal"
+    status: str
+
+class NotificationBatchItemResult(BaseModel):
+    index: int
+    mensagemId: Optional[UUID] = None
+    traceId: Optional[UUID] = None
+    error: Optional[str] = None
+
+class NotificationBatchResponse(BaseModel):
+    accepted: int
+    rejected: int
+    results: List[NotificationBatchItemResult]
+
+class NotificationIndexItem(BaseModel):
+    traceId: UUID
     tipoNotificacao: str
     status: str
+    # Epoch seconds the notification entered its status (status listing) or was received (mensagemId listing)
+    registradoEm: float
+
+class NotificationPage(BaseModel):
+    items: List[NotificationIndexItem]
+    # Pass it back as ``cursor`` for the next page; None on the last one
+    proximoCursor: Optional[str] = None
+
+class NotificationCountsResponse(BaseModel):
+    total: int
+    # status -> tipoNotificacao -> notifications
+    contagens: Dict[str, Dict[str, int]]
+
+class DeadLetterFailure(BaseModel):
+    etapa: str
+    status: str
+    motivo: str
+    tentativa: int
+    em: float
+
+class DeadLetterItem(BaseModel):
+    traceId: UUID
+    mensagemId: Optional[str] = None
+    tipoNotificacao: Optional[str] = None
+    # Status, stage and reason of the last failure
+    status: Optional[str] = None
+    etapa: Optional[str] = None
+    motivo: str
+    tentativas: int
+    historico: List[DeadLetterFailure]
+    # Epoch seconds the message reached the DLQ
+    registradoEm: float
+
+class DeadLetterPage(BaseModel):
+    items: List[DeadLetterItem]
+    proximoCursor: Optional[str] = None
+
+class DeadLetterReplayRequest(BaseModel):
+    destino: str = "entrada"
+    status: Optional[str] = None
+    tipoNotificacao: Optional[str] = None
+    desde: Optional[float] = None
+    ate: Optional[float] = None
+    erro: Optional[str] = None
+    # Messages per second; DLQ_REPLAY_RATE by default
+    taxa: Optional[float] = Field(None, gt=0)
+    lote: Optional[int] = Field(None, ge=1)
+    limite: int = Field(100, ge=1)
+
+class DeadLetterReplayResponse(BaseModel):
+    destino: str
+    reprocessadas: int
+    falhas: int
+    aguardandoSegundos: float
@@ -0,0 +1,110 @@
+import asyncio
+import logging
+import time
+from typing import Dict, Optional, Tuple
+from app.core import metrics
+from app.core.config import settings
+from app.core.priority import HIGH_PRIORITY
+from app.services.dispatcher import channel_queue
+from app.services.rabbitmq import RabbitMQService
+from app.services.topology import stage_depth
+
+logger = logging.getLogger(__name__)
+
+LOAD_SHED = metrics.Counter("notification_load_shed_total", "Notifications rejected by the API's load shedding, by channel and reason.", ("channel", "reason"))
+
+TOO_MANY_REQUESTS = 429
+SERVICE_UNAVAILABLE = 503
+
+
+class BackpressureMonitor:
+    """Decides whether the API sheds a new notification, from the backlog of the pipeline.
+
+    Reads the depth of the input stage, and of the dispatch queues with a
+    BACKPRESSURE_CHANNEL_WATERMARKS entry, from the broker at most every
+    BACKPRESSURE_REFRESH_SECONDS; requests arriving during a refresh use the
+    previous depths instead of waiting for it. The publish latency is the
+    publisher's moving average, only trusted while publishes keep coming, so
+    shedding on latency lets a probe through once a refresh period passed.
+    """
+
+    def __init__(self):
+        self._depths: Dict[str, int] = {}
+        self._refreshed_at: Optional[float] = None
+        self._refresh_lock = asyncio.Lock()
+
+    def enabled(self) -> bool:
+        return bool(
+            settings.BACKPRESSURE_QUEUE_HIGH_WATERMARK
+            or settings.BACKPRESSURE_QUEUE_CRITICAL_WATERMARK
+            or settings.BACKPRESSURE_PUBLISH_LATENCY_MS
+            or settings.BACKPRESSURE_CHANNEL_WATERMARKS
+        )
+
+    def _watched_queues(self) -> list:
+        return [settings.NOTIFICATION_INPUT_QUEUE, *(channel_queue(channel) for channel in settings.BACKPRESSURE_CHANNEL_WATERMARKS)]
+
+    async def _refresh(self, rabbitmq_service: RabbitMQService):
+        if self._refresh_lock.locked():
+            return
+        async with self._refresh_lock:
+            self._refreshed_at = time.monotonic()
+            try:
+                self._depths = {queue: await stage_depth(rabbitmq_service, queue) for queue in self._watched_queues()}
+            except Exception as e:
+                # Keep deciding on the last known depths rather than failing the requests
+                logger.warning(f"Could not read queue depths for load shedding: {e!r}")
+
+    async def depths(self, rabbitmq_service: RabbitMQService) -> Dict[str, int]:
+        if self._refreshed_at is None or time.monotonic() - self._refreshed_at >= settings.BACKPRESSURE_REFRESH_SECONDS:
+            await self._refresh(rabbitmq_service)
+        return self._depths
+
+    def _publish_latency_ms(self, rabbitmq_service: RabbitMQService) -> float:
+        last_publish_at = rabbitmq_service.last_publish_at
+        if last_publish_at is None or time.monotonic() - last_publish_at > settings.BACKPRESSURE_REFRESH_SECONDS:
+            return 0.0
+        return rabbitmq_service.publish_latency * 1000
+
+    async def check(self, rabbitmq_service: RabbitMQService, channel: str, priority: Optional[str] = None) -> Optional[Tuple[int, str]]:
+        """Returns ``(status_code, reason)`` if a notification of this channel and priority is shed now, else None."""
+        if not self.enabled():
+            return None
+        depths = await self.depths(rabbitmq_service)
+        input_depth = depths.get(settings.NOTIFICATION_INPUT_QUEUE, 0)
+        critical = settings.BACKPRESSURE_QUEUE_CRITICAL_WATERMARK
+        high = settings.BACKPRESSURE_QUEUE_HIGH_WATERMARK
+        latency_ms = self._publish_latency_ms(rabbitmq_service)
+        if critical and input_depth >= critical:
+            return self._shed(channel, "queue_critical", SERVICE_UNAVAILABLE, f"{input_depth} notifications waiting to be processed")
+        if settings.BACKPRESSURE_PUBLISH_LATENCY_MS and latency_ms >= settings.BACKPRESSURE_PUBLISH_LATENCY_MS:
+            return self._shed(channel, "publish_latency", SERVICE_UNAVAILABLE, f"Message broker is slow to accept notifications ({latency_ms:.0f} ms)")
+        # High-priority notifications (e.g. OTPs) have their own lane and keep being accepted
+        if high and input_depth >= high and priority != HIGH_PRIORITY:
+            return self._shed(channel, "queue_high", TOO_MANY_REQUESTS, f"{input_depth} notifications waiting to be processed")
+        channel_watermark = settings.BACKPRESSURE_CHANNEL_WATERMARKS.get(channel)
+        channel_depth = depths.get(channel_queue(channel), 0)
+        if channel_watermark and channel_depth >= channel_watermark:
+            return self._shed(channel, "channel_queue", TOO_MANY_REQUESTS, f"{channel_depth} '{channel}' notifications waiting to be sent")
+        return None
+
+    def _shed(self, channel: str, reason: str, status_code: int, detail: str) -> Tuple[int, str]:
+        LOAD_SHED.labels(channel, reason).inc()
+        return status_code, f"Notification rejected to shed load: {detail}. Retry later."
+
+    def last_depths(self) -> Dict[str, int]:
+        return dict(self._depths)
+
+    def clear(self):
+        self._depths = {}
+        self._refreshed_at = None
+
+
+backpressure = BackpressureMonitor()
+
+metrics.GaugeCallback(
+    "notification_backpressure_queue_depth",
+    "Queue depths last read by the API's load shedding, by stage queue.",
+    ("queue",),
+    lambda: {(queue,): depth for queue, depth in backpressure.last_depths().items()},
+)
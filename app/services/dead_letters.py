@@ -0,0 +1,151 @@
+import logging
+import time
+from typing import Optional
+from app.core import metrics, storage
+from app.core.config import settings
+from app.core.rate_limit import TokenBucket
+from app.core.status_cache import notification_cache
+from app.services.rabbitmq import RabbitMQService
+from app.services.topology import publish_batch_to_stage
+
+logger = logging.getLogger(__name__)
+
+# Every failure of a notification is appended to the "falhas" list of the
+# message itself, so the DLQ entry tells at which stage, with which status
+# and why it failed on each attempt. Replays count in "reprocessamentos".
+FAILURES_KEY = "falhas"
+REPLAYS_KEY = "reprocessamentos"
+REPLAY_STATUS = "REPROCESSAMENTO_DLQ"
+# Stages a dead message can be published back to
+REPLAY_TARGETS = {
+    "entrada": settings.NOTIFICATION_INPUT_QUEUE,
+    "validacao": settings.NOTIFICATION_VALIDATION_QUEUE,
+}
+# A filtered listing reads at most this many index entries per returned entry
+_SCAN_FACTOR = 10
+
+
+def record_failure(data: dict, stage: str, status: str, reason: str, attempt: int = 1):
+    data.setdefault(FAILURES_KEY, []).append(
+        {"etapa": stage, "status": status, "motivo": reason, "tentativa": attempt, "em": time.time()}
+    )
+
+
+def build_dead_letter(data: dict) -> dict:
+    """Builds the stored DLQ entry of a dead message from its failure history."""
+    failures = data.get(FAILURES_KEY) or []
+    last = failures[-1] if failures else {}
+    return {
+        "traceId": data.get("traceId"),
+        "mensagemId": data.get("mensagemId"),
+        "tipoNotificacao": data.get("channel"),
+        "status": last.get("status"),
+        "etapa": last.get("etapa"),
+        "motivo": last.get("motivo") or "desconhecido",
+        "tentativas": len(failures),
+        "historico": failures,
+        "registradoEm": time.time(),
+        "mensagem": data,
+    }
+
+
+def _matches(entry: dict, status: Optional[str], channel: Optional[str], error: Optional[str]) -> bool:
+    if status is not None and entry["status"] != status:
+        return False
+    if channel is not None and entry["tipoNotificacao"] != channel:
+        return False
+    if error is not None:
+        error = error.lower()
+        reasons = [entry["motivo"], *(failure.get("motivo") or "" for failure in entry["historico"])]
+        return any(error in reason.lower() for reason in reasons)
+    return True
+
+
+async def find_dead_letters(
+    status: Optional[str] = None,
+    channel: Optional[str] = None,
+    since: Optional[float] = None,
+    until: Optional[float] = None,
+    error: Optional[str] = None,
+    limit: int = 50,
+    cursor: Optional[str] = None,
+) -> tuple:
+    """Lists stored dead messages matching the filters, newest first: ``(entries, next_cursor)``.
+
+    ``error`` matches a case-insensitive substring of any failure reason. The
+    time range is served by the DLQ index; the other filters are applied to
+    the entries read from it, reading at most ``limit * 10`` of them per call,
+    so a page may come back short with a cursor to continue from.
+    """
+    entries, budget = [], limit * _SCAN_FACTOR
+    while len(entries) < limit and budget > 0:
+        page, cursor = await storage.list_dead_letters(since, until, min(limit, budget), cursor)
+        budget -= len(page)
+        for (trace_id, dead_at), entry in zip(page, await storage.get_dead_letters([trace_id for trace_id, _ in page])):
+            # Entries expire before their index is pruned
+            if entry is not None and _matches(entry, status, channel, error):
+                entries.append(entry)
+                if len(entries) == limit:
+                    # The rest of the page is left for the next call
+                    return entries, storage.format_cursor(trace_id, dead_at)
+        if cursor is None:
+            break
+    return entries, cursor
+
+
+async def _mark_replayed(entries: list):
+    for entry in entries:
+        trace_id = entry["traceId"]
+        if not await storage.set_status(trace_id, REPLAY_STATUS):
+            # The record expired meanwhile: the replay brings it back
+            await storage.set_notification(trace_id, {**entry["mensagem"], storage.STATUS_FIELD: REPLAY_STATUS})
+        # Status change events only reach the cache for streamed traceIds
+        notification_cache.invalidate(trace_id)
+
+
+async def replay_dead_letters(
+    rabbitmq_service: RabbitMQService,
+    target: str = "entrada",
+    rate: Optional[float] = None,
+    batch_size: Optional[int] = None,
+    limit: int = 1000,
+    **filters,
+) -> dict:
+    """Publishes up to ``limit`` dead messages matching ``filters`` back to a stage of REPLAY_TARGETS.
+
+    Publishes ``batch_size`` messages per batch, at most ``rate`` per second
+    across every replay running against the same Redis (DLQ_REPLAY_* by
+    default), so a replay does not flood the stage it feeds. Replayed
+    messages leave the stored DLQ; the ones whose publish failed stay in it.
+    """
+    if target not in REPLAY_TARGETS:
+        raise ValueError(f"Unknown replay target '{target}'. Available targets: {', '.join(REPLAY_TARGETS)}")
+    queue_name = REPLAY_TARGETS[target]
+    batch_size = batch_size or settings.DLQ_REPLAY_BATCH_SIZE
+    bucket = TokenBucket("dlq-replay", rate or settings.DLQ_REPLAY_RATE, batch_size)
+    replayed = metrics.DLQ_REPLAYED.labels(target, "replayed")
+    failed = metrics.DLQ_REPLAYED.labels(target, "failed")
+    summary = {"destino": target, "reprocessadas": 0, "falhas": 0, "aguardandoSegundos": 0.0}
+    cursor = None
+    while summary["reprocessadas"] + summary["falhas"] < limit:
+        remaining = limit - summary["reprocessadas"] - summary["falhas"]
+        entries, cursor = await find_dead_letters(limit=min(batch_size, remaining), cursor=cursor, **filters)
+        if entries:
+            summary["aguardandoSegundos"] += await bucket.acquire(len(entries))
+            messages = [{**entry["mensagem"], REPLAYS_KEY: entry["mensagem"].get(REPLAYS_KEY, 0) + 1} for entry in entries]
+            await _mark_replayed(entries)
+            errors = await publish_batch_to_stage(rabbitmq_service, messages, queue_name)
+            published = [entry["traceId"] for entry, error in zip(entries, errors) if error is None]
+            await storage.delete_dead_letters(published)
+            for entry, error in zip(entries, errors):
+                if error is not None:
+                    logger.error(f"Replay of dead message {entry['traceId']} to '{queue_name}' failed: {error}")
+                    await storage.set_status(entry["traceId"], "DLQ_RECEIVED")
+                    notification_cache.invalidate(entry["traceId"])
+            replayed.inc(len(published))
+            failed.inc(len(entries) - len(published))
+            summary["reprocessadas"] += len(published)
+            summary["falhas"] += len(entries) - len(published)
+        if cursor is None:
+            break
+    return summary
@@ -0,0 +1,152 @@
+import asyncio
+import logging
+import time
+from typing import Optional
+from app.core import metrics
+from app.core.config import settings
+from app.core.exceptions import ProviderError
+from app.core.rate_limit import TokenBucket
+from app.services.providers import NotificationProvider, load_provider
+
+logger = logging.getLogger(__name__)
+
+DISPATCH_BATCH_SIZE = metrics.Histogram(
+    "notification_dispatch_batch_size",
+    "Notifications sent per provider call.",
+    ("channel",),
+    buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000),
+)
+DISPATCH_DURATION = metrics.Histogram("notification_dispatch_duration_seconds", "Time of a provider call.", ("channel",))
+DISPATCHED = metrics.Counter("notification_dispatched_total", "Notifications handed to a provider, by outcome.", ("channel", "outcome"))
+RATE_LIMIT_WAIT = metrics.Counter("notification_rate_limit_wait_seconds_total", "Time provider calls waited for the rate limit.", ("channel",))
+
+
+def channel_queue(channel: str) -> str:
+    return f"{settings.NOTIFICATION_CHANNEL_QUEUE_PREFIX}{channel}"
+
+
+class ChannelDispatcher:
+    """Groups the sends of a channel into batched provider calls.
+
+    A batch goes out once ``max_batch_size`` notifications are waiting or
+    ``max_wait`` seconds after its first one, whichever comes first, after
+    taking one token per notification from the channel's shared rate limit.
+    Each ``send`` returns when its notification was accepted, or raises
+    the provider's error for it, any other failure of the call wrapped in
+    a ProviderError.
+    """
+
+    def __init__(
+        self,
+        channel: str,
+        provider: NotificationProvider,
+        max_batch_size: int,
+        max_wait: float,
+        rate_limit: Optional[TokenBucket] = None,
+    ):
+        self.channel = channel
+        self.provider = provider
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.rate_limit = rate_limit
+        self._pending = []  # (notification, future)
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._calls = set()
+        self._batch_size = DISPATCH_BATCH_SIZE.labels(channel)
+        self._duration = DISPATCH_DURATION.labels(channel)
+        self._sent = DISPATCHED.labels(channel, "sent")
+        self._failed = DISPATCHED.labels(channel, "failed")
+        self._rate_limit_wait = RATE_LIMIT_WAIT.labels(channel)
+
+    async def send(self, data: dict):
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((data, future))
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.max_wait, self._flush)
+        await future
+
+    @staticmethod
+    def _as_provider_error(error: Exception) -> ProviderError:
+        # Transport failures (timeouts, connection resets) are failed sends
+        # too, so the stages route them to retry/DLQ like a refusal
+        if isinstance(error, ProviderError):
+            return error
+        wrapped = ProviderError(f"{type(error).__name__}: {error}")
+        wrapped.__cause__ = error
+        return wrapped
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        while self._pending:
+            batch, self._pending = self._pending[:self.max_batch_size], self._pending[self.max_batch_size:]
+            call = asyncio.create_task(self._call(batch))
+            self._calls.add(call)
+            call.add_done_callback(self._calls.discard)
+
+    async def _call(self, batch: list):
+        try:
+            if self.rate_limit is not None:
+                self._rate_limit_wait.inc(await self.rate_limit.acquire(len(batch)))
+            started = time.perf_counter()
+            try:
+                results = await self.provider.send_batch([data for data, _ in batch])
+            finally:
+                self._duration.observe(time.perf_counter() - started)
+            self._batch_size.observe(len(batch))
+        except Exception as e:
+            logger.error(f"Provider call for {len(batch)} '{self.channel}' notifications failed: {e}")
+            results = [e] * len(batch)
+        for (_, future), error in zip(batch, results):
+            (self._sent if error is None else self._failed).inc()
+            # The sender may have been cancelled meanwhile (e.g. on shutdown)
+            if future.done():
+                continue
+            if error is None:
+                future.set_result(None)
+            else:
+                future.set_exception(self._as_provider_error(error))
+
+    def stats(self) -> dict:
+        return {"pending": len(self._pending), "calls_in_flight": len(self._calls)}
+
+    async def close(self):
+        """Sends what is still waiting and closes the provider."""
+        self._flush()
+        await asyncio.gather(*self._calls, return_exceptions=True)
+        await self.provider.close()
+
+
+_dispatchers = {}
+
+
+def get_dispatcher(channel: str) -> ChannelDispatcher:
+    """Returns the dispatcher of a channel, built from the DISPATCH_* settings on first use."""
+    dispatcher = _dispatchers.get(channel)
+    if dispatcher is None:
+        rate = settings.DISPATCH_RATE_LIMITS.get(channel)
+        dispatcher = _dispatchers[channel] = ChannelDispatcher(
+            channel,
+            load_provider(settings.DISPATCH_PROVIDERS.get(channel, "fake"), channel),
+            max_batch_size=settings.DISPATCH_BATCH_SIZE,
+            max_wait=settings.DISPATCH_BATCH_WAIT_MS / 1000,
+            rate_limit=TokenBucket(channel, rate, settings.DISPATCH_RATE_BURST.get(channel)) if rate else None,
+        )
+    return dispatcher
+
+
+async def close_dispatchers():
+    while _dispatchers:
+        _, dispatcher = _dispatchers.popitem()
+        await dispatcher.close()
+
+
+metrics.GaugeCallback(
+    "notification_dispatch",
+    "Notifications waiting for a provider call and provider calls in flight, by channel.",
+    ("channel", "stat"),
+    lambda: {(channel, name): value for channel, dispatcher in list(_dispatchers.items()) for name, value in dispatcher.stats().items()},
+)
@@ -0,0 +1,139 @@
+import asyncio
+import logging
+import time
+from typing import Optional
+from aio_pika import ExchangeType
+from app.core import metrics
+from app.core.log import bind_trace_id, reset_trace_id
+from app.core.priority import DEFAULT_PRIORITY, WeightedFairLimiter
+from app.services.rabbitmq import RabbitMQService
+from app.services.topology import destination_queue
+
+logger = logging.getLogger(__name__)
+
+
+class _LocalStage:
+    def __init__(self, queue_name: str, task_func, concurrency: int, queue_size: int, limiter: Optional[WeightedFairLimiter], priority: str):
+        self.queue_name = queue_name
+        self.task_func = task_func
+        self.concurrency = concurrency
+        self.limiter = limiter
+        self.priority = priority
+        self.queue = asyncio.Queue(queue_size)
+        self.metrics = metrics.stage_metrics(task_func.__name__)
+        self.runners = []
+
+
+class FusedRabbitMQService:
+    """RabbitMQService proxy that hands messages to stages hosted in the same process in memory.
+
+    A publish to the queue of a local stage is put on that stage's bounded
+    asyncio queue instead of going through the broker, skipping the encode,
+    the broker round trip and the decode. The publish only returns once the
+    local stage (and whatever it hands off further) has finished, so the
+    broker message that started the chain stays unacked until the terminal
+    stage is done: if the process dies midway the broker redelivers it and
+    the chain runs again from its first stage, as with the unfused pipeline.
+    Errors of a local stage are raised to the publisher, so a PublishNackError
+    further down still requeues the original message.
+
+    Publishes with an expiration (delayed retries) and publishes to queues
+    not hosted here go through the broker.
+    """
+
+    def __init__(self, rabbitmq_service: RabbitMQService, queue_size: int):
+        self.rabbitmq_service = rabbitmq_service
+        self.queue_size = queue_size
+        self.stages = {}
+
+    def __getattr__(self, name):
+        return getattr(self.rabbitmq_service, name)
+
+    def add_stage(
+        self,
+        queue_name: str,
+        task_func,
+        concurrency: int,
+        limiter: Optional[WeightedFairLimiter] = None,
+        priority: str = DEFAULT_PRIORITY,
+    ):
+        """Hosts a stage locally, running it on ``concurrency`` tasks.
+
+        With ``limiter`` each run also takes a slot of the ``priority`` lane
+        from it, so the lanes of a stage and its broker consumers sharing the
+        limiter never run more than its ``max_concurrency`` handlers together.
+        """
+        stage = _LocalStage(queue_name, task_func, concurrency, self.queue_size, limiter, priority)
+        stage.runners = [asyncio.create_task(self._run(stage)) for _ in range(concurrency)]
+        self.stages[queue_name] = stage
+
+    def _local_stage(self, routing_key: str, exchange_name: str, expiration: float):
+        if expiration is not None:
+            return None
+        return self.stages.get(destination_queue(exchange_name, routing_key))
+
+    async def publish_message(
+        self,
+        message: dict,
+        routing_key: str,
+        exchange_name: str = '',
+        exchange_type: ExchangeType = ExchangeType.DIRECT,
+        headers: dict = None,
+        expiration: float = None,
+    ):
+        stage = self._local_stage(routing_key, exchange_name, expiration)
+        if stage is None:
+            await self.rabbitmq_service.publish_message(message, routing_key, exchange_name, exchange_type, headers, expiration)
+            return
+        done = asyncio.get_running_loop().create_future()
+        # A copy stands in for the decode a broker hop would do
+        await stage.queue.put((dict(message), dict(headers or {}), done))
+        await done
+
+    async def _run(self, stage: _LocalStage):
+        while True:
+            data, headers, done = await stage.queue.get()
+            if stage.limiter is not None:
+                try:
+                    await stage.limiter.acquire(stage.priority)
+                except asyncio.CancelledError:
+                    if not done.done():
+                        done.cancel()
+                    raise
+            stage.metrics.in_flight.inc()
+            started = time.perf_counter()
+            trace_token = bind_trace_id(data.get("traceId"))
+            try:
+                await stage.task_func(data, self, headers=headers)
+            except asyncio.CancelledError:
+                if not done.done():
+                    done.cancel()
+                raise
+            except Exception as e:
+                stage.metrics.error.inc()
+                if not done.done():
+                    done.set_exception(e)
+            else:
+                stage.metrics.success.inc()
+                if not done.done():
+                    done.set_result(None)
+            finally:
+                if stage.limiter is not None:
+                    stage.limiter.release()
+                reset_trace_id(trace_token)
+                stage.metrics.duration.observe(time.perf_counter() - started)
+                stage.metrics.in_flight.dec()
+
+    def health(self) -> dict:
+        return {
+            **self.rabbitmq_service.health(),
+            "fused_stages": {name: {"queued": stage.queue.qsize(), "concurrency": stage.concurrency} for name, stage in self.stages.items()},
+        }
+
+    async def close(self):
+        """Stops the local stages; call it after in-flight broker messages have drained."""
+        runners = [runner for stage in self.stages.values() for runner in stage.runners]
+        for runner in runners:
+            runner.cancel()
+        await asyncio.gather(*runners, return_exceptions=True)
+        self.stages.clear()
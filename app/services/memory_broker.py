@@ -0,0 +1,283 @@
+import asyncio
+import itertools
+import zlib
+from collections import deque
+from contextlib import asynccontextmanager
+import aio_pika
+from aio_pika import ExchangeType
+from app.services.rabbitmq import RabbitMQService
+
+
+class InMemoryMessage:
+    """Delivered message exposing the parts of aio_pika.IncomingMessage used by the consumers."""
+
+    def __init__(self, broker, queue, body: bytes, content_type: str = None, headers: dict = None, expiration: float = None):
+        self.broker = broker
+        self.queue = queue
+        self.body = body
+        self.content_type = content_type
+        self.headers = headers or {}
+        self.expiration = expiration
+        self.redelivered = False
+        self.delivery_tag = None
+        self.consumer = None
+        self.expires_at = None
+        self.processed = False
+
+    async def ack(self):
+        self.broker._settle(self)
+
+    async def nack(self, requeue: bool = True):
+        self.broker._settle(self, requeue=requeue, dead_letter=not requeue)
+
+    async def reject(self, requeue: bool = False):
+        await self.nack(requeue=requeue)
+
+    @asynccontextmanager
+    async def process(self, requeue: bool = False, reject_on_redelivered: bool = False, ignore_processed: bool = False):
+        try:
+            yield self
+        except BaseException:
+            if not (ignore_processed and self.processed):
+                await self.reject(requeue=requeue)
+            raise
+        if not (ignore_processed and self.processed):
+            await self.ack()
+
+
+class _Consumer:
+    def __init__(self, tag: str, callback, prefetch_count: int = None):
+        self.tag = tag
+        self.callback = callback
+        self.prefetch_count = prefetch_count
+        self.unacked = 0
+
+    @property
+    def has_capacity(self) -> bool:
+        return not self.prefetch_count or self.unacked < self.prefetch_count
+
+
+class _Queue:
+    def __init__(self, name: str, arguments: dict = None):
+        self.name = name
+        self.arguments = arguments or {}
+        self.messages = deque()
+        self.consumers = []
+        self.expiry_timer = None
+        ttl = self.arguments.get("x-message-ttl")
+        self.ttl = ttl / 1000 if ttl is not None else None
+        self.dead_letter_exchange = self.arguments.get("x-dead-letter-exchange")
+        self.dead_letter_routing_key = self.arguments.get("x-dead-letter-routing-key")
+
+
+class _Exchange:
+    def __init__(self, name: str, type: ExchangeType):
+        self.name = name
+        self.type = ExchangeType(type)
+        self.bindings = {}  # routing key -> queue names
+
+    def route(self, routing_key: str) -> list:
+        if self.type == ExchangeType.FANOUT:
+            return list(dict.fromkeys(q for queues in self.bindings.values() for q in queues))
+        if self.type == ExchangeType.X_CONSISTENT_HASH:
+            # Binding keys are weights; a stable hash keeps each routing key on one queue
+            ring = [q for weight, queues in sorted(self.bindings.items()) for q in sorted(queues) for _ in range(int(weight))]
+            return [ring[zlib.crc32(routing_key.encode()) % len(ring)]] if ring else []
+        return list(self.bindings.get(routing_key, ()))
+
+
+class InMemoryRabbitMQService(RabbitMQService):
+    """Broker stand-in that keeps exchanges and queues in the running event loop.
+
+    It implements the RabbitMQService surface used by the API, the worker and
+    the stages: direct/fanout/consistent-hash exchanges and the default exchange, per-consumer
+    prefetch, acks, nacks with requeue, and queue/message TTLs that
+    dead-letter through ``x-dead-letter-exchange`` like RabbitMQ does (only
+    expired messages at the head of a queue are dead-lettered). Publishing
+    still goes through the configured codec, so benchmarks include encoding.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.broker_queues = {}
+        self.broker_exchanges = {"": _Exchange("", ExchangeType.DIRECT)}
+        self._consumer_tags = itertools.count(1)
+        self._delivery_tags = itertools.count(1)
+        self._outstanding = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._tasks = set()
+        self.published = 0
+        self.dead_lettered = 0
+
+    async def connect(self):
+        pass
+
+    async def _prepare_publish(self, exchange_name: str, exchange_type: ExchangeType):
+        if exchange_name not in self.broker_exchanges:
+            await self.declare_exchange(exchange_name, exchange_type, durable=True)
+
+    async def declare_exchange(self, name: str, type: ExchangeType = ExchangeType.DIRECT, **kwargs):
+        if name not in self.broker_exchanges:
+            self.broker_exchanges[name] = _Exchange(name, type)
+        self.exchanges[name] = self.broker_exchanges[name]
+        return self.exchanges[name]
+
+    async def declare_queue(self, name: str, arguments: dict = None, **kwargs):
+        if name not in self.broker_queues:
+            self.broker_queues[name] = _Queue(name, arguments)
+        self.queues[name] = self.broker_queues[name]
+        return self.queues[name]
+
+    async def bind_queue(self, queue_name: str, exchange_name: str, routing_key: str = None):
+        if queue_name not in self.broker_queues or exchange_name not in self.broker_exchanges:
+            raise ValueError(f"Queue '{queue_name}' or Exchange '{exchange_name}' not declared.")
+        self.broker_exchanges[exchange_name].bindings.setdefault(routing_key or queue_name, set()).add(queue_name)
+
+    async def _publish(self, exchange_name: str, message: aio_pika.Message, routing_key: str):
+        self.published += 1
+        self._route(exchange_name, routing_key, message.body, message.content_type, dict(message.headers or {}), message.expiration)
+
+    def _route(self, exchange_name: str, routing_key: str, body: bytes, content_type: str, headers: dict, expiration: float):
+        if exchange_name:
+            exchange = self.broker_exchanges.get(exchange_name)
+            if exchange is None:
+                raise ValueError(f"Exchange '{exchange_name}' not declared.")
+            queue_names = exchange.route(routing_key)
+        else:
+            queue_names = [routing_key] if routing_key in self.broker_queues else []
+        # Unroutable messages are dropped, as with a non-mandatory publish
+        for queue_name in queue_names:
+            queue = self.broker_queues[queue_name]
+            self._enqueue(queue, InMemoryMessage(self, queue, body, content_type, dict(headers), expiration))
+
+    def _enqueue(self, queue: _Queue, message: InMemoryMessage, front: bool = False):
+        if not front:
+            self._outstanding += 1
+            self._idle.clear()
+            ttls = [ttl for ttl in (queue.ttl, message.expiration) if ttl is not None]
+            if ttls:
+                message.expires_at = asyncio.get_running_loop().time() + min(ttls)
+        if front:
+            queue.messages.appendleft(message)
+        else:
+            queue.messages.append(message)
+        self._dispatch(queue)
+
+    def _done(self):
+        self._outstanding -= 1
+        if self._outstanding == 0:
+            self._idle.set()
+
+    def _dispatch(self, queue: _Queue):
+        self._expire(queue)
+        while queue.messages:
+            consumer = next((c for c in queue.consumers if c.has_capacity), None)
+            if consumer is None:
+                break
+            # Round robin between the queue's consumers
+            queue.consumers.remove(consumer)
+            queue.consumers.append(consumer)
+            message = queue.messages.popleft()
+            message.consumer = consumer
+            message.delivery_tag = next(self._delivery_tags)
+            message.processed = False
+            consumer.unacked += 1
+            task = asyncio.get_running_loop().create_task(consumer.callback(message))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+            self._expire(queue)
+        self._schedule_expiry(queue)
+
+    def _expire(self, queue: _Queue):
+        now = asyncio.get_running_loop().time()
+        while queue.messages and queue.messages[0].expires_at is not None and queue.messages[0].expires_at <= now:
+            self._dead_letter(queue.messages.popleft(), "expired")
+
+    def _schedule_expiry(self, queue: _Queue):
+        if queue.expiry_timer is not None or not queue.messages or queue.messages[0].expires_at is None:
+            return
+        loop = asyncio.get_running_loop()
+
+        def on_expiry():
+            queue.expiry_timer = None
+            self._dispatch(queue)
+
+        queue.expiry_timer = loop.call_at(queue.messages[0].expires_at, on_expiry)
+
+    def _dead_letter(self, message: InMemoryMessage, reason: str):
+        queue = message.queue
+        if queue.dead_letter_exchange is not None:
+            self.dead_lettered += 1
+            headers = dict(message.headers)
+            # Like RabbitMQ, the most recent death is first and repeated deaths increment its count
+            deaths = list(headers.get("x-death", []))
+            count = 1
+            for death in deaths:
+                if (death["queue"], death["reason"]) == (queue.name, reason):
+                    count += death["count"]
+                    deaths.remove(death)
+                    break
+            headers["x-death"] = [{"queue": queue.name, "reason": reason, "count": count}, *deaths]
+            routing_key = queue.dead_letter_routing_key or queue.name
+            # The per-message expiration is dropped when a message is dead-lettered
+            self._route(queue.dead_letter_exchange, routing_key, message.body, message.content_type, headers, None)
+        self._done()
+
+    def _settle(self, message: InMemoryMessage, requeue: bool = False, dead_letter: bool = False):
+        if message.processed:
+            raise RuntimeError("Message already processed")
+        message.processed = True
+        message.consumer.unacked -= 1
+        queue = message.queue
+        if requeue:
+            # A redelivery is a new delivery: the settled one must stay processed for its handler
+            redelivery = InMemoryMessage(self, queue, message.body, message.content_type, message.headers, message.expiration)
+            redelivery.redelivered = True
+            redelivery.expires_at = message.expires_at
+            self._enqueue(queue, redelivery, front=True)
+        elif dead_letter:
+            self._dead_letter(message, "rejected")
+        else:
+            self._done()
+        self._dispatch(queue)
+
+    async def start_consumer(self, queue_name: str, callback, prefetch_count: int = None):
+        if queue_name not in self.broker_queues:
+            raise ValueError(f"Queue '{queue_name}' not declared.")
+        queue = self.broker_queues[queue_name]
+        consumer = _Consumer(f"ctag-{next(self._consumer_tags)}", callback, prefetch_count)
+        queue.consumers.append(consumer)
+        self.consumers[queue_name] = (queue, consumer.tag)
+        self._dispatch(queue)
+
+    async def stop_consumers(self):
+        for queue in self.broker_queues.values():
+            queue.consumers.clear()
+        self.consumers.clear()
+
+    async def join(self, timeout: float = None):
+        """Waits until every published message has been acked, dropped or dead-lettered to nowhere."""
+        await asyncio.wait_for(self._idle.wait(), timeout)
+
+    async def queue_depth(self, queue_name: str) -> int:
+        queue = self.broker_queues.get(queue_name)
+        return len(queue.messages) if queue else 0
+
+    def queue_depths(self) -> dict:
+        return {name: len(queue.messages) for name, queue in self.broker_queues.items()}
+
+    def health(self) -> dict:
+        return {
+            "connected": True,
+            "channel_pool": None,
+            "confirm_publisher": None,
+            "in_memory": {"published": self.published, "dead_lettered": self.dead_lettered, "outstanding": self._outstanding},
+        }
+
+    async def close(self):
+        await self.stop_consumers()
+        for queue in self.broker_queues.values():
+            if queue.expiry_timer is not None:
+                queue.expiry_timer.cancel()
+                queue.expiry_timer = None
@@ -0,0 +1,74 @@
+import abc
+import asyncio
+import importlib
+import random
+from collections import deque
+from typing import List, Optional
+from app.core.config import settings
+from app.core.exceptions import ProviderError
+
+
+class NotificationProvider(abc.ABC):
+    """Sends the notifications of one channel to an external service, a batch per call.
+
+    Implementations take the channel in their constructor and return one
+    entry per notification from ``send_batch``: None if it was accepted or
+    the exception explaining why not. An exception raised by ``send_batch``
+    itself fails the whole batch.
+    """
+
+    name = "base"
+
+    def __init__(self, channel: str):
+        self.channel = channel
+
+    @abc.abstractmethod
+    async def send_batch(self, notifications: List[dict]) -> List[Optional[Exception]]:
+        ...
+
+    async def close(self):
+        pass
+
+
+class FakeProvider(NotificationProvider):
+    """Local provider for development, benchmarks and tests.
+
+    Each call takes the simulated provider latency once for the whole batch
+    (scaled by SIMULATED_LATENCY_SCALE) and fails notifications at random
+    with FAKE_PROVIDER_FAILURE_RATE. The last ``sent_history`` accepted
+    notifications are kept in ``sent``.
+    """
+
+    name = "fake"
+    sent_history = 1000
+
+    def __init__(self, channel: str, failure_rate: Optional[float] = None):
+        super().__init__(channel)
+        self.failure_rate = settings.FAKE_PROVIDER_FAILURE_RATE if failure_rate is None else failure_rate
+        self.calls = 0
+        self.sent = deque(maxlen=self.sent_history)
+
+    async def send_batch(self, notifications: List[dict]) -> List[Optional[Exception]]:
+        self.calls += 1
+        await asyncio.sleep(random.uniform(0.5, 1) * settings.SIMULATED_LATENCY_SCALE)
+        results = []
+        for data in notifications:
+            if random.random() < self.failure_rate:
+                results.append(ProviderError(f"Simulated {self.channel} provider failure"))
+            else:
+                self.sent.append(data)
+                results.append(None)
+        return results
+
+
+PROVIDERS = {provider.name: provider for provider in (FakeProvider,)}
+
+
+def load_provider(spec: str, channel: str) -> NotificationProvider:
+    """Builds the provider of a channel from a name in PROVIDERS or a "package.module:ClassName" path."""
+    if spec in PROVIDERS:
+        return PROVIDERS[spec](channel)
+    module_name, sep, class_name = spec.partition(":")
+    if not sep:
+        raise ValueError(f"Unknown notification provider '{spec}'. Use one of {', '.join(PROVIDERS)} or 'package.module:ClassName'.")
+    return getattr(importlib.import_module(module_name), class_name)(channel)
@@ -1,27 +1,220 @@
-import json
+import asyncio
+import logging
+import time
+import weakref
+from contextlib import asynccontextmanager
+from app.core import metrics
+from app.core.codec import get_codec
 from app.core.config import settings
 import aio_pika
-from aio_pika import ExchangeType
+from aio_pika import DeliveryMode, ExchangeType
+from aio_pika.exceptions import AMQPError, DeliveryError
+from app.core.exceptions import PublishNackError
+from fastapi import Request
+
+logger = logging.getLogger(__name__)
+
+# Weight of the latest publish in RabbitMQService.publish_latency
+PUBLISH_LATENCY_SMOOTHING = 0.2
+
+
+class ChannelPool:
+    """Bounded pool of channels shared by concurrent publishers."""
+
+    def __init__(self, connection, max_size: int, publisher_confirms: bool = True):
+        self.connection = connection
+        self.max_size = max_size
+        self.publisher_confirms = publisher_confirms
+        self._idle = asyncio.LifoQueue()
+        self._semaphore = asyncio.Semaphore(max_size)
+        self._size = 0
+        self._in_use = 0
+        self._waiting = 0
+
+    async def _get_channel(self):
+        # Channels closed by the broker (e.g. after a channel-level error) are discarded
+        while not self._idle.empty():
+            channel = self._idle.get_nowait()
+            if not channel.is_closed:
+                return channel
+            self._size -= 1
+        channel = await self.connection.channel(publisher_confirms=self.publisher_confirms)
+        self._size += 1
+        return channel
+
+    @asynccontextmanager
+    async def acquire(self):
+        self._waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self._waiting -= 1
+
+        channel = None
+        try:
+            channel = await self._get_channel()
+            self._in_use += 1
+            try:
+                yield channel
+            finally:
+                self._in_use -= 1
+        finally:
+            if channel is not None:
+                if channel.is_closed:
+                    self._size -= 1
+                else:
+                    self._idle.put_nowait(channel)
+            self._semaphore.release()
+
+    def stats(self) -> dict:
+        return {
+            "max_size": self.max_size,
+            "size": self._size,
+            "in_use": self._in_use,
+            "idle": self._idle.qsize(),
+            "waiting": self._waiting,
+        }
+
+    async def close(self):
+        while not self._idle.empty():
+            channel = self._idle.get_nowait()
+            self._size -= 1
+            if not channel.is_closed:
+                await channel.close()
+
+
+async def _get_channel_exchange(channel, exchange_name: str):
+    if exchange_name:
+        return await channel.get_exchange(exchange_name, ensure=False)
+    return channel.default_exchange
+
+
+class ConfirmPublisher:
+    """Publishes with publisher confirms, keeping up to ``window`` unconfirmed messages in flight.
+
+    Concurrent publishes share a few confirm-mode channels, so the broker
+    acknowledges them in pipelined (often ``multiple``) batches while each
+    caller only awaits the confirm of its own message. Nacked or timed out
+    publishes are retried with backoff before PublishNackError is raised.
+    """
+
+    def __init__(self, connection, channel_count: int, window: int):
+        self.connection = connection
+        self.channel_count = channel_count
+        self.window = window
+        self._window = asyncio.Semaphore(window)
+        self._channels = []
+        self._next_channel = 0
+        self._channel_lock = asyncio.Lock()
+        self._in_flight = 0
+        self._counters = {"confirmed": 0, "nacked": 0, "retried": 0, "failed": 0}
+
+    async def _get_channel(self):
+        async with self._channel_lock:
+            self._channels = [channel for channel in self._channels if not channel.is_closed]
+            if len(self._channels) < self.channel_count:
+                channel = await self.connection.channel(publisher_confirms=True)
+                self._channels.append(channel)
+                return channel
+            self._next_channel = (self._next_channel + 1) % len(self._channels)
+            return self._channels[self._next_channel]
+
+    async def publish(self, exchange_name: str, message: aio_pika.Message, routing_key: str):
+        async with self._window:
+            self._in_flight += 1
+            try:
+                for attempt in range(settings.RABBITMQ_PUBLISH_RETRIES + 1):
+                    if attempt:
+                        self._counters["retried"] += 1
+                        await asyncio.sleep(settings.RABBITMQ_PUBLISH_RETRY_BACKOFF * 2 ** (attempt - 1))
+                    try:
+                        channel = await self._get_channel()
+                        exchange = await _get_channel_exchange(channel, exchange_name)
+                        await exchange.publish(message, routing_key=routing_key, timeout=settings.RABBITMQ_CONFIRM_TIMEOUT)
+                    except (DeliveryError, AMQPError, asyncio.TimeoutError) as e:
+                        self._counters["nacked"] += 1
+                        last_error = e
+                        continue
+                    self._counters["confirmed"] += 1
+                    return
+                self._counters["failed"] += 1
+                raise PublishNackError(
+                    f"Message to exchange '{exchange_name}' with routing key '{routing_key}' was not confirmed: {last_error!r}"
+                ) from last_error
+            finally:
+                self._in_flight -= 1
+
+    def stats(self) -> dict:
+        return {
+            "window": self.window,
+            "in_flight": self._in_flight,
+            "channels": len(self._channels),
+            **self._counters,
+        }
+
+    async def close(self):
+        for channel in self._channels:
+            if not channel.is_closed:
+                await channel.close()
+        self._channels = []
+
+
+# Connected services whose publisher statistics are exported as gauges
+_connected_services = weakref.WeakSet()
+
+
+def _publisher_stats() -> dict:
+    values = {}
+    for service in list(_connected_services):
+        for component, stats in (("channel_pool", service.channel_pool), ("confirm_publisher", service.confirm_publisher)):
+            for name, value in (stats.stats() if stats else {}).items():
+                values[(component, name)] = values.get((component, name), 0) + value
+    return values
+
+
+metrics.GaugeCallback("rabbitmq_publisher", "Channel pool and publisher-confirm statistics.", ("component", "stat"), _publisher_stats)
 
 
 class RabbitMQService:
     def __init__(self):
         self.connection = None
         self.channel = None
+        self.channel_pool: ChannelPool = None
+        self.confirm_publisher: ConfirmPublisher = None
         self.queues = {}  # To store declared queues
         self.exchanges = {} # To store declared exchanges
+        self.consumer_channels = {}  # Dedicated channel per consumed queue
+        self.consumers = {}  # queue name -> (queue, consumer tag)
+        self._connect_lock = asyncio.Lock()
+        # Moving average of the publish time, read by the API's load shedding
+        self.publish_latency = 0.0
+        self.last_publish_at = None
 
     async def connect(self):
-        if not self.connection or self.connection.is_closed:
-            self.connection = await aio_pika.connect_robust(
-                host=settings.RABBITMQ_HOST,
-                port=settings.RABBITMQ_PORT,
-                login=settings.RABBITMQ_USER,
-                password=settings.RABBITMQ_PASS
-            )
-            self.channel = await self.connection.channel()
-            # Ensure default exchange is available
-            self.exchanges[''] = self.channel.default_exchange
+        async with self._connect_lock:
+            if not self.connection or self.connection.is_closed:
+                # connect_robust transparently reconnects and restores channels and topology
+                self.connection = await aio_pika.connect_robust(
+                    host=settings.RABBITMQ_HOST,
+                    port=settings.RABBITMQ_PORT,
+                    login=settings.RABBITMQ_USER,
+                    password=settings.RABBITMQ_PASS
+                )
+                self.channel = await self.connection.channel()
+                self.channel_pool = ChannelPool(
+                    self.connection,
+                    settings.RABBITMQ_CHANNEL_POOL_SIZE,
+                    publisher_confirms=not settings.RABBITMQ_PUBLISHER_CONFIRMS,
+                )
+                if settings.RABBITMQ_PUBLISHER_CONFIRMS:
+                    self.confirm_publisher = ConfirmPublisher(
+                        self.connection,
+                        settings.RABBITMQ_CONFIRM_CHANNELS,
+                        settings.RABBITMQ_CONFIRM_WINDOW,
+                    )
+                # Ensure default exchange is available
+                self.exchanges[''] = self.channel.default_exchange
+                _connected_services.add(self)
 
     async def declare_exchange(self, name: str, type: ExchangeType = ExchangeType.DIRECT, **kwargs):
         if name not in self.exchanges:
@@ -43,43 +236,142 @@ class RabbitMQService:
         else:
             raise ValueError(f"Queue '{queue_name}' or Exchange '{exchange_name}' not declared.")
 
-    async def publish_message(self, message: dict, routing_key: str, exchange_name: str = '', exchange_type: ExchangeType = ExchangeType.DIRECT):
-        if not self.channel:
+    def _build_message(self, message: dict, headers: dict = None, expiration: float = None) -> aio_pika.Message:
+        codec = get_codec()
+        return aio_pika.Message(
+            body=codec.encode(message),
+            content_type=codec.content_type,
+            headers=headers,
+            expiration=expiration,
+            # Confirmed publishes are also persisted so a broker restart does not lose them
+            delivery_mode=DeliveryMode.PERSISTENT if self.confirm_publisher else DeliveryMode.NOT_PERSISTENT,
+        )
+
+    async def _publish(self, exchange_name: str, message: aio_pika.Message, routing_key: str):
+        started = time.perf_counter()
+        try:
+            if self.confirm_publisher:
+                await self.confirm_publisher.publish(exchange_name, message, routing_key)
+                return
+            async with self.channel_pool.acquire() as channel:
+                exchange = await _get_channel_exchange(channel, exchange_name)
+                await exchange.publish(message, routing_key=routing_key)
+        except Exception:
+            metrics.PUBLISH_ERRORS.labels(exchange_name).inc()
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            metrics.PUBLISH_DURATION.labels(exchange_name).observe(elapsed)
+            self.observe_publish(elapsed)
+
+    def observe_publish(self, elapsed: float):
+        self.publish_latency += PUBLISH_LATENCY_SMOOTHING * (elapsed - self.publish_latency)
+        self.last_publish_at = time.monotonic()
+
+    async def queue_depth(self, queue_name: str) -> int:
+        """Returns the messages ready in a queue, read with a passive declare."""
+        if not self.channel_pool:
             await self.connect()
+        async with self.channel_pool.acquire() as channel:
+            queue = await channel.declare_queue(queue_name, passive=True)
+        return queue.declaration_result.message_count
 
-        exchange = self.exchanges.get(exchange_name)
-        if not exchange:
+    async def _prepare_publish(self, exchange_name: str, exchange_type: ExchangeType):
+        if not self.channel_pool:
+            await self.connect()
+
+        if exchange_name not in self.exchanges:
             # Declare exchange if it doesn't exist (or use default)
             # Ensure it's declared as durable=True to match existing queues/exchanges
-            exchange = await self.declare_exchange(exchange_name, exchange_type, durable=True)
+            await self.declare_exchange(exchange_name, exchange_type, durable=True)
+
+    async def publish_message(
+        self,
+        message: dict,
+        routing_key: str,
+        exchange_name: str = '',
+        exchange_type: ExchangeType = ExchangeType.DIRECT,
+        headers: dict = None,
+        expiration: float = None,
+    ):
+        """Publishes a message; in confirm mode it returns once the broker has confirmed it.
+
+        Raises PublishNackError if the broker keeps rejecting the message.
+        """
+        await self._prepare_publish(exchange_name, exchange_type)
+        await self._publish(exchange_name, self._build_message(message, headers, expiration), routing_key)
 
-        await exchange.publish(
-            aio_pika.Message(body=json.dumps(message).encode()),
-            routing_key=routing_key
+    async def publish_messages(
+        self,
+        messages: list,
+        routing_key: str,
+        exchange_name: str = '',
+        exchange_type: ExchangeType = ExchangeType.DIRECT,
+        routing_keys: list = None,
+    ) -> list:
+        """Publishes many messages concurrently, so their confirms are pipelined.
+
+        ``routing_keys``, when given, holds the routing key of each message
+        (e.g. for a consistent-hash exchange) instead of the shared ``routing_key``.
+        Returns, for each message, None on success or the exception raised.
+        """
+        await self._prepare_publish(exchange_name, exchange_type)
+        routing_keys = routing_keys or [routing_key] * len(messages)
+        results = await asyncio.gather(
+            *(self._publish(exchange_name, self._build_message(message), key) for message, key in zip(messages, routing_keys)),
+            return_exceptions=True,
         )
-        print(f"[x] Sent '{message}' to exchange '{exchange_name}' with routing key '{routing_key}'")
+        return [result if isinstance(result, BaseException) else None for result in results]
 
-    async def start_consumer(self, queue_name: str, callback):
+    async def start_consumer(self, queue_name: str, callback, prefetch_count: int = None):
         if not self.channel:
             await self.connect()
 
-        queue = self.queues.get(queue_name)
-        if not queue:
+        if queue_name not in self.queues:
             raise ValueError(f"Queue '{queue_name}' not declared.")
 
-        print(f"[*] Waiting for messages in queue '{queue_name}'. To exit press CTRL+C")
-        await queue.consume(callback)
+        # Each consumer gets its own channel so its QoS does not affect other queues
+        channel = await self.connection.channel()
+        if prefetch_count:
+            await channel.set_qos(prefetch_count=prefetch_count)
+        self.consumer_channels[queue_name] = channel
+        queue = await channel.get_queue(queue_name, ensure=False)
+
+        logger.info("Waiting for messages in queue '%s'.", queue_name)
+        consumer_tag = await queue.consume(callback)
+        self.consumers[queue_name] = (queue, consumer_tag)
+
+    async def stop_consumers(self):
+        """Stops receiving new deliveries; messages already delivered can still be acked."""
+        for queue, consumer_tag in self.consumers.values():
+            await queue.cancel(consumer_tag)
+        self.consumers.clear()
+
+    def health(self) -> dict:
+        return {
+            "connected": bool(self.connection and not self.connection.is_closed),
+            "channel_pool": self.channel_pool.stats() if self.channel_pool else None,
+            "confirm_publisher": self.confirm_publisher.stats() if self.confirm_publisher else None,
+        }
 
     async def close(self):
+        for channel in self.consumer_channels.values():
+            if not channel.is_closed:
+                await channel.close()
+        self.consumer_channels.clear()
+        if self.channel_pool:
+            await self.channel_pool.close()
+        if self.confirm_publisher:
+            await self.confirm_publisher.close()
         if self.connection and not self.connection.is_closed:
             await self.connection.close()
 
 
-async def get_rabbitmq_service() -> RabbitMQService:
-    """Dependency injection for RabbitMQService."""
-    service = RabbitMQService()
-    await service.connect()
-    try:
-        yield service
-    finally:
-        await service.close()
+async def get_rabbitmq_service(request: Request) -> RabbitMQService:
+    """Dependency injection for the application-wide RabbitMQService."""
+    service = getattr(request.app.state, "rabbitmq_service", None)
+    if service is None:
+        # Connection is opened lazily on first publish
+        service = RabbitMQService()
+        request.app.state.rabbitmq_service = service
+    return service
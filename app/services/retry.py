@@ -0,0 +1,59 @@
+import random
+from aio_pika import ExchangeType
+from app.core import metrics
+from app.core.config import settings
+from app.services.rabbitmq import RabbitMQService
+
+# Delayed retries are parked in per-attempt delay queues that nobody consumes.
+# When a message's TTL expires the broker dead-letters it back to the retry
+# queue, so the delay costs no consumer capacity or prefetch.
+RETRY_ATTEMPT_HEADER = "x-retry-attempt"
+RETRY_DELAY_EXCHANGE = f"{settings.NOTIFICATION_RETRY_QUEUE}.delay_exchange"
+
+
+def retry_delay_queue(attempt: int) -> str:
+    return f"{settings.NOTIFICATION_RETRY_QUEUE}.delay.{attempt}"
+
+
+def backoff_delay(attempt: int) -> float:
+    """Upper bound, in seconds, of the delay before the given retry attempt."""
+    delay = settings.RETRY_BACKOFF_BASE_SECONDS * settings.RETRY_BACKOFF_MULTIPLIER ** (attempt - 1)
+    return min(delay, settings.RETRY_BACKOFF_MAX_SECONDS)
+
+
+def jittered_delay(attempt: int) -> float:
+    # Jitter only shortens the delay so the per-message expiration never exceeds the queue TTL
+    return backoff_delay(attempt) * (1 - settings.RETRY_BACKOFF_JITTER * random.random())
+
+
+def get_retry_attempt(headers: dict) -> int:
+    return int((headers or {}).get(RETRY_ATTEMPT_HEADER, 1))
+
+
+async def declare_retry_topology(rabbitmq_service: RabbitMQService):
+    retry_exchange = f"{settings.NOTIFICATION_RETRY_QUEUE}_exchange"
+    await rabbitmq_service.declare_exchange(retry_exchange, ExchangeType.DIRECT, durable=True)
+    await rabbitmq_service.declare_queue(settings.NOTIFICATION_RETRY_QUEUE, durable=True)
+    await rabbitmq_service.bind_queue(settings.NOTIFICATION_RETRY_QUEUE, retry_exchange, routing_key=settings.NOTIFICATION_RETRY_QUEUE)
+
+    await rabbitmq_service.declare_exchange(RETRY_DELAY_EXCHANGE, ExchangeType.DIRECT, durable=True)
+    for attempt in range(1, settings.RETRY_MAX_ATTEMPTS + 1):
+        queue_name = retry_delay_queue(attempt)
+        await rabbitmq_service.declare_queue(queue_name, durable=True, arguments={
+            "x-message-ttl": int(backoff_delay(attempt) * 1000),
+            "x-dead-letter-exchange": retry_exchange,
+            "x-dead-letter-routing-key": settings.NOTIFICATION_RETRY_QUEUE,
+        })
+        await rabbitmq_service.bind_queue(queue_name, RETRY_DELAY_EXCHANGE, routing_key=queue_name)
+
+
+async def schedule_retry(data: dict, attempt: int, rabbitmq_service: RabbitMQService):
+    """Publishes the message to the delay queue of the given attempt."""
+    metrics.RETRIES_SCHEDULED.labels(str(attempt)).inc()
+    await rabbitmq_service.publish_message(
+        data,
+        retry_delay_queue(attempt),
+        exchange_name=RETRY_DELAY_EXCHANGE,
+        headers={RETRY_ATTEMPT_HEADER: attempt},
+        expiration=jittered_delay(attempt),
+    )
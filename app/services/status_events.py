@@ -0,0 +1,179 @@
+import asyncio
+import logging
+import weakref
+from typing import Iterable, Optional
+from fastapi.requests import HTTPConnection
+from app.core import metrics, storage
+from app.core.config import settings
+from app.core.status_cache import notification_cache
+
+logger = logging.getLogger(__name__)
+
+
+class StatusSubscription:
+    """Status changes of a set of traceIds, received as (traceId, version, status) tuples."""
+
+    def __init__(self, bus: "StatusEventBus", max_pending: int):
+        self.bus = bus
+        self.trace_ids = set()
+        self._queue = asyncio.Queue(max_pending)
+
+    def _push(self, event: tuple):
+        # A slow reader only needs the latest statuses, so the oldest event is dropped
+        if self._queue.full():
+            self._queue.get_nowait()
+            self.bus.dropped += 1
+        self._queue.put_nowait(event)
+
+    async def add(self, *trace_ids: str):
+        for trace_id in trace_ids:
+            if trace_id not in self.trace_ids:
+                self.trace_ids.add(trace_id)
+                await self.bus._watch(self, trace_id)
+
+    async def remove(self, *trace_ids: str):
+        for trace_id in trace_ids:
+            if trace_id in self.trace_ids:
+                self.trace_ids.discard(trace_id)
+                await self.bus._unwatch(self, trace_id)
+
+    async def get(self, timeout: Optional[float] = None) -> Optional[tuple]:
+        """Returns the next event, or None if none arrived within ``timeout`` seconds."""
+        try:
+            return await asyncio.wait_for(self._queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    async def close(self):
+        await self.remove(*list(self.trace_ids))
+
+
+class StatusEventBus:
+    """Fans status changes out to the subscribers of an API process.
+
+    The process holds a single Redis pub/sub connection, subscribed only to
+    the channels of the traceIds someone is watching; each event is then
+    copied to the local subscriptions of that traceId.
+    """
+
+    def __init__(self):
+        self._watchers = {}  # traceId -> subscriptions
+        self._pubsub = None
+        self._reader: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+        self.delivered = 0
+        self.dropped = 0
+        # Callables receiving every (traceId, version, status) event of the watched traceIds,
+        # e.g. cache invalidation (other traceIds are never received by this process)
+        self.listeners = []
+        _active_buses.add(self)
+
+    async def subscribe(self, trace_ids: Iterable[str] = ()) -> StatusSubscription:
+        subscription = StatusSubscription(self, settings.STATUS_STREAM_MAX_PENDING)
+        await subscription.add(*trace_ids)
+        return subscription
+
+    async def _watch(self, subscription: StatusSubscription, trace_id: str):
+        async with self._lock:
+            watchers = self._watchers.get(trace_id)
+            if watchers is None:
+                watchers = self._watchers[trace_id] = set()
+                if self._pubsub is None:
+                    self._pubsub = storage.get_client().pubsub()
+                await self._pubsub.subscribe(storage.status_channel(trace_id))
+                if self._reader is None:
+                    self._reader = asyncio.create_task(self._read())
+            watchers.add(subscription)
+
+    async def _unwatch(self, subscription: StatusSubscription, trace_id: str):
+        async with self._lock:
+            watchers = self._watchers.get(trace_id)
+            if watchers is None:
+                return
+            watchers.discard(subscription)
+            if not watchers:
+                del self._watchers[trace_id]
+                if self._pubsub is not None:
+                    await self._pubsub.unsubscribe(storage.status_channel(trace_id))
+
+    def _dispatch(self, channel: bytes, payload: bytes):
+        trace_id = channel.decode()[len(storage.STATUS_CHANNEL_PREFIX):]
+        event = (trace_id, *storage.parse_status_event(payload))
+        for listener in self.listeners:
+            listener(*event)
+        for subscription in list(self._watchers.get(trace_id, ())):
+            subscription._push(event)
+            self.delivered += 1
+
+    async def _read(self):
+        failures = 0
+        while True:
+            try:
+                # A failed resubscribe is retried here too, so the reader never dies with watchers left
+                if failures:
+                    await self._resubscribe()
+                    failures = 0
+                message = await self._pubsub.get_message(ignore_subscribe_messages=True, timeout=None)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                delay = min(settings.STATUS_STREAM_RECONNECT_SECONDS * 2 ** failures, settings.STATUS_STREAM_RECONNECT_MAX_SECONDS)
+                failures += 1
+                logger.warning(f"Status event subscription failed, resubscribing in {delay:.1f}s: {e}")
+                await asyncio.sleep(delay)
+                continue
+            if message and message["type"] == "message":
+                self._dispatch(message["channel"], message["data"])
+
+    async def _resubscribe(self):
+        async with self._lock:
+            try:
+                await self._pubsub.aclose()
+            except Exception:
+                pass
+            self._pubsub = storage.get_client().pubsub()
+            if self._watchers:
+                await self._pubsub.subscribe(*(storage.status_channel(trace_id) for trace_id in self._watchers))
+
+    def stats(self) -> dict:
+        return {
+            "watched": len(self._watchers),
+            "subscriptions": len({id(s) for watchers in self._watchers.values() for s in watchers}),
+            "delivered": self.delivered,
+            "dropped": self.dropped,
+        }
+
+    async def close(self):
+        if self._reader is not None:
+            self._reader.cancel()
+            await asyncio.gather(self._reader, return_exceptions=True)
+            self._reader = None
+        if self._pubsub is not None:
+            await self._pubsub.aclose()
+            self._pubsub = None
+        self._watchers.clear()
+        self._lock = asyncio.Lock()
+
+
+# Buses whose statistics are exported as gauges
+_active_buses = weakref.WeakSet()
+
+
+def _stream_stats() -> dict:
+    values = {}
+    for bus in list(_active_buses):
+        for name, value in bus.stats().items():
+            values[(name,)] = values.get((name,), 0) + value
+    return values
+
+
+metrics.GaugeCallback("status_stream", "Status streaming subscriptions and events.", ("stat",), _stream_stats)
+
+
+def get_status_events(connection: HTTPConnection) -> StatusEventBus:
+    """Dependency returning the application-wide status event bus (HTTP and WebSocket routes)."""
+    bus = getattr(connection.app.state, "status_events", None)
+    if bus is None:
+        bus = connection.app.state.status_events = StatusEventBus()
+        bus.listeners.append(notification_cache.on_status_event)
+    return bus
@@ -0,0 +1,143 @@
+from typing import Iterable, Optional
+from aio_pika import ExchangeType
+from app.core.config import settings
+from app.core.priority import HIGH_PRIORITY, has_lanes, lane_queue, stage_lanes
+from app.services.rabbitmq import RabbitMQService
+
+# A sharded queue is split into QUEUE_SHARDS[queue] queues "<queue>.shard.<n>"
+# behind a consistent-hash exchange. Messages are hashed by traceId, so every
+# hop of a notification lands on the same shard, and each shard has a single
+# active consumer: shards spread a stage over broker nodes and worker
+# processes while the messages of a notification stay in order.
+SHARD_EXCHANGE_TYPE = ExchangeType.X_CONSISTENT_HASH
+SHARD_EXCHANGE_SUFFIX = ".shards_exchange"
+# Binding keys of a consistent-hash exchange are weights: every shard gets an equal share
+SHARD_BINDING_WEIGHT = "1"
+
+
+def shard_count(queue_name: str) -> int:
+    # Only queues published by the stages themselves can be sharded: the retry queue is fed by
+    # dead-lettering with a fixed routing key and the DLQ is drained by a single consumer
+    stage_queue = queue_name.removesuffix(f".{HIGH_PRIORITY}")
+    if not has_lanes(stage_queue):
+        return 1
+    return max(settings.QUEUE_SHARDS.get(queue_name, 1), 1)
+
+
+def shard_exchange(queue_name: str) -> str:
+    return f"{queue_name}{SHARD_EXCHANGE_SUFFIX}"
+
+
+def max_shard_count(queue_names: Iterable[str]) -> int:
+    """Returns the shard count of the most sharded lane of ``queue_names``."""
+    return max((shard_count(lane) for queue_name in queue_names for lane in stage_lanes(queue_name).values()), default=1)
+
+
+def check_shards(queue_names: Iterable[str], shards: Optional[Iterable[int]]):
+    """Raises ValueError if a claimed shard does not exist in any lane of ``queue_names``.
+
+    Claims are not checked for queues that are not sharded at all, which consume their only queue.
+    """
+    queue_names = list(queue_names)
+    count = max_shard_count(queue_names)
+    if count == 1:
+        return
+    invalid = sorted({n for n in shards or () if not 0 <= n < count})
+    if invalid:
+        raise ValueError(
+            f"Shards {', '.join(map(str, invalid))} do not exist: {', '.join(queue_names)} have shards 0-{count - 1}."
+        )
+
+
+def shard_queues(queue_name: str, shards: Optional[Iterable[int]] = None) -> list:
+    """Returns the queues a consumer of ``queue_name`` reads from, restricted to the claimed shards.
+
+    Claims are checked against the queues a process consumes together
+    (``check_shards``); shards beyond this queue's own count are those of a
+    more sharded queue of the group and do not apply to it.
+    """
+    count = shard_count(queue_name)
+    if count == 1:
+        return [queue_name]
+    claimed = set(shards) if shards else None
+    return [f"{queue_name}.shard.{n}" for n in range(count) if claimed is None or n in claimed]
+
+
+def shard_key(message: dict) -> str:
+    return str(message.get("traceId") or message.get("mensagemId") or "")
+
+
+def destination_queue(exchange_name: str, routing_key: str) -> Optional[str]:
+    """Returns the stage queue a publish is addressed to, or None for other exchanges."""
+    if exchange_name.endswith(SHARD_EXCHANGE_SUFFIX):
+        return exchange_name[:-len(SHARD_EXCHANGE_SUFFIX)]
+    if exchange_name in ('', f"{routing_key}_exchange"):
+        return routing_key
+    return None
+
+
+async def stage_depth(rabbitmq_service: RabbitMQService, queue_name: str) -> int:
+    """Returns the messages waiting in a stage, over all its priority lanes and shards."""
+    depth = 0
+    for lane in stage_lanes(queue_name).values():
+        for queue in shard_queues(lane):
+            depth += await rabbitmq_service.queue_depth(queue)
+    return depth
+
+
+async def declare_stage(rabbitmq_service: RabbitMQService, queue_name: str) -> list:
+    """Declares the exchanges and queues of each priority lane of a stage; returns the lane queues."""
+    lanes = list(stage_lanes(queue_name).values())
+    for lane in lanes:
+        if shard_count(lane) == 1:
+            exchange_name = f"{lane}_exchange"
+            await rabbitmq_service.declare_exchange(exchange_name, ExchangeType.DIRECT, durable=True)
+            await rabbitmq_service.declare_queue(lane, durable=True)
+            await rabbitmq_service.bind_queue(lane, exchange_name, routing_key=lane)
+            continue
+        exchange_name = shard_exchange(lane)
+        await rabbitmq_service.declare_exchange(exchange_name, SHARD_EXCHANGE_TYPE, durable=True)
+        for shard in shard_queues(lane):
+            # A second worker claiming the same shard stays on standby instead of reordering it
+            await rabbitmq_service.declare_queue(shard, durable=True, arguments={"x-single-active-consumer": True})
+            await rabbitmq_service.bind_queue(shard, exchange_name, routing_key=SHARD_BINDING_WEIGHT)
+    return lanes
+
+
+async def publish_to_stage(rabbitmq_service: RabbitMQService, message: dict, queue_name: str) -> str:
+    """Publishes a notification to a stage, in the lane of its priority; returns the lane queue."""
+    lane = lane_queue(queue_name, message.get("prioridade"))
+    if shard_count(lane) == 1:
+        await rabbitmq_service.publish_message(message, routing_key=lane, exchange_name=f"{lane}_exchange")
+    else:
+        await rabbitmq_service.publish_message(
+            message,
+            routing_key=shard_key(message),
+            exchange_name=shard_exchange(lane),
+            exchange_type=SHARD_EXCHANGE_TYPE,
+        )
+    return lane
+
+
+async def publish_batch_to_stage(rabbitmq_service: RabbitMQService, messages: list, queue_name: str) -> list:
+    """Publishes notifications to the lanes of their priority; returns the errors in input order."""
+    lanes = {}
+    for index, message in enumerate(messages):
+        lanes.setdefault(lane_queue(queue_name, message.get("prioridade")), []).append(index)
+    errors = [None] * len(messages)
+    for lane, indexes in lanes.items():
+        batch = [messages[index] for index in indexes]
+        if shard_count(lane) == 1:
+            lane_errors = await rabbitmq_service.publish_messages(batch, routing_key=lane, exchange_name=f"{lane}_exchange")
+        else:
+            lane_errors = await rabbitmq_service.publish_messages(
+                batch,
+                routing_key=None,
+                exchange_name=shard_exchange(lane),
+                exchange_type=SHARD_EXCHANGE_TYPE,
+                routing_keys=[shard_key(message) for message in batch],
+            )
+        for index, error in zip(indexes, lane_errors):
+            errors[index] = error
+    return errors
+
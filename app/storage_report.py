@@ -0,0 +1,73 @@
+"""Report of the Redis footprint of notification records, for capacity planning.
+
+Samples the stored records, averages their size per status group and
+projects the memory needed for a given number of notifications::
+
+    python -m app.storage_report --sample 1000 --project 100000000
+"""
+import argparse
+import asyncio
+import json
+from app.core import storage
+from app.core.config import settings
+
+
+def project(sizes: dict, notifications: int) -> dict:
+    """Projects the bytes needed to hold ``notifications`` records with the sampled status mix.
+
+    Uses the MEMORY USAGE figure when the server reported it, otherwise the
+    raw payload size (which leaves out Redis' per-key overhead).
+    """
+    sampled = sum(group["records"] for group in sizes.values())
+    total = 0.0
+    for group in sizes.values():
+        per_record = group["memory_bytes"] if group["memory_bytes"] is not None else group["payload_bytes"]
+        total += per_record * notifications * group["records"] / sampled
+    return {"notifications": notifications, "bytes": total}
+
+
+async def build_report(sample: int, notifications: int = None) -> dict:
+    try:
+        sizes = await storage.record_sizes(sample)
+    finally:
+        await storage.close()
+    report = {
+        "key_prefix": settings.REDIS_KEY_PREFIX,
+        "codec": settings.MESSAGE_CODEC,
+        "inflight_ttl_seconds": settings.NOTIFICATION_INFLIGHT_TTL_SECONDS,
+        "terminal_ttl_seconds": settings.NOTIFICATION_TERMINAL_TTL_SECONDS,
+        "drop_content_after_dispatch": settings.STORAGE_DROP_CONTENT_AFTER_DISPATCH,
+        "groups": sizes,
+    }
+    if notifications and sizes:
+        report["projection"] = project(sizes, notifications)
+    return report
+
+
+def format_report(report: dict) -> str:
+    lines = [
+        f"Key prefix: {report['key_prefix']!r} (codec {report['codec']}, drop content after dispatch {report['drop_content_after_dispatch']})",
+        f"Retention: in-flight {report['inflight_ttl_seconds']}s, terminal {report['terminal_ttl_seconds']}s (0 = forever)",
+    ]
+    if not report["groups"]:
+        lines.append("No notification records found.")
+        return "\n".join(lines)
+    lines.append(f"{'group':<12}{'records':>10}{'payload B':>12}{'memory B':>12}")
+    for name, group in sorted(report["groups"].items()):
+        memory = f"{group['memory_bytes']:.1f}" if group["memory_bytes"] is not None else "n/a"
+        lines.append(f"{name:<12}{group['records']:>10}{group['payload_bytes']:>12.1f}{memory:>12}")
+    if "projection" in report:
+        projection = report["projection"]
+        lines.append(f"Projected for {projection['notifications']} notifications: {projection['bytes'] / 1024 ** 3:.2f} GiB")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Report the bytes per notification record stored in Redis.")
+    parser.add_argument("--sample", type=int, default=1000, help="Number of records to measure.")
+    parser.add_argument("--project", type=int, help="Project the memory needed for this many notifications.")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON.")
+    args = parser.parse_args()
+
+    report = asyncio.run(build_report(args.sample, args.project))
+    print(json.dumps(report, indent=2) if args.json else format_report(report))
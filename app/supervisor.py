@@ -0,0 +1,213 @@
+import json
+import logging
+import multiprocessing
+import signal
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+from app.core.config import settings
+from app.services.topology import check_shards, max_shard_count
+
+logger = logging.getLogger(__name__)
+
+
+def build_process_specs(queue_names: list, processes: int = 1, queue_processes: dict = None, shards: list = None) -> list:
+    """Splits the consumed queues into the ``(queue_names, shards)`` of each worker process.
+
+    Queues listed in ``queue_processes`` get that many dedicated processes;
+    the remaining queues are shared by ``processes`` processes. The processes
+    consuming the same queues split ``shards`` (default: all the shards of
+    those queues) round-robin, so each shard has one consumer; with more
+    processes than shards the extra processes also wait on a shard, as
+    standbys. ``shards`` is None for processes of unsharded queues.
+    """
+    queue_processes = queue_processes or {}
+    specs = []
+    for queue_name in queue_names:
+        specs.extend(_split_shards([queue_name], queue_processes.get(queue_name, 0), shards))
+    shared = [q for q in queue_names if q not in queue_processes]
+    if shared:
+        specs.extend(_split_shards(shared, max(processes, 1), shards))
+    return specs
+
+
+def _split_shards(queue_names: list, processes: int, shards: Optional[list]) -> list:
+    count = max_shard_count(queue_names)
+    if count == 1 or processes == 0:
+        return [(list(queue_names), None) for _ in range(processes)]
+    check_shards(queue_names, shards)
+    claimed = sorted(set(shards)) if shards else list(range(count))
+    return [(list(queue_names), claimed[index::processes] or [claimed[index % len(claimed)]]) for index in range(processes)]
+
+
+class WorkerProcess:
+    def __init__(self, index: int, queue_names: list, shards: Optional[list] = None):
+        self.index = index
+        self.queue_names = queue_names
+        self.shards = shards
+        self.process = None
+        self.started_at = 0.0
+        self.restarts = 0
+        self.consecutive_failures = 0
+        self.restart_at = 0.0
+        self.finished = False
+
+    def health(self) -> dict:
+        alive = bool(self.process and self.process.is_alive())
+        return {
+            "index": self.index,
+            "pid": self.process.pid if self.process else None,
+            "alive": alive,
+            "queues": self.queue_names,
+            "shards": self.shards,
+            "restarts": self.restarts,
+            "consecutive_failures": self.consecutive_failures,
+            "crash_looping": self.consecutive_failures >= settings.WORKER_CRASH_LOOP_FAILURES,
+            "finished": self.finished,
+            "exitcode": None if alive or not self.process else self.process.exitcode,
+        }
+
+
+class WorkerSupervisor:
+    """Runs each queue list in its own process, restarting children that crash.
+
+    The health reports the restarts of each child and flags as crash looping
+    the ones that crashed ``WORKER_CRASH_LOOP_FAILURES`` times in a row.
+
+    SIGTERM/SIGINT are forwarded to the children so they drain in-flight
+    messages before exiting; children still alive after
+    ``WORKER_SHUTDOWN_TIMEOUT`` seconds are killed.
+    """
+
+    def __init__(self, specs: list, target, target_kwargs: dict = None, process_factory=None):
+        self.workers = [WorkerProcess(index, queue_names, shards) for index, (queue_names, shards) in enumerate(specs)]
+        self.target = target
+        self.target_kwargs = target_kwargs or {}
+        self.process_factory = process_factory or multiprocessing.Process
+        self.stopping = False
+
+    def _spawn(self, worker: WorkerProcess):
+        kwargs = dict(self.target_kwargs)
+        if kwargs.get("metrics_port"):
+            # Each child serves its own /metrics on consecutive ports
+            kwargs["metrics_port"] += worker.index
+        if worker.shards is not None:
+            kwargs["shards"] = worker.shards
+        worker.process = self.process_factory(
+            target=self.target,
+            args=(",".join(worker.queue_names),),
+            kwargs=kwargs,
+            name=f"worker-{worker.index}",
+        )
+        worker.process.start()
+        worker.started_at = time.monotonic()
+        shards = f" (shards {', '.join(map(str, worker.shards))})" if worker.shards is not None else ""
+        logger.info(f"Started worker process {worker.index} (pid {worker.process.pid}) for queues: {', '.join(worker.queue_names)}{shards}")
+
+    def start(self):
+        for worker in self.workers:
+            self._spawn(worker)
+
+    def check_children(self):
+        """Restarts crashed children, backing off exponentially on crash loops.
+
+        A child that exits with code 0 stopped on purpose (e.g. it got the
+        shutdown signal before the supervisor did) and is not restarted.
+        """
+        now = time.monotonic()
+        for worker in self.workers:
+            if self.stopping or worker.process is None or worker.finished:
+                continue
+            if worker.process.is_alive():
+                if worker.consecutive_failures and now - worker.started_at >= settings.WORKER_RESTART_RESET_SECONDS:
+                    worker.consecutive_failures = 0
+                continue
+            if worker.process.exitcode == 0:
+                worker.finished = True
+                logger.info(f"Worker process {worker.index} exited cleanly. Not restarting it.")
+                continue
+            if not worker.restart_at:
+                delay = min(
+                    settings.WORKER_RESTART_BACKOFF_SECONDS * 2 ** worker.consecutive_failures,
+                    settings.WORKER_RESTART_BACKOFF_MAX_SECONDS,
+                )
+                worker.consecutive_failures += 1
+                worker.restart_at = now + delay
+                logger.warning(f"Worker process {worker.index} crashed with exit code {worker.process.exitcode}. Restarting in {delay:.1f}s.")
+            if now >= worker.restart_at:
+                worker.restart_at = 0.0
+                worker.restarts += 1
+                self._spawn(worker)
+        if not self.stopping and all(worker.finished for worker in self.workers):
+            logger.info("Every worker process exited cleanly. Stopping the supervisor.")
+            self.stopping = True
+
+    def health(self) -> dict:
+        processes = [worker.health() for worker in self.workers]
+        alive = sum(1 for p in processes if p["alive"])
+        crash_looping = sum(1 for p in processes if p["crash_looping"])
+        return {
+            "status": "ok" if alive == len(processes) and not crash_looping else "degraded",
+            "alive": alive,
+            "total": len(processes),
+            "restarts": sum(p["restarts"] for p in processes),
+            "crash_looping": crash_looping,
+            "processes": processes,
+        }
+
+    def stop(self, *_):
+        self.stopping = True
+
+    def shutdown(self):
+        for worker in self.workers:
+            if worker.process and worker.process.is_alive():
+                worker.process.terminate()
+        deadline = time.monotonic() + settings.WORKER_SHUTDOWN_TIMEOUT
+        for worker in self.workers:
+            if worker.process:
+                worker.process.join(max(deadline - time.monotonic(), 0))
+                if worker.process.is_alive():
+                    logger.warning(f"Worker process {worker.index} did not drain in time. Killing it.")
+                    worker.process.kill()
+                    worker.process.join()
+
+    def run(self, health_port: int = None):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        health_server = start_health_server(self, health_port) if health_port else None
+        self.start()
+        try:
+            while not self.stopping:
+                self.check_children()
+                time.sleep(0.5)
+        finally:
+            logger.info("Stopping worker processes.")
+            self.shutdown()
+            if health_server:
+                health_server.shutdown()
+
+
+def start_health_server(supervisor: WorkerSupervisor, port: int) -> ThreadingHTTPServer:
+    """Serves the aggregated health of every worker process at GET /health."""
+
+    class HealthHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/health":
+                self.send_error(404)
+                return
+            health = supervisor.health()
+            body = json.dumps(health).encode()
+            self.send_response(200 if health["status"] == "ok" else 503)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("0.0.0.0", port), HealthHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f"Supervisor health endpoint listening on port {port}.")
+    return server
@@ -1,86 +1,113 @@
 import random
 import asyncio
 import logging
-from app.core import storage
+from app.core import claim_check, metrics, storage
+from app.core.exceptions import ContentNotFoundError, ProviderError
+from app.services.dead_letters import build_dead_letter, record_failure
+from app.services.dispatcher import channel_queue, get_dispatcher
 from app.services.rabbitmq import RabbitMQService
+from app.services.retry import get_retry_attempt, schedule_retry
+from app.services.topology import publish_to_stage
 from app.core.config import settings
 
+# The traceId is bound to each record by the worker (app.core.log), not formatted into the messages
 logger = logging.getLogger(__name__)
 
-async def process_initial_notification(data: dict, rabbitmq_service: RabbitMQService):
+async def _set_status(trace_id: str, status: str) -> bool:
+    # Terminal statuses are never overwritten by late or redelivered messages
+    return await storage.set_status(trace_id, status, unless=storage.TERMINAL_STATUSES)
+
+async def _fail(data: dict, stage: str, status: str, reason: str, attempt: int = 1):
+    # The attempt history travels with the message, so the DLQ keeps why and where it failed
+    await _set_status(data.get("traceId"), status)
+    record_failure(data, stage, status, reason, attempt)
+
+async def _send_to_dlq(data: dict, rabbitmq_service: RabbitMQService, stage: str):
+    metrics.DLQ_MESSAGES.labels(stage).inc()
+    await rabbitmq_service.publish_message(
+        data,
+        settings.NOTIFICATION_DLQ,
+        exchange_name=f"{settings.NOTIFICATION_DLQ}_exchange"
+    )
+    logger.info("Mensagem enviada para DLQ: %s", settings.NOTIFICATION_DLQ)
+
+async def process_initial_notification(data: dict, rabbitmq_service: RabbitMQService, headers: dict = None):
     trace_id = data.get("traceId")
 
-    logger.info(f"[traceId: {trace_id}] Consumidor 1: Processador de Entrada - Iniciando processamento.")
-    storage.set_status(trace_id, "RECEBIDO")
+    logger.info("Consumidor 1: Processador de Entrada - Iniciando processamento.")
+    await _set_status(trace_id, "RECEBIDO")
 
     if random.random() < 0.15:
-        logger.warning(f"[traceId: {trace_id}] Consumidor 1: Falha simulada no processamento inicial.")
-        storage.set_status(trace_id, "FALHA_PROCESSAMENTO_INICIAL")
-        await rabbitmq_service.publish_message(
-            data,
-            settings.NOTIFICATION_RETRY_QUEUE,
-            exchange_name=f"{settings.NOTIFICATION_RETRY_QUEUE}_exchange"
-        )
-        logger.info(f"[traceId: {trace_id}] Mensagem enviada para fila de retry: {settings.NOTIFICATION_RETRY_QUEUE}")
+        logger.warning("Consumidor 1: Falha simulada no processamento inicial.")
+        await _fail(data, "process_initial_notification", "FALHA_PROCESSAMENTO_INICIAL", "Falha simulada no processamento inicial")
+        await schedule_retry(data, 1, rabbitmq_service)
+        logger.info("Mensagem agendada para retry (tentativa 1/%d).", settings.RETRY_MAX_ATTEMPTS)
     else:
-        logger.info(f"[traceId: {trace_id}] Consumidor 1: Processamento inicial bem-sucedido.")
-        await asyncio.sleep(random.uniform(1, 1.5))
-        storage.set_status(trace_id, "PROCESSADO_INTERMEDIARIO")
-        await rabbitmq_service.publish_message(
-            data,
-            settings.NOTIFICATION_VALIDATION_QUEUE,
-            exchange_name=f"{settings.NOTIFICATION_VALIDATION_QUEUE}_exchange"
-        )
-        logger.info(f"[traceId: {trace_id}] Mensagem enviada para fila de validação: {settings.NOTIFICATION_VALIDATION_QUEUE}")
+        logger.info("Consumidor 1: Processamento inicial bem-sucedido.")
+        await asyncio.sleep(random.uniform(1, 1.5) * settings.SIMULATED_LATENCY_SCALE)
+        await _set_status(trace_id, "PROCESSADO_INTERMEDIARIO")
+        await publish_to_stage(rabbitmq_service, data, settings.NOTIFICATION_VALIDATION_QUEUE)
+        logger.info("Mensagem enviada para fila de validação: %s", settings.NOTIFICATION_VALIDATION_QUEUE)
 
-async def process_retry_notification(data: dict, rabbitmq_service: RabbitMQService):
+async def process_retry_notification(data: dict, rabbitmq_service: RabbitMQService, headers: dict = None):
     trace_id = data.get("traceId")
-    logger.info(f"[traceId: {trace_id}] Consumidor 2: Processador de Retries - Iniciando reprocessamento.")
-    
-    await asyncio.sleep(3)
+    attempt = get_retry_attempt(headers)
+    logger.info("Consumidor 2: Processador de Retries - Iniciando reprocessamento (tentativa %d/%d).", attempt, settings.RETRY_MAX_ATTEMPTS)
 
+    # The backoff delay already happened in the broker's delay queue
     if random.random() < 0.20:
-        logger.warning(f"[traceId: {trace_id}] Consumidor 2: Falha simulada no reprocessamento.")
-        storage.set_status(trace_id, "FALHA_FINAL_REPROCESSAMENTO")
-        await rabbitmq_service.publish_message(
-            data,
-            settings.NOTIFICATION_DLQ,
-            exchange_name=f"{settings.NOTIFICATION_DLQ}_exchange"
-        )
-        logger.info(f"[traceId: {trace_id}] Mensagem enviada para DLQ: {settings.NOTIFICATION_DLQ}")
+        if attempt < settings.RETRY_MAX_ATTEMPTS:
+            logger.warning("Consumidor 2: Falha simulada no reprocessamento.")
+            await _fail(data, "process_retry_notification", "FALHA_REPROCESSAMENTO", "Falha simulada no reprocessamento", attempt)
+            await schedule_retry(data, attempt + 1, rabbitmq_service)
+            logger.info("Mensagem agendada para retry (tentativa %d/%d).", attempt + 1, settings.RETRY_MAX_ATTEMPTS)
+        else:
+            logger.warning("Consumidor 2: Falha simulada no reprocessamento. Tentativas esgotadas.")
+            await _fail(data, "process_retry_notification", "FALHA_FINAL_REPROCESSAMENTO", "Tentativas de reprocessamento esgotadas", attempt)
+            await _send_to_dlq(data, rabbitmq_service, "process_retry_notification")
     else:
-        logger.info(f"[traceId: {trace_id}] Consumidor 2: Reprocessamento bem-sucedido.")
-        storage.set_status(trace_id, "REPROCESSADO_COM_SUCESSO")
-        await rabbitmq_service.publish_message(
-            data,
-            settings.NOTIFICATION_VALIDATION_QUEUE,
-            exchange_name=f"{settings.NOTIFICATION_VALIDATION_QUEUE}_exchange"
-        )
-        logger.info(f"[traceId: {trace_id}] Mensagem enviada para fila de validação após retry: {settings.NOTIFICATION_VALIDATION_QUEUE}")
+        logger.info("Consumidor 2: Reprocessamento bem-sucedido.")
+        await _set_status(trace_id, "REPROCESSADO_COM_SUCESSO")
+        await publish_to_stage(rabbitmq_service, data, settings.NOTIFICATION_VALIDATION_QUEUE)
+        logger.info("Mensagem enviada para fila de validação após retry: %s", settings.NOTIFICATION_VALIDATION_QUEUE)
 
-async def process_final_notification(data: dict, rabbitmq_service: RabbitMQService):
+async def process_final_notification(data: dict, rabbitmq_service: RabbitMQService, headers: dict = None):
     trace_id = data.get("traceId")
     tipo_notificacao = data.get("channel")
-    logger.info(f"[traceId: {trace_id}] Consumidor 3: Processador de Validação/Envio Final - Iniciando envio para '{tipo_notificacao}'.")
-    storage.set_status(trace_id, "Validating/Sending")
+    logger.info("Consumidor 3: Processador de Validação - Encaminhando para o canal '%s'.", tipo_notificacao)
+    await _set_status(trace_id, "Validating/Sending")
+
+    if tipo_notificacao not in settings.ALLOWED_NOTIFICATION_TYPES:
+        logger.warning("Consumidor 3: Canal '%s' sem fila de envio.", tipo_notificacao)
+        await _fail(data, "process_final_notification", "FALHA_ENVIO_FINAL", f"Canal '{tipo_notificacao}' sem fila de envio")
+        await _send_to_dlq(data, rabbitmq_service, "process_final_notification")
+        return
 
-    await asyncio.sleep(random.uniform(0.5, 1))
+    queue_name = await publish_to_stage(rabbitmq_service, data, channel_queue(tipo_notificacao))
+    logger.info("Mensagem enviada para fila de envio: %s", queue_name)
+
+async def process_channel_notification(data: dict, rabbitmq_service: RabbitMQService, headers: dict = None):
+    trace_id = data.get("traceId")
+    tipo_notificacao = data.get("channel")
+    logger.info("Consumidor 5: Despachante '%s' - Enviando ao provedor.", tipo_notificacao)
 
-    if random.random() < 0.05:
-        logger.warning(f"[traceId: {trace_id}] Consumidor 3: Falha simulada no envio final para '{tipo_notificacao}'.")
-        storage.set_status(trace_id, "FALHA_ENVIO_FINAL")
-        await rabbitmq_service.publish_message(
-            data,
-            settings.NOTIFICATION_DLQ,
-            exchange_name=f"{settings.NOTIFICATION_DLQ}_exchange"
-        )
-        logger.info(f"[traceId: {trace_id}] Mensagem enviada para DLQ: {settings.NOTIFICATION_DLQ}")
+    try:
+        # Claim-checked contents are only fetched here, right before the provider needs them
+        await get_dispatcher(tipo_notificacao).send(await claim_check.check_out(data))
+    except (ProviderError, ContentNotFoundError) as e:
+        logger.warning("Consumidor 5: Falha no envio final para '%s': %s", tipo_notificacao, e)
+        await _fail(data, "process_channel_notification", "FALHA_ENVIO_FINAL", str(e))
+        await _send_to_dlq(data, rabbitmq_service, "process_channel_notification")
     else:
-        logger.info(f"[traceId: {trace_id}] Consumidor 3: Envio final para '{tipo_notificacao}' bem-sucedido.")
-        storage.set_status(trace_id, "ENVIADO_SUCESSO")
+        logger.info("Consumidor 5: Envio final para '%s' bem-sucedido.", tipo_notificacao)
+        if await _set_status(trace_id, "ENVIADO_SUCESSO"):
+            metrics.observe_end_to_end(data, "ENVIADO_SUCESSO")
 
-async def process_dlq_message(data: dict, rabbitmq_service: RabbitMQService):
+async def process_dlq_message(data: dict, rabbitmq_service: RabbitMQService, headers: dict = None):
     trace_id = data.get("traceId")
-    logger.error(f"[traceId: {trace_id}] Consumidor 4: Dead Letter Queue (DLQ) - Mensagem recebida na DLQ. Não será mais processada.")
-    logger.error(f"DLQ Message Details: {data}")
-    storage.set_status(trace_id, "DLQ_RECEIVED")
+    dead_letter = build_dead_letter(data)
+    logger.error("Consumidor 4: Dead Letter Queue (DLQ) - Mensagem recebida na DLQ: %s (etapa %s).", dead_letter['motivo'], dead_letter['etapa'])
+    # Kept with its failure reason and attempt history, for inspection and replay (app.dlq)
+    await storage.store_dead_letter(trace_id, dead_letter, claim_check.referenced_contents(data))
+    if await _set_status(trace_id, "DLQ_RECEIVED"):
+        metrics.observe_end_to_end(data, "DLQ_RECEIVED")
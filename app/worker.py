@@ -1,11 +1,32 @@
 import asyncio
 import logging
-import json
 import argparse
-from aio_pika import IncomingMessage, ExchangeType
+import signal
+import sys
+import time
+from typing import Optional
+from aio_pika import IncomingMessage
+from app.services.fused import FusedRabbitMQService
 from app.services.rabbitmq import RabbitMQService
-from app.tasks.message_tasks import process_initial_notification, process_retry_notification, process_final_notification, process_dlq_message
+from app.services.retry import declare_retry_topology, get_retry_attempt
+from app.services.dead_letters import REPLAYS_KEY
+from app.services.dispatcher import channel_queue, close_dispatchers
+from app.services.topology import check_shards, declare_stage, shard_queues
+from app.tasks.message_tasks import (
+    process_initial_notification,
+    process_retry_notification,
+    process_final_notification,
+    process_channel_notification,
+    process_dlq_message,
+)
+from app.core import metrics, storage
+from app.core.codec import codec_for_content_type
+from app.core.dedup import processed_set
+from app.core.log import bind_trace_id, configure_logging, reset_trace_id
+from app.core.priority import WeightedFairLimiter, stage_lanes
+from app.core.exceptions import PublishNackError
 from app.core.config import settings
+from app.supervisor import WorkerSupervisor, build_process_specs
 
 logger = logging.getLogger(__name__)
 
@@ -15,33 +36,231 @@ TASK_FUNCTIONS = {
     settings.NOTIFICATION_RETRY_QUEUE: process_retry_notification,
     settings.NOTIFICATION_VALIDATION_QUEUE: process_final_notification,
     settings.NOTIFICATION_DLQ: process_dlq_message,
+    # One dispatch queue per channel, so a slow or throttled provider does not hold the others back
+    **{channel_queue(channel): process_channel_notification for channel in settings.ALLOWED_NOTIFICATION_TYPES},
 }
 
+def delivery_step(task_func, headers: dict, data: dict = None) -> str:
+    """Identifies a delivery within a traceId: the stage, the retry attempt and, after a DLQ replay, the replay."""
+    step = f"{task_func.__name__}:{get_retry_attempt(headers)}"
+    replays = (data or {}).get(REPLAYS_KEY)
+    return f"{step}:r{replays}" if replays else step
+
 async def process_message(message: IncomingMessage, task_func, rabbitmq_service: RabbitMQService):
-    async with message.process():
+    stage = metrics.stage_metrics(task_func.__name__)
+    stage.in_flight.inc()
+    started = time.perf_counter()
+    outcome = stage.success
+    trace_token = None
+    try:
+        async with message.process(ignore_processed=True):
+            try:
+                # Decode by the declared content type so producers on another codec interoperate
+                data = codec_for_content_type(message.content_type).decode(message.body)
+                # Every record logged while handling the message carries its traceId
+                trace_token = bind_trace_id(data.get("traceId"))
+                headers = dict(message.headers or {})
+                trace_id = data.get("traceId") if settings.WORKER_DEDUP_ENABLED else None
+                step = delivery_step(task_func, headers, data)
+                if trace_id and await processed_set.contains(trace_id, step):
+                    # Already finished (redelivery or duplicate publish): ack without side effects
+                    outcome = stage.duplicate
+                    logger.info("Skipping message already processed by %s", task_func.__name__)
+                    return
+                await task_func(data, rabbitmq_service, headers=headers)
+                logger.info("Message processed successfully by %s", task_func.__name__)
+                if trace_id:
+                    try:
+                        await processed_set.add(trace_id, step)
+                    except Exception as e:
+                        logger.warning("Could not mark message processed by %s: %s", task_func.__name__, e)
+            except PublishNackError as e:
+                # The next hop was not confirmed: requeue instead of acking so the message is not lost
+                outcome = stage.requeued
+                logger.error("Error processing message for %s, requeueing: %s", task_func.__name__, e)
+                await message.nack(requeue=True)
+            except Exception as e:
+                outcome = stage.error
+                logger.error("Error processing message for %s: %s", task_func.__name__, e, exc_info=True)
+    finally:
+        if trace_token is not None:
+            reset_trace_id(trace_token)
+        stage.duration.observe(time.perf_counter() - started)
+        stage.in_flight.dec()
+        outcome.inc()
+
+def limit_concurrency(handler, max_concurrency: int):
+    """Caps how many messages of a queue are handled at the same time."""
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def limited_handler(message: IncomingMessage):
+        async with semaphore:
+            await handler(message)
+
+    return limited_handler
+
+def stage_limiter(queue_name: str, max_concurrency: int) -> WeightedFairLimiter:
+    """Returns a limiter sharing the ``max_concurrency`` slots of a stage between its priority lanes."""
+    weights = {priority: settings.PRIORITY_LANE_WEIGHTS.get(priority, 1) for priority in stage_lanes(queue_name)}
+    return WeightedFairLimiter(max_concurrency, weights, queue_name)
+
+def stage_handlers(queue_name: str, handler, max_concurrency: int, limiter: Optional[WeightedFairLimiter] = None) -> dict:
+    """Returns the concurrency-limited handler of each priority lane queue of a stage.
+
+    The lanes of a stage share its ``max_concurrency`` slots, handed out by
+    PRIORITY_LANE_WEIGHTS when more than one lane has messages waiting. Pass
+    ``limiter`` to share the slots with the stage's fused lanes too.
+    """
+    lanes = stage_lanes(queue_name)
+    if limiter is None and len(lanes) == 1:
+        return {queue_name: limit_concurrency(handler, max_concurrency)}
+    limiter = limiter or stage_limiter(queue_name, max_concurrency)
+    return {lane: limiter.wrap(priority, handler) for priority, lane in lanes.items()}
+
+class InFlightTracker:
+    """Keeps track of running message handlers so shutdown can wait for them."""
+
+    def __init__(self):
+        self.tasks = set()
+
+    def wrap(self, handler):
+        async def tracked_handler(message: IncomingMessage):
+            task = asyncio.current_task()
+            self.tasks.add(task)
+            try:
+                await handler(message)
+            finally:
+                self.tasks.discard(task)
+
+        return tracked_handler
+
+    async def drain(self, timeout: float) -> int:
+        """Waits for in-flight handlers; returns how many were still running at the timeout."""
+        if not self.tasks:
+            return 0
+        _, pending = await asyncio.wait(set(self.tasks), timeout=timeout)
+        return len(pending)
+
+def resolve_consumer_limits(
+    queue_name: str,
+    prefetch: int = None,
+    concurrency: int = None,
+    queue_prefetch: dict = None,
+    queue_concurrency: dict = None,
+) -> tuple:
+    """Returns (prefetch_count, max_concurrency) for a queue.
+
+    Per-queue CLI overrides win over the CLI defaults, which win over the
+    per-queue settings, which win over the global settings defaults. An
+    explicit 0 is a value, not a fallback: a prefetch of 0 is unlimited.
+    Channel queues default to at least DISPATCH_BATCH_SIZE of both, since
+    each send holds a handler until its provider batch goes out.
+    """
+    queue_prefetch = queue_prefetch or {}
+    queue_concurrency = queue_concurrency or {}
+    default_prefetch, default_concurrency = settings.WORKER_DEFAULT_PREFETCH, settings.WORKER_DEFAULT_CONCURRENCY
+    is_channel_queue = queue_name.startswith(settings.NOTIFICATION_CHANNEL_QUEUE_PREFIX)
+    if is_channel_queue:
+        default_concurrency = max(default_concurrency, settings.DISPATCH_BATCH_SIZE)
+        if default_prefetch:
+            default_prefetch = max(default_prefetch, settings.DISPATCH_BATCH_SIZE)
+    prefetch_count = _first_set(
+        queue_prefetch.get(queue_name), prefetch, settings.WORKER_QUEUE_PREFETCH.get(queue_name), default_prefetch
+    )
+    max_concurrency = _first_set(
+        queue_concurrency.get(queue_name), concurrency, settings.WORKER_QUEUE_CONCURRENCY.get(queue_name), default_concurrency
+    )
+    if max_concurrency < 1:
+        raise ValueError(f"Concurrency of {queue_name} must be at least 1, got {max_concurrency}.")
+    in_flight = min(max_concurrency, prefetch_count or max_concurrency)
+    if is_channel_queue and in_flight < settings.DISPATCH_BATCH_SIZE:
+        logger.warning(
+            f"{queue_name} takes at most {in_flight} sends at a time, fewer than "
+            f"DISPATCH_BATCH_SIZE={settings.DISPATCH_BATCH_SIZE}: its provider batches never fill and each waits DISPATCH_BATCH_WAIT_MS."
+        )
+    return prefetch_count, max_concurrency
+
+def _first_set(*values):
+    return next((value for value in values if value is not None), None)
+
+def parse_queue_overrides(values: list) -> dict:
+    overrides = {}
+    for value in values or []:
+        queue_name, sep, number = value.rpartition('=')
+        if not sep or not queue_name:
+            raise argparse.ArgumentTypeError(f"Expected QUEUE=N, got '{value}'.")
+        overrides[queue_name] = int(number)
+    return overrides
+
+def parse_shards(value: str) -> list:
+    """Parses shard numbers like "0,2,4-7"."""
+    shards = []
+    for part in (value or "").split(','):
+        part = part.strip()
+        if not part:
+            continue
+        first, sep, last = part.partition('-')
         try:
-            data = json.loads(message.body.decode())
-            await task_func(data, rabbitmq_service)
-            logger.info(f"Message processed successfully by {task_func.__name__}")
-        except Exception as e:
-            logger.error(f"Error processing message for {task_func.__name__}: {e}", exc_info=True)
-
-async def main(queue_names_str: str):
-    logging.basicConfig(level=logging.INFO)
+            shards.extend(range(int(first), int(last) + 1) if sep else [int(first)])
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"Expected shard numbers like 0,2,4-7, got '{value}'.")
+    return shards
+
+async def main(
+    queue_names_str: str,
+    prefetch: int = None,
+    concurrency: int = None,
+    queue_prefetch: dict = None,
+    queue_concurrency: dict = None,
+    metrics_port: int = None,
+    fused: bool = None,
+    shards: list = None,
+):
+    configure_logging()
     
     queue_names = [q.strip() for q in queue_names_str.split(',') if q.strip()]
     if not queue_names:
         logger.error("No queues specified to consume from.")
         return
+    if shards is None:
+        shards = settings.WORKER_SHARDS
+    check_shards([q for q in queue_names if q in TASK_FUNCTIONS], shards)
 
     logger.info(f"Starting aio-pika worker(s) for queues: {', '.join(queue_names)}")
 
     rabbitmq_service = RabbitMQService()
+    fused_service = None
+    in_flight = InFlightTracker()
+    metrics_server = metrics.start_metrics_server(metrics_port) if metrics_port else None
+
+    # SIGTERM (e.g. forwarded by the supervisor) stops consuming and drains in-flight messages
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except (NotImplementedError, RuntimeError):
+            pass
 
     try:
         await rabbitmq_service.connect()
         logger.info("Connected to RabbitMQ.")
 
+        # Stages schedule delayed retries through the broker's delay queues
+        await declare_retry_topology(rabbitmq_service)
+
+        if settings.STATUS_WRITE_BEHIND_ENABLED:
+            storage.start_write_behind()
+            logger.info("Write-behind batching of status updates enabled.")
+
+        # Stages receive the fused proxy, so hand-offs between stages hosted here skip the broker
+        if fused is None:
+            fused = settings.WORKER_FUSED_STAGES
+        if fused:
+            fused_service = FusedRabbitMQService(rabbitmq_service, settings.WORKER_FUSED_QUEUE_SIZE)
+            logger.info("Fused mode enabled for the stages hosted by this worker.")
+        task_service = fused_service or rabbitmq_service
+
         consumer_tasks = []
         for queue_name in queue_names:
             if queue_name not in TASK_FUNCTIONS:
@@ -50,42 +269,104 @@ async def main(queue_names_str: str):
 
             task_func = TASK_FUNCTIONS[queue_name]
             
-            exchange_name = f"{queue_name}_exchange"
-            await rabbitmq_service.declare_exchange(exchange_name, ExchangeType.DIRECT, durable=True)
-            await rabbitmq_service.declare_queue(queue_name, durable=True)
-            await rabbitmq_service.bind_queue(queue_name, exchange_name, routing_key=queue_name)
-            logger.info(f"Exchange '{exchange_name}' and queue '{queue_name}' declared and bound.")
-
-            consumer_task = asyncio.create_task(
-                rabbitmq_service.start_consumer(
-                    queue_name,
-                    lambda msg, tf=task_func: process_message(msg, tf, rabbitmq_service)
-                )
+            # Latency-sensitive stages are consumed from one queue per priority lane
+            lanes = await declare_stage(rabbitmq_service, queue_name)
+            logger.info(f"Exchanges and queues declared and bound for: {', '.join(lanes)}")
+
+            prefetch_count, max_concurrency = resolve_consumer_limits(
+                queue_name, prefetch, concurrency, queue_prefetch, queue_concurrency
+            )
+            # Fused lanes take their slots from the same limiter as the stage's broker deliveries
+            limiter = stage_limiter(queue_name, max_concurrency) if fused_service else None
+            handlers = stage_handlers(
+                queue_name,
+                lambda msg, tf=task_func: process_message(msg, tf, task_service),
+                max_concurrency,
+                limiter,
             )
-            consumer_tasks.append(consumer_task)
-            logger.info(f"Consumer started for queue: {queue_name}")
+            for priority, lane in stage_lanes(queue_name).items():
+                handler = handlers[lane]
+                if fused_service:
+                    fused_service.add_stage(lane, task_func, max_concurrency, limiter, priority)
+                # Sharded lanes are consumed from the claimed shards, which share the lane's handler slots
+                for consumed_queue in shard_queues(lane, shards):
+                    consumer_task = asyncio.create_task(
+                        rabbitmq_service.start_consumer(consumed_queue, in_flight.wrap(handler), prefetch_count=prefetch_count)
+                    )
+                    consumer_tasks.append(consumer_task)
+                    logger.info(f"Consumer started for queue: {consumed_queue} (prefetch={prefetch_count}, concurrency={max_concurrency})")
 
         if not consumer_tasks:
             logger.warning("No valid queues found to start consumers for. Exiting worker.")
             return
 
-        await asyncio.Future()
+        await stop_event.wait()
+        logger.info("Shutdown requested. Draining in-flight messages.")
+        await rabbitmq_service.stop_consumers()
+        still_running = await in_flight.drain(settings.WORKER_SHUTDOWN_TIMEOUT)
+        if still_running:
+            logger.warning(f"{still_running} message(s) still in flight after {settings.WORKER_SHUTDOWN_TIMEOUT}s; they will be redelivered.")
 
     except asyncio.CancelledError:
         logger.info("Worker stopped by cancellation.")
     except Exception as e:
         logger.error(f"Worker encountered an error: {e}", exc_info=True)
+        raise
     finally:
+        if fused_service:
+            await fused_service.close()
+        await close_dispatchers()
         if rabbitmq_service:
             await rabbitmq_service.close()
             logger.info("RabbitMQ connection closed.")
+        await storage.close()
+        if metrics_server:
+            metrics_server.shutdown()
+
+def run_worker(queue_names_str: str, **kwargs):
+    """Entry point of a worker process started by the supervisor."""
+    try:
+        asyncio.run(main(queue_names_str, **kwargs))
+    except KeyboardInterrupt:
+        logger.info("Worker stopped manually.")
+    except Exception:
+        # Already logged by main; a non-zero exit code tells the supervisor the process crashed
+        sys.exit(1)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Run aio-pika worker for specified queues.")
     parser.add_argument("--queue", required=True, help="Comma-separated list of queue names to consume messages from.")
+    parser.add_argument("--prefetch", type=int, help="Prefetch count (QoS) for every queue.")
+    parser.add_argument("--concurrency", type=int, help="Max concurrent handlers for every queue.")
+    parser.add_argument("--queue-prefetch", action="append", metavar="QUEUE=N", help="Prefetch count for a single queue. Can be repeated.")
+    parser.add_argument("--queue-concurrency", action="append", metavar="QUEUE=N", help="Max concurrent handlers for a single queue. Can be repeated.")
+    parser.add_argument("--processes", type=int, default=1, help="Number of worker processes consuming the queues.")
+    parser.add_argument("--queue-processes", action="append", metavar="QUEUE=N", help="Dedicated worker processes for a single queue. Can be repeated.")
+    parser.add_argument("--health-port", type=int, default=settings.WORKER_HEALTH_PORT, help="Port of the supervisor's aggregated health endpoint.")
+    parser.add_argument("--fused", action="store_true", default=None, help="Hand messages between the stages hosted by a worker over in memory.")
+    parser.add_argument("--shards", type=parse_shards, help="Shards of the sharded queues to consume, e.g. 0,2,4-7 (default: all).")
+    parser.add_argument("--metrics-port", type=int, default=settings.WORKER_METRICS_PORT, help="Port of the worker's /metrics endpoint (each extra process uses the next port).")
     args = parser.parse_args()
 
-    try:
-        asyncio.run(main(args.queue))
-    except KeyboardInterrupt:
-        logger.info("Worker stopped manually.")
+    worker_kwargs = dict(
+        prefetch=args.prefetch,
+        concurrency=args.concurrency,
+        queue_prefetch=parse_queue_overrides(args.queue_prefetch),
+        queue_concurrency=parse_queue_overrides(args.queue_concurrency),
+        metrics_port=args.metrics_port,
+        fused=args.fused,
+        shards=args.shards,
+    )
+    queue_processes = parse_queue_overrides(args.queue_processes)
+
+    if args.processes > 1 or queue_processes:
+        configure_logging()
+        queue_names = [q.strip() for q in args.queue.split(',') if q.strip()]
+        shards = args.shards if args.shards is not None else settings.WORKER_SHARDS
+        try:
+            specs = build_process_specs(queue_names, args.processes, queue_processes, shards)
+        except ValueError as e:
+            parser.error(str(e))
+        WorkerSupervisor(specs, run_worker, worker_kwargs).run(health_port=args.health_port)
+    else:
+        run_worker(args.queue, **worker_kwargs)
@@ -1,45 +1,76 @@
-from fastapi.testclient import TestClient
+import httpx
 import uuid
 import pytest
+import pytest_asyncio
 
 from app.main import app
+from unittest.mock import AsyncMock
 from app.core import storage
+from app.core.config import settings
+from app.core.exceptions import PublishNackError
+from app.services.backpressure import backpressure
+from app.services.dispatcher import channel_queue
+from app.services.memory_broker import InMemoryRabbitMQService
+from app.services.topology import declare_stage, publish_to_stage
 
-@pytest.fixture(autouse=True)
-def clear_storage_before_each_test():
-    """Garante que o armazenamento em memória esteja limpo antes de cada teste."""
-    storage.clear_storage()
+@pytest_asyncio.fixture(autouse=True)
+async def clear_storage_before_each_test():
+    """Garante que o armazenamento esteja limpo antes de cada teste."""
+    await storage.clear_storage()
     yield
+    # O pool de conexões pertence ao event loop do teste
+    await storage.close()
 
-client = TestClient(app)
+@pytest_asyncio.fixture
+async def client():
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://testserver") as client:
+        yield client
 
-def test_health_check():
-    response = client.get("/health")
+@pytest.mark.asyncio
+async def test_health_check(client):
+    response = await client.get("/health")
     assert response.status_code == 200
     assert response.json() == {"status": "ok"}
 
-def test_create_notification_success(mocker):
+@pytest.mark.asyncio
+async def test_create_notification_success(client, mocker):
     notification_data = {
         "conteudoMensagem": "Olá Mundo!",
         "tipoNotificacao": "email"
     }
 
     mock_publish = mocker.patch('app.services.rabbitmq.RabbitMQService.publish_message')
-    response = client.post("/api/notificar", json=notification_data)
+    response = await client.post("/api/notificar", json=notification_data)
 
     assert response.status_code == 202
     response_json = response.json()
     trace_id = response_json["traceId"]
     mensagem_id = response_json["mensagemId"]
 
-    stored_data = storage.get_notification(str(trace_id))
+    stored_data = await storage.get_notification(str(trace_id))
     assert stored_data["status"] == "RECEBIDO"
     assert str(stored_data["mensagemId"]) == str(mensagem_id)
     assert stored_data["conteudoMensagem"] == notification_data["conteudoMensagem"]
     assert stored_data["channel"] == notification_data["tipoNotificacao"]
     mock_publish.assert_called_once()
 
-def test_get_notification_status():
+@pytest.mark.asyncio
+async def test_create_notification_high_priority_uses_its_lane(client, mocker):
+    """Testa que a prioridade alta é publicada na faixa alta da fila de entrada e armazenada."""
+    mock_publish = mocker.patch('app.services.rabbitmq.RabbitMQService.publish_message')
+    response = await client.post(
+        "/api/notificar",
+        json={"conteudoMensagem": "Código 123456", "tipoNotificacao": "sms", "prioridade": "alta"},
+    )
+
+    assert response.status_code == 202
+    assert mock_publish.call_args.kwargs["routing_key"] == "fila.notificacao.entrada.alta"
+    stored_data = await storage.get_notification(response.json()["traceId"])
+    assert stored_data["prioridade"] == "alta"
+
+@pytest.mark.asyncio
+async def test_get_notification_status(client):
     trace_id = uuid.uuid4()
     data = {
         "mensagemId": str(uuid.uuid4()),
@@ -48,9 +79,9 @@ def test_get_notification_status():
         "status": "Sent",
         "traceId": str(trace_id) # Add traceId to the stored data
     }
-    storage.set_notification(str(trace_id), data)
+    await storage.set_notification(str(trace_id), data)
 
-    response = client.get(f"/api/notificacao/status/{trace_id}")
+    response = await client.get(f"/api/notificacao/status/{trace_id}")
 
     assert response.status_code == 200
     assert response.json() == {
@@ -58,49 +89,65 @@ def test_get_notification_status():
         "mensagemId": str(data["mensagemId"]),
         "conteudoMensagem": data["conteudoMensagem"],
         "tipoNotificacao": data["tipoNotificacao"],
+        "prioridade": "normal",
         "status": data["status"]
     }
 
-def test_get_notification_status_not_found():
+@pytest.mark.asyncio
+async def test_get_notification_status_not_found(client):
     non_existent_id = str(uuid.uuid4())
-    response = client.get(f"/api/notificacao/status/{non_existent_id}")
+    response = await client.get(f"/api/notificacao/status/{non_existent_id}")
 
     assert response.status_code == 404
     assert response.json() == {"detail": "Notification not found"}
 
-def test_create_notification_invalid_data():
+@pytest.mark.asyncio
+async def test_get_notification_status_does_not_read_auxiliary_keys(client, mocker):
+    """Testa que nomes de chaves auxiliares (idempotência, DLQ) usados como traceId retornam 404."""
+    mocker.patch('app.services.rabbitmq.RabbitMQService.publish_message', new_callable=AsyncMock)
+    created = (await client.post("/api/notificar", json={"conteudoMensagem": "Oi", "tipoNotificacao": "email"})).json()
+    await storage.store_dead_letter(created["traceId"], {"traceId": created["traceId"], "registradoEm": 1.0})
+
+    for trace_id in (f"mensagem:{created['mensagemId']}", f"dlq:{created['traceId']}", "idx:pares"):
+        response = await client.get(f"/api/notificacao/status/{trace_id}")
+        assert response.status_code == 404
+
+@pytest.mark.asyncio
+async def test_create_notification_invalid_data(client):
     invalid_data = {
         "conteudoMensagem": "Olá Mundo!"
         # Missing "tipoNotificacao"
     }
-    response = client.post("/api/notificar", json=invalid_data)
+    response = await client.post("/api/notificar", json=invalid_data)
     assert response.status_code == 422 # Unprocessable Entity for validation errors
 
     invalid_type_data = {
         "conteudoMensagem": 123, # Invalid type
         "tipoNotificacao": "email"
     }
-    response = client.post("/api/notificar", json=invalid_type_data)
+    response = await client.post("/api/notificar", json=invalid_type_data)
     assert response.status_code == 422
 
-def test_create_notification_unsupported_type(mocker):
+@pytest.mark.asyncio
+async def test_create_notification_unsupported_type(client, mocker):
     notification_data = {
         "conteudoMensagem": "Olá Mundo!",
         "tipoNotificacao": "unsupported_type"
     }
     mock_publish = mocker.patch('app.services.rabbitmq.RabbitMQService.publish_message')
-    response = client.post("/api/notificar", json=notification_data)
+    response = await client.post("/api/notificar", json=notification_data)
     assert response.status_code == 400 # Bad Request for unsupported type
     assert "Unsupported notification type" in response.json()["detail"]
     mock_publish.assert_not_called()
 
-def test_create_notification_publish_error(mocker):
+@pytest.mark.asyncio
+async def test_create_notification_publish_error(client, mocker):
     notification_data = {
         "conteudoMensagem": "Olá Mundo!",
         "tipoNotificacao": "email"
     }
     mocker.patch('app.services.rabbitmq.RabbitMQService.publish_message', side_effect=Exception("RabbitMQ error"))
-    response = client.post("/api/notificar", json=notification_data)
+    response = await client.post("/api/notificar", json=notification_data)
 
     assert response.status_code == 500 # Internal Server Error
     assert response.json() == {"detail": "Internal server error"}
@@ -108,5 +155,267 @@ def test_create_notification_publish_error(mocker):
     response_json = response.json()
     trace_id = response_json.get("traceId")
     if trace_id:
-        stored_data = storage.get_notification(str(trace_id))
+        stored_data = await storage.get_notification(str(trace_id))
         assert stored_data["status"] == "FALHA_ENVIO"
+
+@pytest.mark.asyncio
+async def test_create_notification_not_confirmed(client, mocker):
+    """Testa que um nack do broker é exposto como 503 e marca FALHA_ENVIO."""
+    mocker.patch('app.services.rabbitmq.RabbitMQService.publish_message', side_effect=PublishNackError("nack"))
+    mock_set_status = mocker.patch('app.api.endpoints.messages.storage.set_status', new_callable=AsyncMock)
+
+    response = await client.post("/api/notificar", json={"conteudoMensagem": "Olá", "tipoNotificacao": "email"})
+
+    assert response.status_code == 503
+    assert mock_set_status.await_args.args[1] == "FALHA_ENVIO"
+
+@pytest.mark.asyncio
+async def test_create_notification_reuses_shared_publisher(client, mocker):
+    notification_data = {
+        "conteudoMensagem": "Olá Mundo!",
+        "tipoNotificacao": "sms"
+    }
+    mock_publish = mocker.patch('app.services.rabbitmq.RabbitMQService.publish_message', autospec=True)
+    await client.post("/api/notificar", json=notification_data)
+    await client.post("/api/notificar", json=notification_data)
+
+    assert mock_publish.call_count == 2
+    services = {id(call.args[0]) for call in mock_publish.call_args_list}
+    assert len(services) == 1
+
+@pytest.mark.asyncio
+async def test_create_notification_batch(client, mocker):
+    """Testa o lote com itens válidos e inválidos, com erros por item."""
+    mock_publish = mocker.patch('app.services.rabbitmq.RabbitMQService.publish_messages', return_value=[None, None])
+    batch = [
+        {"conteudoMensagem": "Um", "tipoNotificacao": "email"},
+        {"conteudoMensagem": "Dois"},
+        {"conteudoMensagem": "Três", "tipoNotificacao": "fax"},
+        {"conteudoMensagem": "Quatro", "tipoNotificacao": "sms"},
+    ]
+
+    response = await client.post("/api/notificar/lote", json=batch)
+
+    assert response.status_code == 202
+    body = response.json()
+    assert body["accepted"] == 2
+    assert body["rejected"] == 2
+    results = body["results"]
+    assert [r["index"] for r in results] == [0, 1, 2, 3]
+    assert "tipoNotificacao" in results[1]["error"]
+    assert "Unsupported notification type" in results[2]["error"]
+    mock_publish.assert_called_once()
+    assert len(mock_publish.call_args.args[0]) == 2
+    for result in (results[0], results[3]):
+        stored = await storage.get_notification(result["traceId"])
+        assert stored["status"] == "RECEBIDO"
+
+@pytest.mark.asyncio
+async def test_create_notification_batch_ndjson_with_publish_failure(client, mocker):
+    """Testa o lote em NDJSON e a marcação de falha de publicação por item."""
+    mocker.patch('app.services.rabbitmq.RabbitMQService.publish_messages', return_value=[None, Exception("nack")])
+    body = (
+        b'{"conteudoMensagem": "Um", "tipoNotificacao": "push"}\n'
+        b'not json\n'
+        b'{"conteudoMensagem": "Dois", "tipoNotificacao": "push"}\n'
+    )
+
+    response = await client.post("/api/notificar/lote", content=body, headers={"Content-Type": "application/x-ndjson"})
+
+    assert response.status_code == 202
+    results = response.json()["results"]
+    assert results[0]["error"] is None
+    assert results[1]["error"] == "Invalid JSON"
+    assert results[2]["error"] == "Failed to publish notification"
+    stored = await storage.get_notification(results[2]["traceId"])
+    assert stored["status"] == "FALHA_ENVIO"
+
+@pytest.mark.asyncio
+async def test_create_notification_is_idempotent_by_mensagem_id(client, mocker):
+    """Testa que o reenvio do mesmo mensagemId devolve o traceId original sem publicar de novo."""
+    mock_publish = mocker.patch('app.services.rabbitmq.RabbitMQService.publish_message', new_callable=AsyncMock)
+    notification_data = {"mensagemId": str(uuid.uuid4()), "conteudoMensagem": "Uma vez", "tipoNotificacao": "email"}
+
+    first = await client.post("/api/notificar", json=notification_data)
+    second = await client.post("/api/notificar", json=notification_data)
+
+    assert first.status_code == second.status_code == 202
+    assert second.json()["traceId"] == first.json()["traceId"]
+    mock_publish.assert_awaited_once()
+
+@pytest.mark.asyncio
+async def test_create_notification_retry_after_publish_failure_is_published(client, mocker):
+    """Testa que um mensagemId cuja publicação falhou pode ser reenviado pelo cliente."""
+    mock_publish = mocker.patch('app.services.rabbitmq.RabbitMQService.publish_message', side_effect=[PublishNackError("nack"), None])
+    notification_data = {"mensagemId": str(uuid.uuid4()), "conteudoMensagem": "De novo", "tipoNotificacao": "sms"}
+
+    assert (await client.post("/api/notificar", json=notification_data)).status_code == 503
+    response = await client.post("/api/notificar", json=notification_data)
+
+    assert response.status_code == 202
+    assert mock_publish.call_count == 2
+    assert (await storage.get_notification(response.json()["traceId"]))["status"] == "RECEBIDO"
+
+@pytest.mark.asyncio
+async def test_create_notification_releases_mensagem_id_when_storing_fails(client, mocker):
+    """Testa que, se a gravação do registro falhar, o mensagemId é liberado e o reenvio do cliente é aceito."""
+    mock_publish = mocker.patch('app.services.rabbitmq.RabbitMQService.publish_message')
+    set_notification = storage.set_notification
+    calls = []
+
+    async def failing_once(trace_id, data):
+        calls.append(trace_id)
+        if len(calls) == 1:
+            raise ConnectionError("Redis indisponível")
+        await set_notification(trace_id, data)
+
+    mocker.patch.object(storage, "set_notification", side_effect=failing_once)
+    notification_data = {"mensagemId": str(uuid.uuid4()), "conteudoMensagem": "De novo", "tipoNotificacao": "email"}
+
+    assert (await client.post("/api/notificar", json=notification_data)).status_code == 500
+    mock_publish.assert_not_called()
+    response = await client.post("/api/notificar", json=notification_data)
+
+    assert response.status_code == 202
+    mock_publish.assert_called_once()
+    assert (await storage.get_notification(response.json()["traceId"]))["status"] == "RECEBIDO"
+
+@pytest.mark.asyncio
+async def test_create_notification_batch_deduplicates_mensagem_ids(client, mocker):
+    """Testa que mensagemIds repetidos no lote ou já recebidos não são publicados de novo."""
+    mocker.patch('app.services.rabbitmq.RabbitMQService.publish_message', new_callable=AsyncMock)
+    mock_publish = mocker.patch('app.services.rabbitmq.RabbitMQService.publish_messages', return_value=[None])
+    known_id, new_id = str(uuid.uuid4()), str(uuid.uuid4())
+    known = await client.post("/api/notificar", json={"mensagemId": known_id, "conteudoMensagem": "Já", "tipoNotificacao": "email"})
+    batch = [
+        {"mensagemId": known_id, "conteudoMensagem": "Já", "tipoNotificacao": "email"},
+        {"mensagemId": new_id, "conteudoMensagem": "Nova", "tipoNotificacao": "push"},
+        {"mensagemId": new_id, "conteudoMensagem": "Nova", "tipoNotificacao": "push"},
+    ]
+
+    response = await client.post("/api/notificar/lote", json=batch)
+
+    results = response.json()["results"]
+    assert results[0]["traceId"] == known.json()["traceId"]
+    assert results[2]["traceId"] == results[1]["traceId"]
+    assert all(result["error"] is None for result in results)
+    assert [data["mensagemId"] for data in mock_publish.call_args.args[0]] == [new_id]
+
+@pytest.mark.asyncio
+async def test_create_notification_batch_too_large(client, mocker):
+    mocker.patch('app.core.config.settings.NOTIFICATION_BATCH_MAX_SIZE', 2)
+    batch = [{"conteudoMensagem": "x", "tipoNotificacao": "email"}] * 3
+
+    response = await client.post("/api/notificar/lote", json=batch)
+
+    assert response.status_code == 413
+
+@pytest.mark.asyncio
+async def test_list_and_count_notifications(client, mocker):
+    """Testa as consultas por status, por mensagemId e as contagens por status e canal."""
+    mocker.patch('app.services.rabbitmq.RabbitMQService.publish_message')
+    mensagem_id = str(uuid.uuid4())
+    trace_ids = []
+    for tipo in ("email", "email", "sms"):
+        response = await client.post("/api/notificar", json={"conteudoMensagem": "Oi", "tipoNotificacao": tipo})
+        trace_ids.append(response.json()["traceId"])
+    response = await client.post("/api/notificar", json={"mensagemId": mensagem_id, "conteudoMensagem": "Oi", "tipoNotificacao": "push"})
+    await storage.set_status(trace_ids[0], "FALHA_ENVIO_FINAL")
+
+    first_page = (await client.get("/api/notificacoes", params={"status": "RECEBIDO", "limite": 2})).json()
+    second_page = (await client.get("/api/notificacoes", params={"status": "RECEBIDO", "limite": 2, "cursor": first_page["proximoCursor"]})).json()
+    failed = (await client.get("/api/notificacoes", params={"status": "FALHA_ENVIO_FINAL", "tipoNotificacao": "email"})).json()
+    by_message = (await client.get(f"/api/notificacoes/mensagem/{mensagem_id}")).json()
+    counts = (await client.get("/api/notificacoes/contagem")).json()
+
+    assert len(first_page["items"]) == 2 and first_page["proximoCursor"]
+    assert len(second_page["items"]) == 1 and second_page["proximoCursor"] is None
+    assert failed["items"][0]["traceId"] == trace_ids[0]
+    assert by_message["items"][0]["traceId"] == response.json()["traceId"]
+    assert by_message["items"][0]["status"] == "RECEBIDO"
+    assert counts == {
+        "total": 4,
+        "contagens": {"RECEBIDO": {"email": 1, "sms": 1, "push": 1}, "FALHA_ENVIO_FINAL": {"email": 1}},
+    }
+    invalid = await client.get("/api/notificacoes", params={"status": "RECEBIDO", "cursor": "x"})
+    assert invalid.status_code == 422
+
+@pytest.mark.asyncio
+async def test_metrics_endpoint(client, mocker):
+    """Testa a exposição das métricas no formato do Prometheus."""
+    mocker.patch('app.services.rabbitmq.RabbitMQService.publish_message', new_callable=AsyncMock)
+    await client.post("/api/notificar", json={"conteudoMensagem": "Métricas", "tipoNotificacao": "push"})
+
+    response = await client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert 'notifications_received_total{channel="push"}' in response.text
+    assert 'redis_operation_duration_seconds_count{operation="set_notification"}' in response.text
+
+@pytest_asyncio.fixture
+async def backlogged_broker(mocker):
+    """Broker em memória com 3 notificações esperando na entrada e 2 na fila de envio de SMS."""
+    broker = InMemoryRabbitMQService()
+    for queue_name in (settings.NOTIFICATION_INPUT_QUEUE, channel_queue("sms")):
+        await declare_stage(broker, queue_name)
+    for n in range(3):
+        await publish_to_stage(broker, {"traceId": str(n)}, settings.NOTIFICATION_INPUT_QUEUE)
+    for n in range(2):
+        await publish_to_stage(broker, {"traceId": str(n)}, channel_queue("sms"))
+    mocker.patch.object(app.state, "rabbitmq_service", broker, create=True)
+    mocker.patch.object(settings, "BACKPRESSURE_REFRESH_SECONDS", 0)
+    backpressure.clear()
+    yield broker
+    backpressure.clear()
+    await broker.close()
+
+@pytest.mark.asyncio
+async def test_create_notification_sheds_load_past_watermarks(client, backlogged_broker, mocker):
+    """Testa o 429 acima da marca alta (exceto prioridade alta), o 503 acima da crítica e o Retry-After."""
+    mocker.patch.object(settings, "BACKPRESSURE_QUEUE_HIGH_WATERMARK", 3)
+    normal = await client.post("/api/notificar", json={"conteudoMensagem": "Oi", "tipoNotificacao": "email"})
+    high = await client.post("/api/notificar", json={"conteudoMensagem": "Código", "tipoNotificacao": "email", "prioridade": "alta"})
+
+    assert normal.status_code == 429
+    assert normal.headers["Retry-After"] == str(settings.BACKPRESSURE_RETRY_AFTER_SECONDS)
+    assert high.status_code == 202
+
+    mocker.patch.object(settings, "BACKPRESSURE_QUEUE_CRITICAL_WATERMARK", 3)
+    critical = await client.post("/api/notificar", json={"conteudoMensagem": "Código", "tipoNotificacao": "email", "prioridade": "alta"})
+    assert critical.status_code == 503
+    assert "Retry-After" in critical.headers
+
+@pytest.mark.asyncio
+async def test_create_notification_sheds_only_the_backlogged_channel(client, backlogged_broker, mocker):
+    """Testa que a marca por tipoNotificacao rejeita só o canal atrasado, também no lote."""
+    mocker.patch.object(settings, "BACKPRESSURE_CHANNEL_WATERMARKS", {"sms": 2})
+
+    sms = await client.post("/api/notificar", json={"conteudoMensagem": "Oi", "tipoNotificacao": "sms"})
+    email = await client.post("/api/notificar", json={"conteudoMensagem": "Oi", "tipoNotificacao": "email"})
+    batch = await client.post("/api/notificar/lote", json=[
+        {"conteudoMensagem": "Oi", "tipoNotificacao": "sms"},
+        {"conteudoMensagem": "Oi", "tipoNotificacao": "push"},
+    ])
+    sms_batch = await client.post("/api/notificar/lote", json=[{"conteudoMensagem": "Oi", "tipoNotificacao": "sms"}])
+
+    assert sms.status_code == 429
+    assert email.status_code == 202
+    assert batch.status_code == 202
+    assert batch.json()["accepted"] == 1
+    assert "shed load" in batch.json()["results"][0]["error"]
+    assert batch.headers["Retry-After"] == str(settings.BACKPRESSURE_RETRY_AFTER_SECONDS)
+    assert sms_batch.status_code == 429
+
+@pytest.mark.asyncio
+async def test_create_notification_sheds_load_on_slow_publishes(client, backlogged_broker, mocker):
+    """Testa o 503 enquanto a latência média de publicação está acima do limite, e a volta ao normal."""
+    mocker.patch.object(settings, "BACKPRESSURE_PUBLISH_LATENCY_MS", 500)
+    mocker.patch.object(settings, "BACKPRESSURE_REFRESH_SECONDS", 60)
+    backlogged_broker.observe_publish(5.0)
+
+    slow = await client.post("/api/notificar", json={"conteudoMensagem": "Oi", "tipoNotificacao": "email"})
+    assert slow.status_code == 503
+
+    backlogged_broker.publish_latency = 0.01
+    recovered = await client.post("/api/notificar", json={"conteudoMensagem": "Oi", "tipoNotificacao": "email"})
+    assert recovered.status_code == 202
@@ -0,0 +1,17 @@
+import pytest
+from app.bench import run_benchmark
+from app.core.config import settings
+
+
+@pytest.mark.asyncio
+async def test_benchmark_is_repeatable_with_the_same_seed():
+    """Testa que o benchmark percorre o pipeline completo e é reproduzível com a mesma semente."""
+    first = await run_benchmark(count=60, seed=7, batch_size=25)
+    second = await run_benchmark(count=60, seed=7, batch_size=25)
+
+    assert sum(first["final_statuses"].values()) == 60
+    assert set(first["final_statuses"]) <= {"ENVIADO_SUCESSO", "DLQ_RECEIVED"}
+    assert first["final_statuses"] == second["final_statuses"]
+    assert first["published"] == second["published"]
+    assert first["stages"]["process_initial_notification"]["count"] == 60
+    assert settings.STORAGE_BACKEND == "redis"
@@ -0,0 +1,128 @@
+import uuid
+import httpx
+import pytest
+import pytest_asyncio
+from unittest.mock import AsyncMock
+
+from app.main import app
+from app.core import claim_check, metrics, storage
+from app.core.config import settings
+from app.core.exceptions import ContentNotFoundError
+from app.services.dispatcher import close_dispatchers, get_dispatcher
+from app.services.rabbitmq import RabbitMQService
+from app.tasks.message_tasks import process_channel_notification, process_dlq_message
+
+CAMPAIGN = "<html>" + "Promoção imperdível! " * 200 + "</html>"
+
+
+@pytest_asyncio.fixture(autouse=True)
+async def clean_storage(mocker):
+    """Ativa o claim check para conteúdos de 1 KB e limpa o armazenamento e o cache local."""
+    mocker.patch.object(settings, "CLAIM_CHECK_THRESHOLD_BYTES", 1024)
+    await storage.clear_storage()
+    claim_check.content_cache.clear()
+    yield
+    await close_dispatchers()
+    await storage.close()
+
+
+def claim_check_total(operation: str) -> float:
+    return metrics.REGISTRY.get_sample_value("notification_claim_check_total", {"operation": operation})
+
+
+def notification(content: str) -> dict:
+    return {"traceId": str(uuid.uuid4()), "conteudoMensagem": content, "channel": "email"}
+
+
+@pytest.mark.asyncio
+async def test_check_in_stores_identical_contents_once():
+    """Testa que conteúdos grandes viram referência, que conteúdos iguais são armazenados uma vez e que os pequenos ficam na mensagem."""
+    stored_before, deduplicated_before = claim_check_total("stored"), claim_check_total("deduplicated")
+    batch = [notification(CAMPAIGN), notification(CAMPAIGN), notification("Olá")]
+
+    await claim_check.check_in(batch)
+    await claim_check.check_in([notification(CAMPAIGN)])
+
+    assert batch[0]["conteudoMensagem"] is None
+    assert batch[0]["conteudoRef"] == batch[1]["conteudoRef"]
+    assert batch[0]["conteudoRef"]["encoding"] == "gzip"
+    assert batch[0]["conteudoRef"]["bytes"] == len(CAMPAIGN.encode())
+    assert batch[2]["conteudoMensagem"] == "Olá"
+    assert "conteudoRef" not in batch[2]
+    assert claim_check_total("stored") == stored_before + 1
+    assert claim_check_total("deduplicated") == deduplicated_before + 2
+    assert len(await storage.get_content(claim_check.content_id(batch[0]["conteudoRef"]))) < len(CAMPAIGN.encode())
+
+
+@pytest.mark.parametrize("name", list(claim_check.COMPRESSIONS))
+def test_compression_round_trip(name):
+    """Testa que cada compressão devolve o conteúdo original."""
+    compression = claim_check.get_compression(name)
+    data = CAMPAIGN.encode()
+
+    assert compression.decompress(compression.compress(data)) == data
+
+
+@pytest.mark.asyncio
+async def test_check_out_fetches_once_and_reports_missing_contents():
+    """Testa que o conteúdo volta descomprimido, é reaproveitado do cache local e que um conteúdo expirado gera erro."""
+    data = notification(CAMPAIGN)
+    await claim_check.check_in([data])
+
+    assert (await claim_check.check_out(data))["conteudoMensagem"] == CAMPAIGN
+    await storage.clear_storage()
+    assert (await claim_check.check_out(data))["conteudoMensagem"] == CAMPAIGN
+
+    claim_check.content_cache.clear()
+    with pytest.raises(ContentNotFoundError):
+        await claim_check.check_out(data)
+
+
+@pytest.mark.asyncio
+async def test_channel_stage_sends_checked_out_content(mocker):
+    """Testa que o despachante entrega ao provedor o conteúdo completo e que a mensagem publicada leva só a referência."""
+    mocker.patch.object(settings, "SIMULATED_LATENCY_SCALE", 0)
+    mocker.patch('app.services.providers.random.random', return_value=0.99)
+    mocker.patch('app.tasks.message_tasks.storage.set_status', new_callable=AsyncMock, return_value=True)
+    data = notification(CAMPAIGN)
+    await claim_check.check_in([data])
+
+    await process_channel_notification(data, AsyncMock(spec=RabbitMQService))
+
+    assert list(get_dispatcher("email").provider.sent) == [{**data, "conteudoMensagem": CAMPAIGN}]
+    assert data["conteudoMensagem"] is None
+
+
+@pytest.mark.asyncio
+async def test_api_stores_reference_and_status_returns_content(mocker):
+    """Testa que a API publica apenas a referência e que o status devolve o conteúdo completo."""
+    mock_publish = mocker.patch('app.services.rabbitmq.RabbitMQService.publish_message')
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://testserver") as client:
+        response = await client.post("/api/notificar", json={"conteudoMensagem": CAMPAIGN, "tipoNotificacao": "email"})
+        trace_id = response.json()["traceId"]
+        status_response = await client.get(f"/api/notificacao/status/{trace_id}")
+
+    published = mock_publish.call_args.args[0]
+    assert published["conteudoMensagem"] is None
+    assert published["conteudoRef"]["sha256"]
+    assert status_response.json()["conteudoMensagem"] == CAMPAIGN
+
+
+@pytest.mark.asyncio
+async def test_dead_letter_keeps_its_content_for_the_dlq_retention(mocker):
+    """Testa que guardar a mensagem na DLQ estende o TTL do conteúdo referenciado, sem encurtar TTLs maiores."""
+    mocker.patch.object(settings, "CLAIM_CHECK_TTL_SECONDS", 60)
+    mocker.patch.object(settings, "DLQ_RETENTION_SECONDS", 3600)
+    data = notification(CAMPAIGN)
+    await claim_check.check_in([data])
+    await storage.set_notification(data["traceId"], {**data, "status": "FALHA_ENVIO_FINAL"})
+    key = storage._content_key(claim_check.content_id(data["conteudoRef"]))
+    client = storage.get_client()
+
+    await process_dlq_message(data, AsyncMock(spec=RabbitMQService))
+    assert 3590 < await client.ttl(key) <= 3600
+
+    mocker.patch.object(settings, "DLQ_RETENTION_SECONDS", 600)
+    await process_dlq_message(data, AsyncMock(spec=RabbitMQService))
+    assert await client.ttl(key) > 600
@@ -0,0 +1,34 @@
+import pytest
+from app.core import codec
+from app.core.config import settings
+
+PAYLOAD = {"traceId": "abc", "conteudoMensagem": "Olá", "channel": "email"}
+
+
+@pytest.mark.parametrize("name", ["json", "orjson", "msgpack"])
+def test_codec_round_trip(name, mocker):
+    """Testa que cada codec decodifica o que codificou."""
+    mocker.patch.object(settings, "MESSAGE_CODEC", name)
+
+    selected = codec.get_codec()
+
+    assert selected.name == name
+    assert codec.codec_for_content_type(selected.content_type).decode(selected.encode(PAYLOAD)) == PAYLOAD
+
+
+def test_codec_for_content_type_interoperates_during_rollout(mocker):
+    """Testa que consumidores leem mensagens de produtores com outro codec."""
+    mocker.patch.object(settings, "MESSAGE_CODEC", "msgpack")
+    msgpack_body = codec.get_codec().encode(PAYLOAD)
+    json_body = codec.JsonCodec().encode(PAYLOAD)
+
+    assert codec.codec_for_content_type("application/msgpack").decode(msgpack_body) == PAYLOAD
+    assert codec.codec_for_content_type("application/json").decode(json_body) == PAYLOAD
+    # Produtores antigos não declaram content_type
+    assert codec.codec_for_content_type(None).decode(json_body) == PAYLOAD
+
+
+def test_unknown_codec(mocker):
+    mocker.patch.object(settings, "MESSAGE_CODEC", "xml")
+    with pytest.raises(ValueError):
+        codec.get_codec()
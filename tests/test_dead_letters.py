@@ -0,0 +1,137 @@
+import time
+import uuid
+import pytest
+import pytest_asyncio
+from httpx import ASGITransport, AsyncClient
+from app.core import storage
+from app.core.codec import codec_for_content_type
+from app.core.config import settings
+from app.core.status_cache import notification_cache
+from app.main import app
+from app.services.dead_letters import REPLAY_STATUS, REPLAYS_KEY, build_dead_letter, find_dead_letters, record_failure, replay_dead_letters
+from app.services.memory_broker import InMemoryRabbitMQService
+from app.services.topology import declare_stage
+from app.worker import delivery_step
+from app.tasks.message_tasks import process_initial_notification
+
+INPUT = settings.NOTIFICATION_INPUT_QUEUE
+
+
+@pytest_asyncio.fixture(autouse=True)
+async def clear_storage_before_each_test():
+    """Garante que o armazenamento esteja limpo antes de cada teste."""
+    await storage.clear_storage()
+    yield
+    await storage.close()
+
+
+async def create_dead_letter(channel: str = "email", status: str = "FALHA_ENVIO_FINAL", reason: str = "Timeout do provedor", dead_at: float = None) -> str:
+    trace_id = str(uuid.uuid4())
+    data = {"traceId": trace_id, "mensagemId": str(uuid.uuid4()), "channel": channel, "conteudoMensagem": "Teste", "status": "RECEBIDO"}
+    await storage.set_notification(trace_id, data)
+    record_failure(data, "process_channel_notification", status, reason)
+    entry = build_dead_letter(data)
+    if dead_at is not None:
+        entry["registradoEm"] = dead_at
+    await storage.store_dead_letter(trace_id, entry)
+    await storage.set_status(trace_id, "DLQ_RECEIVED")
+    return trace_id
+
+
+def published_messages(broker: InMemoryRabbitMQService, queue_name: str) -> list:
+    return [codec_for_content_type(m.content_type).decode(m.body) for m in broker.broker_queues[queue_name].messages]
+
+
+@pytest.mark.asyncio
+async def test_find_dead_letters_filters_and_paginates():
+    """Testa os filtros por canal, status, erro e período, e a paginação com cursor."""
+    now = time.time()
+    emails = [await create_dead_letter(dead_at=now - i) for i in range(5)]
+    await create_dead_letter(channel="sms", dead_at=now - 10)
+    await create_dead_letter(reason="Conteúdo expirado", dead_at=now - 11)
+    await create_dead_letter(status="FALHA_FINAL_REPROCESSAMENTO", dead_at=now - 12)
+
+    page, cursor = await find_dead_letters(channel="email", error="TIMEOUT", status="FALHA_ENVIO_FINAL", limit=3)
+    rest, last_cursor = await find_dead_letters(channel="email", error="TIMEOUT", status="FALHA_ENVIO_FINAL", limit=3, cursor=cursor)
+
+    assert [entry["traceId"] for entry in page + rest] == emails
+    assert last_cursor is None
+    recent, _ = await find_dead_letters(since=now - 2.5)
+    assert [entry["traceId"] for entry in recent] == emails[:3]
+    older, _ = await find_dead_letters(until=now - 10.5)
+    assert len(older) == 2
+
+
+@pytest.mark.asyncio
+async def test_find_dead_letters_never_returns_more_than_limit():
+    """Testa que uma página filtrada não passa do limite e que o cursor continua da última entrada devolvida."""
+    now = time.time()
+    emails = []
+    for i in range(6):
+        emails.append(await create_dead_letter(dead_at=now - 2 * i))
+        if i == 0:
+            await create_dead_letter(channel="sms", dead_at=now - 1)
+
+    seen, cursor = [], None
+    while True:
+        page, cursor = await find_dead_letters(channel="email", limit=3, cursor=cursor)
+        assert len(page) <= 3
+        seen.extend(entry["traceId"] for entry in page)
+        if cursor is None:
+            break
+    assert seen == emails
+
+
+@pytest.mark.asyncio
+async def test_replay_dead_letters_publishes_to_target_and_leaves_dlq():
+    """Testa que o replay publica na fila de entrada, respeita a taxa, remove as mensagens reprocessadas da DLQ e invalida o status em cache."""
+    trace_ids = [await create_dead_letter() for _ in range(4)]
+    kept = await create_dead_letter(channel="sms")
+    broker = InMemoryRabbitMQService()
+    await declare_stage(broker, INPUT)
+    notification_cache.clear()
+    assert (await notification_cache.get(trace_ids[0]))["status"] == "DLQ_RECEIVED"
+
+    summary = await replay_dead_letters(broker, target="entrada", rate=5, batch_size=2, limit=10, channel="email")
+
+    assert summary["reprocessadas"] == 4 and summary["falhas"] == 0
+    # The second batch waits for the tokens the first one took
+    assert summary["aguardandoSegundos"] > 0
+    messages = published_messages(broker, INPUT)
+    assert sorted(m["traceId"] for m in messages) == sorted(trace_ids)
+    assert all(m[REPLAYS_KEY] == 1 and len(m["falhas"]) == 1 for m in messages)
+    assert await storage.get_dead_letters(trace_ids) == [None] * 4
+    assert [entry["traceId"] for entry in (await find_dead_letters())[0]] == [kept]
+    assert (await storage.get_status(trace_ids[0]))[0] == REPLAY_STATUS
+    assert (await notification_cache.get(trace_ids[0]))["status"] == REPLAY_STATUS
+    await broker.close()
+
+
+def test_replayed_message_gets_a_new_delivery_step():
+    """Testa que a mensagem reprocessada não é descartada pela deduplicação das entregas anteriores."""
+    data = {"traceId": "1"}
+
+    assert delivery_step(process_initial_notification, {}, data) == "process_initial_notification:1"
+    assert delivery_step(process_initial_notification, {}, {**data, REPLAYS_KEY: 1}) == "process_initial_notification:1:r1"
+
+
+@pytest.mark.asyncio
+async def test_dlq_endpoints_list_and_replay(mocker):
+    """Testa a listagem da DLQ e o reprocessamento pela API."""
+    trace_id = await create_dead_letter()
+    broker = InMemoryRabbitMQService()
+    await declare_stage(broker, INPUT)
+    mocker.patch.object(app.state, "rabbitmq_service", broker, create=True)
+
+    async with AsyncClient(transport=ASGITransport(app=app), base_url="http://test") as client:
+        listed = await client.get("/api/dlq", params={"tipoNotificacao": "email", "erro": "timeout"})
+        invalid = await client.post("/api/dlq/reprocessar", json={"destino": "retry"})
+        replayed = await client.post("/api/dlq/reprocessar", json={"destino": "entrada", "taxa": 100})
+
+    assert listed.status_code == 200
+    [item] = listed.json()["items"]
+    assert item["traceId"] == trace_id and item["motivo"] == "Timeout do provedor" and item["tentativas"] == 1
+    assert invalid.status_code == 400
+    assert replayed.json() == {"destino": "entrada", "reprocessadas": 1, "falhas": 0, "aguardandoSegundos": 0.0}
+    assert [m["traceId"] for m in published_messages(broker, INPUT)] == [trace_id]
+    await broker.close()
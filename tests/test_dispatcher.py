@@ -0,0 +1,117 @@
+import asyncio
+import pytest
+import pytest_asyncio
+
+from app.core import storage
+from app.core.config import settings
+from app.core.exceptions import ProviderError
+from app.core.rate_limit import TokenBucket
+from app.services.dispatcher import ChannelDispatcher
+from app.services.providers import FakeProvider, load_provider
+
+
+@pytest_asyncio.fixture(autouse=True)
+async def clean_storage():
+    """Limpa o armazenamento, onde ficam os token buckets, e fecha o cliente do event loop do teste."""
+    await storage.clear_storage()
+    yield
+    await storage.close()
+
+
+@pytest.fixture(autouse=True)
+def no_simulated_latency(mocker):
+    mocker.patch.object(settings, "SIMULATED_LATENCY_SCALE", 0)
+
+
+class FlakyProvider(FakeProvider):
+    """Provedor que recusa as notificações marcadas com 'falhar'."""
+
+    async def send_batch(self, notifications):
+        self.calls += 1
+        return [ProviderError("recusada") if data.get("falhar") else None for data in notifications]
+
+
+@pytest.mark.asyncio
+async def test_dispatcher_sends_full_batch_in_one_provider_call():
+    """Testa que um lote cheio é enviado em uma única chamada ao provedor, sem esperar o tempo máximo."""
+    provider = FakeProvider("email", failure_rate=0)
+    dispatcher = ChannelDispatcher("email", provider, max_batch_size=3, max_wait=10)
+
+    await asyncio.wait_for(asyncio.gather(*(dispatcher.send({"traceId": str(i)}) for i in range(3))), 1)
+
+    assert provider.calls == 1
+    assert [data["traceId"] for data in provider.sent] == ["0", "1", "2"]
+
+
+@pytest.mark.asyncio
+async def test_dispatcher_flushes_partial_batch_after_max_wait():
+    """Testa que um lote incompleto é enviado após o tempo máximo de espera."""
+    provider = FakeProvider("sms", failure_rate=0)
+    dispatcher = ChannelDispatcher("sms", provider, max_batch_size=100, max_wait=0.01)
+
+    await asyncio.wait_for(asyncio.gather(dispatcher.send({"traceId": "a"}), dispatcher.send({"traceId": "b"})), 1)
+
+    assert provider.calls == 1
+    assert len(provider.sent) == 2
+
+
+@pytest.mark.asyncio
+async def test_dispatcher_reports_errors_per_notification():
+    """Testa que a falha de uma notificação do lote não afeta as demais."""
+    provider = FlakyProvider("push")
+    dispatcher = ChannelDispatcher("push", provider, max_batch_size=2, max_wait=10)
+
+    results = await asyncio.gather(
+        dispatcher.send({"traceId": "ok"}),
+        dispatcher.send({"traceId": "erro", "falhar": True}),
+        return_exceptions=True,
+    )
+
+    assert results[0] is None
+    assert isinstance(results[1], ProviderError)
+
+
+@pytest.mark.asyncio
+async def test_token_bucket_is_shared_between_instances():
+    """Testa que instâncias com o mesmo nome (ex.: outros processos) consomem o mesmo limite."""
+    first = TokenBucket("teste", rate=20, capacity=2)
+    second = TokenBucket("teste", rate=20, capacity=2)
+
+    assert await first.acquire(2) == 0
+    waited = await second.acquire(1)
+
+    assert 0 < waited <= 0.1
+
+
+@pytest.mark.asyncio
+async def test_dispatcher_waits_for_rate_limit():
+    """Testa que o despachante respeita o limite de envios por segundo do canal."""
+    provider = FakeProvider("email", failure_rate=0)
+    dispatcher = ChannelDispatcher("email", provider, max_batch_size=5, max_wait=0, rate_limit=TokenBucket("email", rate=50, capacity=5))
+
+    started = asyncio.get_running_loop().time()
+    await asyncio.gather(*(dispatcher.send({"traceId": str(i)}) for i in range(10)))
+
+    assert provider.calls == 2
+    assert asyncio.get_running_loop().time() - started >= 0.09
+
+
+def test_load_provider_by_name_or_import_path():
+    assert isinstance(load_provider("fake", "email"), FakeProvider)
+    provider = load_provider("app.services.providers:FakeProvider", "sms")
+    assert isinstance(provider, FakeProvider) and provider.channel == "sms"
+    with pytest.raises(TypeError):
+        load_provider("app.services.providers:NotificationProvider", "sms")
+    with pytest.raises(ValueError):
+        load_provider("inexistente", "email")
+
+
+@pytest.mark.asyncio
+async def test_fake_provider_keeps_only_recent_sends(mocker):
+    """Testa que o provedor fake guarda apenas os últimos envios aceitos, sem crescer durante a vida do processo."""
+    mocker.patch.object(FakeProvider, "sent_history", 2)
+    provider = FakeProvider("email", failure_rate=0)
+
+    await provider.send_batch([{"traceId": str(i)} for i in range(5)])
+
+    assert [data["traceId"] for data in provider.sent] == ["3", "4"]
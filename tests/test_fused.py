@@ -0,0 +1,118 @@
+import asyncio
+import pytest
+import pytest_asyncio
+from aio_pika import ExchangeType
+from app.core import storage
+from app.core.exceptions import PublishNackError
+from app.core.priority import WeightedFairLimiter
+from app.services.fused import FusedRabbitMQService
+from app.services.memory_broker import InMemoryRabbitMQService
+from app.worker import process_message
+
+
+@pytest_asyncio.fixture(autouse=True)
+async def clean_storage():
+    """Limpa o armazenamento usado pela deduplicação do process_message e fecha o cliente do event loop do teste."""
+    await storage.clear_storage()
+    yield
+    await storage.close()
+
+
+async def fused_pipeline(first_stage, second_stage):
+    """Monta duas etapas no mesmo processo: 'entrada' publica em 'validacao'."""
+    broker = InMemoryRabbitMQService()
+    for queue_name in ("entrada", "validacao"):
+        await broker.declare_exchange(f"{queue_name}_exchange", ExchangeType.DIRECT, durable=True)
+        await broker.declare_queue(queue_name, durable=True)
+        await broker.bind_queue(queue_name, f"{queue_name}_exchange", routing_key=queue_name)
+    fused = FusedRabbitMQService(broker, queue_size=10)
+    fused.add_stage("validacao", second_stage, concurrency=2)
+    await broker.start_consumer("entrada", lambda msg: process_message(msg, first_stage, fused))
+    return broker, fused
+
+
+async def publish_to_validation(data, rabbitmq_service, headers=None):
+    await rabbitmq_service.publish_message(data, "validacao", exchange_name="validacao_exchange")
+
+
+@pytest.mark.asyncio
+async def test_fused_handoff_skips_the_broker_and_acks_after_the_terminal_stage():
+    """Testa que a mensagem de entrada só é confirmada após a última etapa local."""
+    release = asyncio.Event()
+    received = []
+
+    async def final_stage(data, rabbitmq_service, headers=None):
+        await release.wait()
+        received.append(data)
+
+    broker, fused = await fused_pipeline(publish_to_validation, final_stage)
+    await broker.publish_message({"traceId": "1"}, "entrada", exchange_name="entrada_exchange")
+    await asyncio.sleep(0.01)
+
+    # Still unacked on the broker while the local stage runs
+    assert broker.health()["in_memory"]["outstanding"] == 1
+    release.set()
+    await broker.join(timeout=1)
+
+    assert received == [{"traceId": "1"}]
+    assert broker.published == 1
+    assert broker.queue_depths()["validacao"] == 0
+    await fused.close()
+
+
+@pytest.mark.asyncio
+async def test_fused_stage_failure_requeues_the_original_message():
+    """Testa que um nack mais adiante devolve a mensagem original à fila do broker."""
+    calls = []
+
+    async def final_stage(data, rabbitmq_service, headers=None):
+        calls.append(data)
+        if len(calls) == 1:
+            raise PublishNackError("DLQ publish not confirmed")
+
+    broker, fused = await fused_pipeline(publish_to_validation, final_stage)
+    await broker.publish_message({"traceId": "2"}, "entrada", exchange_name="entrada_exchange")
+    await broker.join(timeout=1)
+
+    assert len(calls) == 2
+    await fused.close()
+
+
+@pytest.mark.asyncio
+async def test_delayed_and_remote_publishes_go_through_the_broker():
+    """Testa que publicações com expiração ou para filas não locais usam o broker."""
+    broker, fused = await fused_pipeline(publish_to_validation, publish_to_validation)
+
+    await fused.publish_message({"traceId": "3"}, "validacao", exchange_name="validacao_exchange", expiration=60)
+    await fused.publish_message({"traceId": "3"}, "entrada", exchange_name="entrada_exchange")
+
+    assert broker.published == 2
+    assert broker.queue_depths()["validacao"] == 1
+    await fused.close()
+
+
+@pytest.mark.asyncio
+async def test_fused_lanes_share_the_stage_limiter():
+    """Testa que as faixas de prioridade locais de uma etapa dividem as vagas do mesmo limitador."""
+    running, peak = 0, 0
+
+    async def stage(data, rabbitmq_service, headers=None):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+
+    limiter = WeightedFairLimiter(2, {"alta": 4, "normal": 1})
+    fused = FusedRabbitMQService(InMemoryRabbitMQService(), queue_size=10)
+    fused.add_stage("validacao.alta", stage, concurrency=2, limiter=limiter, priority="alta")
+    fused.add_stage("validacao", stage, concurrency=2, limiter=limiter, priority="normal")
+
+    await asyncio.gather(*(
+        fused.publish_message({"traceId": str(i)}, lane, exchange_name=f"{lane}_exchange")
+        for i in range(4)
+        for lane in ("validacao.alta", "validacao")
+    ))
+
+    assert peak == 2
+    await fused.close()
@@ -0,0 +1,86 @@
+import json
+import logging
+import pytest
+from unittest.mock import AsyncMock, MagicMock
+from app.core import log, storage
+from app.core.config import settings
+from app.worker import process_message
+
+
+@pytest.fixture(autouse=True)
+def restore_root_logger():
+    """Devolve o logger raiz (com os handlers do pytest) ao estado anterior ao teste."""
+    root = logging.getLogger()
+    handlers, level = root.handlers[:], root.level
+    yield
+    log.stop_logging()
+    root.handlers[:] = handlers
+    root.setLevel(level)
+
+
+def test_json_lines_carry_the_bound_trace_id(capsys, mocker):
+    """Testa o formato JSON, o traceId como campo e a escrita pela thread de logging."""
+    mocker.patch.object(settings, "LOG_FORMAT", "json")
+    mocker.patch.object(settings, "LOG_ASYNC", True)
+    log.configure_logging("INFO")
+    logger = logging.getLogger("app.tasks.message_tasks")
+
+    token = log.bind_trace_id("abc")
+    logger.info("Enviada para %s", "fila.x")
+    log.reset_trace_id(token)
+    logger.warning("Sem traceId")
+    log.stop_logging()
+
+    first, second = [json.loads(line) for line in capsys.readouterr().err.splitlines()]
+    assert first["traceId"] == "abc" and first["message"] == "Enviada para fila.x" and first["level"] == "INFO"
+    assert second["traceId"] == "-"
+
+
+def test_sampling_drops_success_logs_but_keeps_failures(capsys, mocker):
+    """Testa que a amostragem descarta registros INFO e mantém todos os avisos e erros."""
+    mocker.patch.object(settings, "LOG_ASYNC", False)
+    mocker.patch.object(settings, "LOG_SAMPLE_RATES", {"INFO": 0.0, "WARNING": 0.0})
+    log.configure_logging("INFO")
+    logger = logging.getLogger("app.tasks.message_tasks")
+
+    for _ in range(10):
+        logger.info("Processamento bem-sucedido.")
+    logger.warning("Falha simulada.")
+    logger.error("Mensagem recebida na DLQ.")
+
+    lines = capsys.readouterr().err.splitlines()
+    assert len(lines) == 2
+    assert "Falha simulada." in lines[0] and "Mensagem recebida na DLQ." in lines[1]
+
+
+def test_queued_records_are_formatted_off_the_caller():
+    """Testa que o handler de fila enfileira o registro sem formatar a mensagem."""
+    handler = log.DeferredQueueHandler(MagicMock())
+    record = logging.LogRecord("app", logging.INFO, __file__, 1, "Enviada para %s", ("fila.x",), None)
+
+    handler.emit(record)
+
+    queued = handler.queue.put_nowait.call_args.args[0]
+    assert queued.msg == "Enviada para %s" and queued.args == ("fila.x",)
+
+
+@pytest.mark.asyncio
+async def test_process_message_binds_trace_id_while_handling(mocker):
+    """Testa que os logs da etapa recebem o traceId da mensagem sendo processada."""
+    mocker.patch.object(settings, "WORKER_DEDUP_ENABLED", False)
+    seen = []
+
+    async def task_func(data, rabbitmq_service, headers=None):
+        seen.append(log._trace_id.get())
+
+    message = MagicMock()
+    message.process.return_value = AsyncMock()
+    message.headers = {}
+    message.content_type = "application/json"
+    message.body = json.dumps({"traceId": "t-1"}).encode()
+
+    await process_message(message, task_func, AsyncMock())
+    await storage.close()
+
+    assert seen == ["t-1"]
+    assert log._trace_id.get() is None
@@ -0,0 +1,101 @@
+import asyncio
+import pytest
+from aio_pika import ExchangeType
+from app.core.codec import codec_for_content_type
+from app.services.memory_broker import InMemoryRabbitMQService
+
+
+async def declare(service, queue_name, **kwargs):
+    await service.declare_exchange(f"{queue_name}_exchange", ExchangeType.DIRECT, durable=True)
+    await service.declare_queue(queue_name, durable=True, **kwargs)
+    await service.bind_queue(queue_name, f"{queue_name}_exchange", routing_key=queue_name)
+
+
+@pytest.mark.asyncio
+async def test_publish_consume_and_ack():
+    """Testa o roteamento pela exchange, a entrega e o ack."""
+    service = InMemoryRabbitMQService()
+    await declare(service, "entrada")
+    received = []
+
+    async def consume(message):
+        async with message.process(ignore_processed=True):
+            received.append(codec_for_content_type(message.content_type).decode(message.body))
+
+    await service.start_consumer("entrada", consume)
+    await service.publish_message({"traceId": "1"}, "entrada", exchange_name="entrada_exchange")
+    await service.join(timeout=1)
+
+    assert received == [{"traceId": "1"}]
+    assert service.queue_depths()["entrada"] == 0
+
+
+@pytest.mark.asyncio
+async def test_prefetch_limits_unacked_deliveries():
+    """Testa que o prefetch limita as mensagens entregues sem ack."""
+    service = InMemoryRabbitMQService()
+    await declare(service, "entrada")
+    release = asyncio.Event()
+    started = []
+
+    async def consume(message):
+        started.append(message)
+        await release.wait()
+        await message.ack()
+
+    await service.start_consumer("entrada", consume, prefetch_count=2)
+    await service.publish_messages([{"n": i} for i in range(5)], "entrada", exchange_name="entrada_exchange")
+    await asyncio.sleep(0)
+
+    assert len(started) == 2
+    assert service.queue_depths()["entrada"] == 3
+    release.set()
+    await service.join(timeout=1)
+    assert len(started) == 5
+
+
+@pytest.mark.asyncio
+async def test_nack_requeues_and_redelivers():
+    service = InMemoryRabbitMQService()
+    await declare(service, "entrada")
+    deliveries = []
+
+    async def consume(message):
+        deliveries.append(message.redelivered)
+        if message.redelivered:
+            await message.ack()
+        else:
+            await message.nack(requeue=True)
+
+    await service.start_consumer("entrada", consume)
+    await service.publish_message({"traceId": "1"}, "entrada", exchange_name="entrada_exchange")
+    await service.join(timeout=1)
+
+    assert deliveries == [False, True]
+
+
+@pytest.mark.asyncio
+async def test_expired_messages_are_dead_lettered():
+    """Testa que mensagens expiradas vão para a dead letter exchange, como no RabbitMQ."""
+    service = InMemoryRabbitMQService()
+    await declare(service, "retry")
+    await service.declare_exchange("delay_exchange", ExchangeType.DIRECT)
+    await service.declare_queue("delay", arguments={
+        "x-message-ttl": 50,
+        "x-dead-letter-exchange": "retry_exchange",
+        "x-dead-letter-routing-key": "retry",
+    })
+    await service.bind_queue("delay", "delay_exchange", routing_key="delay")
+    received = []
+
+    async def consume(message):
+        received.append(message.headers)
+        await message.ack()
+
+    await service.start_consumer("retry", consume)
+    await service.publish_message({"traceId": "1"}, "delay", exchange_name="delay_exchange", headers={"x-retry-attempt": 1}, expiration=0.01)
+    assert received == []
+    await service.join(timeout=1)
+
+    assert received[0]["x-retry-attempt"] == 1
+    assert received[0]["x-death"] == [{"queue": "delay", "reason": "expired", "count": 1}]
@@ -0,0 +1,59 @@
+import urllib.request
+from app.core import metrics
+
+
+def test_counter_and_histogram_exposition():
+    """Testa o formato de exposição do Prometheus para contadores e histogramas."""
+    registry = metrics.CollectorRegistry()
+    counter = metrics.Counter("test_messages_total", "Mensagens.", ("stage", "outcome"), registry=registry)
+    histogram = metrics.Histogram("test_duration_seconds", "Duração.", ("stage",), buckets=(0.1, 1.0), registry=registry)
+
+    counter.labels("entrada", "success").inc()
+    counter.labels("entrada", "success").inc(2)
+    histogram.labels("entrada").observe(0.05)
+    histogram.labels("entrada").observe(0.5)
+    histogram.labels("entrada").observe(5)
+
+    output = metrics.render(registry).decode()
+    assert "# TYPE test_messages_total counter" in output
+    assert 'test_messages_total{outcome="success",stage="entrada"} 3.0' in output
+    assert 'test_duration_seconds_bucket{le="0.1",stage="entrada"} 1.0' in output
+    assert 'test_duration_seconds_bucket{le="1.0",stage="entrada"} 2.0' in output
+    assert 'test_duration_seconds_bucket{le="+Inf",stage="entrada"} 3.0' in output
+    assert 'test_duration_seconds_count{stage="entrada"} 3.0' in output
+    assert 'test_duration_seconds_sum{stage="entrada"} 5.55' in output
+
+
+def test_histogram_defaults_to_millisecond_buckets():
+    registry = metrics.CollectorRegistry()
+    metrics.Histogram("test_latency_seconds", "Latência.", registry=registry).observe(0.002)
+
+    assert registry.get_sample_value("test_latency_seconds_bucket", {"le": "0.001"}) == 0
+    assert registry.get_sample_value("test_latency_seconds_bucket", {"le": "0.0025"}) == 1
+
+
+def test_gauge_callback_and_duplicate_registration():
+    registry = metrics.CollectorRegistry()
+    metrics.GaugeCallback("test_pool", "Pool.", ("stat",), lambda: {("in_use",): 2}, registry=registry)
+
+    assert registry.get_sample_value("test_pool", {"stat": "in_use"}) == 2
+    try:
+        metrics.Gauge("test_pool", "Duplicada.", registry=registry)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("Duplicate metric names must be rejected")
+
+
+def test_metrics_server():
+    """Testa o endpoint HTTP /metrics usado pelos workers."""
+    registry = metrics.CollectorRegistry()
+    metrics.Counter("test_served_total", "Servida.", registry=registry).inc()
+    server = metrics.start_metrics_server(0, registry)
+    try:
+        port = server.server_address[1]
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics") as response:
+            assert response.headers["Content-Type"].startswith("text/plain")
+            assert "test_served_total 1.0" in response.read().decode()
+    finally:
+        server.shutdown()
@@ -0,0 +1,71 @@
+import asyncio
+import pytest
+from app.core.config import settings
+from app.core.priority import WeightedFairLimiter, lane_queue, stage_lanes
+
+
+def test_lane_queue_only_splits_latency_sensitive_stages():
+    """Testa que apenas as etapas sensíveis à latência têm uma faixa alta separada."""
+    assert lane_queue(settings.NOTIFICATION_INPUT_QUEUE, "alta") == f"{settings.NOTIFICATION_INPUT_QUEUE}.alta"
+    assert lane_queue(settings.NOTIFICATION_INPUT_QUEUE, "normal") == settings.NOTIFICATION_INPUT_QUEUE
+    assert lane_queue(settings.NOTIFICATION_INPUT_QUEUE, None) == settings.NOTIFICATION_INPUT_QUEUE
+    assert lane_queue(settings.NOTIFICATION_DLQ, "alta") == settings.NOTIFICATION_DLQ
+    assert stage_lanes(settings.NOTIFICATION_RETRY_QUEUE) == {"normal": settings.NOTIFICATION_RETRY_QUEUE}
+
+
+async def _run_lanes(limiter: WeightedFairLimiter, queued: dict) -> list:
+    order = []
+    gate = asyncio.Event()
+
+    async def handler(lane):
+        order.append(lane)
+        await gate.wait()
+
+    # Occupies the single slot so every queued message has to wait for it
+    blocker = asyncio.create_task(limiter.wrap("normal", lambda _: gate.wait())(None))
+    await asyncio.sleep(0)
+    tasks = [
+        asyncio.create_task(limiter.wrap(lane, lambda lane: handler(lane))(lane))
+        for lane, n in queued.items() for _ in range(n)
+    ]
+    await asyncio.sleep(0)
+    while not all(task.done() for task in tasks):
+        gate.set()
+        await asyncio.sleep(0)
+    await blocker
+    return order
+
+
+@pytest.mark.asyncio
+async def test_weighted_fair_limiter_does_not_starve_normal_lane():
+    """Testa que, sob uma inundação de prioridade alta, a faixa normal ainda recebe sua parcela."""
+    limiter = WeightedFairLimiter(1, {"alta": 4, "normal": 1})
+
+    order = await _run_lanes(limiter, {"alta": 20, "normal": 5})
+
+    assert order[:5].count("normal") == 1
+    assert order[:10].count("normal") == 2
+    assert sorted(order) == sorted(["alta"] * 20 + ["normal"] * 5)
+
+
+@pytest.mark.asyncio
+async def test_weighted_fair_limiter_gives_idle_lane_slots_away():
+    """Testa que uma faixa ociosa não reserva vagas: a outra usa toda a concorrência."""
+    limiter = WeightedFairLimiter(3, {"alta": 4, "normal": 1})
+    running = []
+    peak = 0
+    gate = asyncio.Event()
+
+    async def handler(_):
+        nonlocal peak
+        running.append(1)
+        peak = max(peak, len(running))
+        await gate.wait()
+        running.pop()
+
+    tasks = [asyncio.create_task(limiter.wrap("normal", handler)(None)) for _ in range(6)]
+    await asyncio.sleep(0)
+    gate.set()
+    await asyncio.gather(*tasks)
+
+    assert peak == 3
@@ -0,0 +1,207 @@
+import asyncio
+import pytest
+from unittest.mock import AsyncMock, MagicMock
+from aio_pika import DeliveryMode
+from aio_pika.exceptions import DeliveryError
+from app.core.config import settings
+from app.core.exceptions import PublishNackError
+from app.services.rabbitmq import ChannelPool, ConfirmPublisher, RabbitMQService
+
+
+def make_connection():
+    """Cria uma conexão falsa que abre canais mockados."""
+    connection = MagicMock()
+
+    async def open_channel(**kwargs):
+        channel = MagicMock()
+        channel.is_closed = False
+        channel.close = AsyncMock()
+        channel.set_qos = AsyncMock()
+        queue = MagicMock()
+        queue.consume = AsyncMock()
+        channel.get_queue = AsyncMock(return_value=queue)
+        return channel
+
+    connection.channel = AsyncMock(side_effect=open_channel)
+    return connection
+
+
+@pytest.mark.asyncio
+async def test_channel_pool_reuses_channels():
+    """Testa que canais devolvidos ao pool são reutilizados."""
+    connection = make_connection()
+    pool = ChannelPool(connection, max_size=2)
+
+    async with pool.acquire() as first:
+        assert pool.stats()["in_use"] == 1
+    async with pool.acquire() as second:
+        pass
+
+    assert first is second
+    assert connection.channel.await_count == 1
+    assert pool.stats() == {"max_size": 2, "size": 1, "in_use": 0, "idle": 1, "waiting": 0}
+
+
+@pytest.mark.asyncio
+async def test_channel_pool_is_bounded():
+    """Testa que o pool nunca abre mais canais que o tamanho máximo."""
+    connection = make_connection()
+    pool = ChannelPool(connection, max_size=2)
+    release = asyncio.Event()
+
+    async def publisher():
+        async with pool.acquire():
+            await release.wait()
+
+    tasks = [asyncio.create_task(publisher()) for _ in range(5)]
+    await asyncio.sleep(0)
+    assert pool.stats()["in_use"] == 2
+    assert pool.stats()["waiting"] == 3
+
+    release.set()
+    await asyncio.gather(*tasks)
+    assert connection.channel.await_count == 2
+    assert pool.stats()["in_use"] == 0
+
+
+@pytest.mark.asyncio
+async def test_channel_pool_discards_closed_channels():
+    """Testa que canais fechados pelo broker são descartados."""
+    connection = make_connection()
+    pool = ChannelPool(connection, max_size=2)
+
+    async with pool.acquire() as channel:
+        channel.is_closed = True
+    assert pool.stats()["size"] == 0
+
+    async with pool.acquire() as new_channel:
+        assert new_channel is not channel
+    assert connection.channel.await_count == 2
+
+
+@pytest.mark.asyncio
+async def test_start_consumer_uses_dedicated_channel_with_qos():
+    """Testa que cada fila consumida tem seu próprio canal e prefetch."""
+    service = RabbitMQService()
+    service.connection = make_connection()
+    service.channel = MagicMock()
+    service.queues["fila"] = MagicMock()
+    callback = AsyncMock()
+
+    await service.start_consumer("fila", callback, prefetch_count=5)
+
+    channel = service.consumer_channels["fila"]
+    channel.set_qos.assert_awaited_once_with(prefetch_count=5)
+    queue = channel.get_queue.return_value
+    queue.consume.assert_awaited_once_with(callback)
+
+
+@pytest.mark.asyncio
+async def test_publish_messages_reports_per_message_errors():
+    """Testa que a publicação em lote retorna o erro de cada mensagem."""
+    service = RabbitMQService()
+    service.connection = make_connection()
+    service.channel_pool = ChannelPool(service.connection, max_size=1)
+    service.exchanges["ex"] = MagicMock()
+
+    async def publish(message, routing_key):
+        if b'"fail"' in message.body:
+            raise RuntimeError("nack")
+
+    exchange = MagicMock()
+    exchange.publish = AsyncMock(side_effect=publish)
+
+    async def open_channel(**kwargs):
+        channel = MagicMock()
+        channel.is_closed = False
+        channel.get_exchange = AsyncMock(return_value=exchange)
+        return channel
+
+    service.connection.channel = AsyncMock(side_effect=open_channel)
+
+    errors = await service.publish_messages([{"id": "ok"}, {"id": "fail"}, {"id": "ok"}], "rk", exchange_name="ex")
+
+    assert errors[0] is None and errors[2] is None
+    assert isinstance(errors[1], RuntimeError)
+    assert exchange.publish.await_count == 3
+    assert service.connection.channel.await_count == 1
+
+
+def make_confirm_connection(publish):
+    """Cria uma conexão falsa cujos canais publicam com a função dada."""
+    connection = MagicMock()
+
+    async def open_channel(**kwargs):
+        channel = MagicMock()
+        channel.is_closed = False
+        channel.close = AsyncMock()
+        exchange = MagicMock()
+        exchange.publish = AsyncMock(side_effect=publish)
+        channel.get_exchange = AsyncMock(return_value=exchange)
+        return channel
+
+    connection.channel = AsyncMock(side_effect=open_channel)
+    return connection
+
+
+@pytest.mark.asyncio
+async def test_confirm_publisher_keeps_window_of_unconfirmed_messages():
+    """Testa que várias publicações aguardam confirmação ao mesmo tempo, limitadas pela janela."""
+    confirm = asyncio.Event()
+    in_flight = 0
+    peak = 0
+
+    async def publish(message, routing_key, timeout=None):
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await confirm.wait()
+        in_flight -= 1
+
+    connection = make_confirm_connection(publish)
+    publisher = ConfirmPublisher(connection, channel_count=2, window=3)
+    tasks = [asyncio.create_task(publisher.publish("ex", MagicMock(), "rk")) for _ in range(5)]
+    await asyncio.sleep(0.01)
+
+    assert publisher.stats()["in_flight"] == 3
+    confirm.set()
+    await asyncio.gather(*tasks)
+
+    assert peak == 3
+    assert connection.channel.await_count == 2
+    assert publisher.stats()["confirmed"] == 5
+
+
+@pytest.mark.asyncio
+async def test_confirm_publisher_retries_nacks_then_raises(mocker):
+    """Testa a retentativa de nacks e o erro quando o broker nunca confirma."""
+    mocker.patch.object(settings, "RABBITMQ_PUBLISH_RETRIES", 2)
+    mocker.patch.object(settings, "RABBITMQ_PUBLISH_RETRY_BACKOFF", 0)
+    attempts = []
+
+    async def flaky_publish(message, routing_key, timeout=None):
+        attempts.append(routing_key)
+        if len(attempts) == 1:
+            raise DeliveryError(None, None)
+
+    publisher = ConfirmPublisher(make_confirm_connection(flaky_publish), channel_count=1, window=10)
+    await publisher.publish("ex", MagicMock(), "rk")
+    assert len(attempts) == 2
+    assert publisher.stats()["retried"] == 1
+
+    async def nack(message, routing_key, timeout=None):
+        raise DeliveryError(None, None)
+
+    publisher = ConfirmPublisher(make_confirm_connection(nack), channel_count=1, window=10)
+    with pytest.raises(PublishNackError):
+        await publisher.publish("ex", MagicMock(), "rk")
+    assert publisher.stats()["failed"] == 1
+
+
+def test_confirmed_messages_are_persistent():
+    service = RabbitMQService()
+    service.confirm_publisher = MagicMock()
+
+    message = service._build_message({"traceId": "1"})
+
+    assert message.delivery_mode == DeliveryMode.PERSISTENT
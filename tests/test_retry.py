@@ -0,0 +1,42 @@
+import pytest
+from unittest.mock import AsyncMock
+from app.core.config import settings
+from app.services import retry
+
+
+def test_backoff_delay_is_exponential_and_capped(mocker):
+    """Testa o backoff exponencial limitado pelo atraso máximo."""
+    mocker.patch.object(settings, "RETRY_BACKOFF_BASE_SECONDS", 2.0)
+    mocker.patch.object(settings, "RETRY_BACKOFF_MULTIPLIER", 3.0)
+    mocker.patch.object(settings, "RETRY_BACKOFF_MAX_SECONDS", 30.0)
+
+    assert [retry.backoff_delay(attempt) for attempt in (1, 2, 3, 4)] == [2.0, 6.0, 18.0, 30.0]
+
+
+def test_jittered_delay_never_exceeds_queue_ttl(mocker):
+    """Testa que o jitter nunca ultrapassa o TTL da fila de atraso."""
+    mocker.patch.object(settings, "RETRY_BACKOFF_JITTER", 0.5)
+    mocker.patch("app.services.retry.random.random", return_value=0.999)
+
+    delay = retry.jittered_delay(2)
+
+    assert retry.backoff_delay(2) * 0.5 <= delay <= retry.backoff_delay(2)
+
+
+@pytest.mark.asyncio
+async def test_declare_retry_topology_dead_letters_back_to_retry_queue():
+    """Testa que cada fila de atraso devolve as mensagens expiradas à fila de retry."""
+    service = AsyncMock()
+
+    await retry.declare_retry_topology(service)
+
+    delay_queues = {
+        call.args[0]: call.kwargs["arguments"]
+        for call in service.declare_queue.await_args_list
+        if "arguments" in call.kwargs
+    }
+    assert len(delay_queues) == settings.RETRY_MAX_ATTEMPTS
+    arguments = delay_queues[retry.retry_delay_queue(2)]
+    assert arguments["x-message-ttl"] == int(retry.backoff_delay(2) * 1000)
+    assert arguments["x-dead-letter-exchange"] == f"{settings.NOTIFICATION_RETRY_QUEUE}_exchange"
+    assert arguments["x-dead-letter-routing-key"] == settings.NOTIFICATION_RETRY_QUEUE
@@ -0,0 +1,69 @@
+import asyncio
+import pytest
+from unittest.mock import AsyncMock
+from app.core.metrics import REGISTRY
+from app.core.status_cache import NotificationCache
+
+
+def make_cache(mocker, loader):
+    mocker.patch("app.core.status_cache.storage.get_notification", new=loader)
+    return NotificationCache(max_entries=2, terminal_ttl=60, inflight_ttl=60)
+
+
+@pytest.mark.asyncio
+async def test_hits_are_served_from_memory(mocker):
+    """Testa que leituras repetidas não consultam o Redis."""
+    loader = AsyncMock(return_value={"traceId": "1", "status": "ENVIADO_SUCESSO"})
+    cache = make_cache(mocker, loader)
+    hits = REGISTRY.get_sample_value("status_cache_requests_total", {"result": "hit"})
+
+    first = await cache.get("1")
+    first["status"] = "alterado"
+    assert await cache.get("1") == {"traceId": "1", "status": "ENVIADO_SUCESSO"}
+    assert loader.await_count == 1
+    assert REGISTRY.get_sample_value("status_cache_requests_total", {"result": "hit"}) == hits + 1
+
+
+@pytest.mark.asyncio
+async def test_concurrent_misses_are_coalesced(mocker):
+    """Testa o single-flight: leituras simultâneas do mesmo traceId fazem uma só consulta."""
+    release = asyncio.Event()
+
+    async def loader(trace_id):
+        await release.wait()
+        return {"traceId": trace_id, "status": "RECEBIDO"}
+
+    loader = AsyncMock(side_effect=loader)
+    cache = make_cache(mocker, loader)
+    lookups = [asyncio.create_task(cache.get("1")) for _ in range(5)]
+    await asyncio.sleep(0)
+    release.set()
+
+    results = await asyncio.gather(*lookups)
+    assert all(result == {"traceId": "1", "status": "RECEBIDO"} for result in results)
+    assert loader.await_count == 1
+
+
+@pytest.mark.asyncio
+async def test_ttl_by_status_lru_and_invalidation(mocker):
+    """Testa o TTL por tipo de status, o limite LRU e a invalidação por evento."""
+    statuses = {"terminal": "ENVIADO_SUCESSO", "andamento": "RECEBIDO", "outro": "RECEBIDO"}
+    loader = AsyncMock(side_effect=lambda trace_id: {"traceId": trace_id, "status": statuses[trace_id]})
+    cache = make_cache(mocker, loader)
+    cache.inflight_ttl = 0
+
+    await cache.get("andamento")
+    await cache.get("andamento")
+    assert loader.await_count == 2  # In-flight statuses are not cached with a zero TTL
+
+    cache.inflight_ttl = 60
+    await cache.get("terminal")
+    await cache.get("andamento")
+    await cache.get("outro")
+    assert len(cache) == 2
+    await cache.get("terminal")
+    assert loader.await_count == 6  # Evicted as least recently used
+
+    cache.on_status_event("outro", 2, "ENVIADO_SUCESSO")
+    statuses["outro"] = "ENVIADO_SUCESSO"
+    assert (await cache.get("outro"))["status"] == "ENVIADO_SUCESSO"
@@ -0,0 +1,148 @@
+import asyncio
+import json
+import httpx
+import pytest
+import pytest_asyncio
+
+from app.main import app
+from app.core import storage
+from app.core.config import settings
+from app.services.status_events import StatusEventBus
+
+TRACE_ID = "5a3f1b9e-0000-4000-8000-000000000001"
+NOTIFICATION = {
+    "traceId": TRACE_ID,
+    "mensagemId": "5a3f1b9e-0000-4000-8000-000000000002",
+    "conteudoMensagem": "Stream",
+    "channel": "email",
+    "status": "RECEBIDO",
+}
+
+
+@pytest_asyncio.fixture(autouse=True)
+async def clean_storage():
+    """Limpa o armazenamento e encerra as conexões do event loop do teste."""
+    await storage.clear_storage()
+    yield
+    status_events = getattr(app.state, "status_events", None)
+    if status_events:
+        await status_events.close()
+    await storage.close()
+
+
+@pytest_asyncio.fixture
+async def client():
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://testserver") as client:
+        yield client
+
+
+async def change_statuses(*statuses, delay=0.05):
+    for status in statuses:
+        await asyncio.sleep(delay)
+        await storage.set_status(TRACE_ID, status)
+
+
+@pytest.mark.asyncio
+async def test_event_bus_delivers_status_changes():
+    """Testa que cada set_status é publicado para os assinantes do traceId."""
+    await storage.set_notification(TRACE_ID, NOTIFICATION)
+    bus = StatusEventBus()
+    subscription = await bus.subscribe([TRACE_ID])
+    other = await bus.subscribe(["outro-trace-id"])
+
+    await storage.set_status(TRACE_ID, "PROCESSADO_INTERMEDIARIO")
+
+    assert await subscription.get(timeout=1) == (TRACE_ID, 1, "PROCESSADO_INTERMEDIARIO")
+    assert await other.get(timeout=0.1) is None
+    await subscription.close()
+    assert bus.stats()["watched"] == 1
+    await bus.close()
+
+
+@pytest.mark.asyncio
+async def test_event_bus_retries_failed_resubscribe(mocker):
+    """Testa que, se a primeira reassinatura falhar, o leitor continua tentando e volta a entregar os eventos."""
+    mocker.patch.object(settings, "STATUS_STREAM_RECONNECT_SECONDS", 0.01)
+    await storage.set_notification(TRACE_ID, NOTIFICATION)
+    bus = StatusEventBus()
+    subscription = await bus.subscribe([TRACE_ID])
+    resubscribe = bus._resubscribe
+    attempts, resubscribed = [], asyncio.Event()
+
+    async def flaky_resubscribe():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise ConnectionError("Redis indisponível")
+        await resubscribe()
+        resubscribed.set()
+
+    mocker.patch.object(bus._pubsub, "get_message", side_effect=ConnectionError("conexão perdida"))
+    mocker.patch.object(bus, "_resubscribe", side_effect=flaky_resubscribe)
+
+    await asyncio.wait_for(resubscribed.wait(), 1)
+    await storage.set_status(TRACE_ID, "PROCESSADO_INTERMEDIARIO")
+
+    assert await subscription.get(timeout=1) == (TRACE_ID, 1, "PROCESSADO_INTERMEDIARIO")
+    assert not bus._reader.done()
+    await bus.close()
+
+
+@pytest.mark.asyncio
+async def test_sse_stream_until_terminal_status(client):
+    """Testa o stream SSE: status atual, mudanças seguintes e fim no status terminal."""
+    await storage.set_notification(TRACE_ID, NOTIFICATION)
+    changes = asyncio.create_task(change_statuses("PROCESSADO_INTERMEDIARIO", "ENVIADO_SUCESSO"))
+
+    response = await client.get(f"/api/notificacao/status/{TRACE_ID}/stream")
+    await changes
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    events = [json.loads(line[len("data: "):]) for line in response.text.splitlines() if line.startswith("data: ")]
+    assert [event["status"] for event in events] == ["RECEBIDO", "PROCESSADO_INTERMEDIARIO", "ENVIADO_SUCESSO"]
+
+
+@pytest.mark.asyncio
+async def test_sse_stream_not_found(client):
+    response = await client.get("/api/notificacao/status/inexistente/stream")
+    assert response.status_code == 404
+    assert app.state.status_events.stats()["watched"] == 0
+
+
+@pytest.mark.asyncio
+async def test_websocket_multiplexes_subscriptions():
+    """Testa a assinatura de vários traceIds em um único WebSocket."""
+    await storage.set_notification(TRACE_ID, NOTIFICATION)
+    incoming = asyncio.Queue()
+    sent = asyncio.Queue()
+    await incoming.put({"type": "websocket.connect"})
+    await incoming.put({"type": "websocket.receive", "text": json.dumps({"action": "subscribe", "traceIds": [TRACE_ID, "inexistente"]})})
+    scope = {
+        "type": "websocket",
+        "path": "/api/notificacao/status/ws",
+        "raw_path": b"/api/notificacao/status/ws",
+        "query_string": b"",
+        "headers": [],
+        "scheme": "ws",
+        "server": ("testserver", 80),
+        "client": ("testclient", 50000),
+        "subprotocols": [],
+        "app": app,
+    }
+    connection = asyncio.create_task(app(scope, incoming.get, sent.put))
+
+    async def next_json():
+        message = await asyncio.wait_for(sent.get(), 1)
+        return json.loads(message["text"])
+
+    assert (await asyncio.wait_for(sent.get(), 1))["type"] == "websocket.accept"
+    assert await next_json() == {"traceId": TRACE_ID, "status": "RECEBIDO"}
+    assert await next_json() == {"traceId": "inexistente", "error": "Notification not found"}
+
+    await storage.set_status(TRACE_ID, "ENVIADO_SUCESSO")
+    assert await next_json() == {"traceId": TRACE_ID, "status": "ENVIADO_SUCESSO"}
+
+    await incoming.put({"type": "websocket.disconnect", "code": 1000})
+    await asyncio.wait_for(connection, 1)
+    assert app.state.status_events.stats()["watched"] == 0
@@ -0,0 +1,265 @@
+import time
+import uuid
+import pytest
+import pytest_asyncio
+from redis.asyncio.connection import AbstractConnection
+
+from app.core import storage
+from app.core.config import settings
+
+
+@pytest_asyncio.fixture(autouse=True)
+async def clear_storage_before_each_test():
+    """Garante que o armazenamento esteja limpo antes de cada teste."""
+    await storage.clear_storage()
+    yield
+    await storage.close()
+
+
+async def create_notification(status: str = "RECEBIDO", channel: str = "email", mensagem_id: str = None, received_at: float = None) -> str:
+    trace_id = str(uuid.uuid4())
+    data = {
+        "traceId": trace_id,
+        "mensagemId": mensagem_id or str(uuid.uuid4()),
+        "conteudoMensagem": "Teste",
+        "channel": channel,
+        "status": status,
+    }
+    if received_at is not None:
+        data["recebidoEm"] = received_at
+    await storage.set_notification(trace_id, data)
+    return trace_id
+
+
+@pytest.mark.asyncio
+async def test_set_status_updates_only_status_field():
+    """Testa que a transição altera apenas o campo de status."""
+    trace_id = await create_notification()
+
+    assert await storage.set_status(trace_id, "PROCESSADO_INTERMEDIARIO") is True
+
+    stored = await storage.get_notification(trace_id)
+    assert stored["status"] == "PROCESSADO_INTERMEDIARIO"
+    assert stored["conteudoMensagem"] == "Teste"
+
+
+@pytest.mark.asyncio
+async def test_get_notification_reads_records_from_previous_codec(mocker):
+    """Testa que registros gravados com outro codec continuam legíveis."""
+    mocker.patch.object(settings, "MESSAGE_CODEC", "msgpack")
+    trace_id = await create_notification()
+
+    mocker.patch.object(settings, "MESSAGE_CODEC", "json")
+    stored = await storage.get_notification(trace_id)
+
+    assert stored["traceId"] == trace_id
+    assert stored["status"] == "RECEBIDO"
+
+
+@pytest.mark.asyncio
+async def test_set_status_missing_notification():
+    """Testa que não é criado registro para traceId inexistente."""
+    trace_id = str(uuid.uuid4())
+
+    assert await storage.set_status(trace_id, "RECEBIDO") is False
+    assert await storage.get_notification(trace_id) is None
+
+
+@pytest.mark.asyncio
+async def test_set_status_unless_protects_terminal_status():
+    """Testa que um RECEBIDO atrasado não sobrescreve ENVIADO_SUCESSO."""
+    trace_id = await create_notification(status="ENVIADO_SUCESSO")
+
+    applied = await storage.set_status(trace_id, "RECEBIDO", unless=storage.TERMINAL_STATUSES)
+
+    assert applied is False
+    assert (await storage.get_notification(trace_id))["status"] == "ENVIADO_SUCESSO"
+
+
+@pytest.mark.asyncio
+async def test_set_status_compare_and_set():
+    """Testa a semântica de compare-and-set com status esperado."""
+    trace_id = await create_notification(status="RECEBIDO")
+
+    assert await storage.set_status(trace_id, "ENVIADO_SUCESSO", expected=["Validating/Sending"]) is False
+    assert await storage.set_status(trace_id, "PROCESSADO_INTERMEDIARIO", expected=["RECEBIDO"]) is True
+    assert (await storage.get_notification(trace_id))["status"] == "PROCESSADO_INTERMEDIARIO"
+
+
+@pytest.mark.asyncio
+async def test_set_status_rejects_both_conditions():
+    with pytest.raises(ValueError):
+        await storage.set_status("abc", "RECEBIDO", expected=["A"], unless=["B"])
+
+
+@pytest.mark.asyncio
+async def test_write_behind_flushes_pipelined_status_updates():
+    """Testa que o write-behind grava os status em lote no Redis."""
+    trace_ids = [await create_notification() for _ in range(3)]
+    storage.start_write_behind()
+
+    for trace_id in trace_ids:
+        await storage.set_status(trace_id, "PROCESSADO_INTERMEDIARIO")
+        await storage.set_status(trace_id, "ENVIADO_SUCESSO")
+    await storage.set_status(trace_ids[0], "RECEBIDO", unless=storage.TERMINAL_STATUSES)
+    await storage.stop_write_behind()
+
+    for trace_id in trace_ids:
+        assert (await storage.get_notification(trace_id))["status"] == "ENVIADO_SUCESSO"
+
+
+@pytest.mark.asyncio
+async def test_records_use_key_prefix_and_status_ttls(mocker):
+    """Testa o prefixo das chaves e a retenção separada de registros em andamento e finalizados."""
+    mocker.patch.object(settings, "NOTIFICATION_INFLIGHT_TTL_SECONDS", 3600)
+    mocker.patch.object(settings, "NOTIFICATION_TERMINAL_TTL_SECONDS", 60)
+    trace_id = await create_notification()
+    client = storage.get_client()
+    key = f"{settings.REDIS_KEY_PREFIX}n:{trace_id}"
+
+    assert await client.exists(trace_id) == 0
+    assert 3590 < await client.ttl(key) <= 3600
+
+    await storage.set_status(trace_id, "ENVIADO_SUCESSO")
+    assert 0 < await client.ttl(key) <= 60
+
+    await storage.set_status(trace_id, "DLQ_RECEIVED")
+    assert 3590 < await client.ttl(key) <= 3600
+
+    mocker.patch.object(settings, "NOTIFICATION_TERMINAL_TTL_SECONDS", 0)
+    await storage.set_status(trace_id, "ENVIADO_SUCESSO")
+    assert await client.ttl(key) == -1
+
+
+@pytest.mark.asyncio
+async def test_drop_content_after_dispatch(mocker):
+    """Testa que o conteúdo da mensagem é descartado do registro após o envio."""
+    mocker.patch.object(settings, "STORAGE_DROP_CONTENT_AFTER_DISPATCH", True)
+    trace_id = await create_notification()
+
+    await storage.set_status(trace_id, "PROCESSADO_INTERMEDIARIO")
+    assert (await storage.get_notification(trace_id))["conteudoMensagem"] == "Teste"
+
+    await storage.set_status(trace_id, "ENVIADO_SUCESSO")
+    stored = await storage.get_notification(trace_id)
+    assert stored["conteudoMensagem"] is None
+    assert stored["status"] == "ENVIADO_SUCESSO"
+
+
+@pytest.mark.asyncio
+async def test_clear_storage_only_deletes_prefixed_keys():
+    """Testa que clear_storage não apaga chaves fora do prefixo das notificações."""
+    trace_id = await create_notification()
+    client = storage.get_client()
+    await client.set("outra:chave", "mantida")
+
+    await storage.clear_storage()
+
+    assert await storage.get_notification(trace_id) is None
+    assert await client.get("outra:chave") == b"mantida"
+    await client.delete("outra:chave")
+
+
+@pytest.mark.asyncio
+async def test_record_sizes_groups_by_status(mocker):
+    """Testa o relatório de bytes por registro, separado por status terminal e em andamento."""
+    # Backend em memória: responde MEMORY USAGE com erro, exercitando o fallback para o tamanho dos campos
+    await storage.close()
+    mocker.patch.object(settings, "STORAGE_BACKEND", "memory")
+    await storage.clear_storage()
+    for _ in range(2):
+        await create_notification()
+    await create_notification(status="ENVIADO_SUCESSO")
+
+    sizes = await storage.record_sizes(sample=10)
+
+    assert sizes["in_flight"]["records"] == 2
+    assert sizes["terminal"]["records"] == 1
+    assert sizes["in_flight"]["payload_bytes"] > len("Teste")
+    assert sizes["in_flight"]["memory_bytes"] is None
+
+
+@pytest.mark.asyncio
+async def test_status_indexes_follow_transitions():
+    """Testa que os índices por status e canal acompanham as transições e alimentam as contagens."""
+    failed = [await create_notification() for _ in range(2)]
+    await create_notification()
+    await create_notification(channel="sms")
+    for trace_id in failed:
+        assert await storage.set_status(trace_id, "FALHA_ENVIO_FINAL") is True
+
+    assert await storage.status_counts() == {
+        "RECEBIDO": {"email": 1, "sms": 1},
+        "FALHA_ENVIO_FINAL": {"email": 2},
+    }
+    entries, next_cursor = await storage.list_by_status("FALHA_ENVIO_FINAL")
+    assert sorted(trace_id for trace_id, _, _ in entries) == sorted(failed)
+    assert {channel for _, channel, _ in entries} == {"email"}
+    assert next_cursor is None
+
+
+@pytest.mark.asyncio
+async def test_set_status_updates_indexes_in_one_round_trip(mocker):
+    """Testa que a transição e a atualização dos índices são uma única chamada ao Redis, sem leitura prévia do registro."""
+    trace_id = await create_notification()
+    sends = mocker.spy(AbstractConnection, "send_packed_command")
+
+    assert await storage.set_status(trace_id, "FALHA_ENVIO_FINAL") is True
+
+    assert sends.await_count == 1
+    assert await storage.status_counts() == {"FALHA_ENVIO_FINAL": {"email": 1}}
+
+
+@pytest.mark.asyncio
+async def test_list_by_status_pages_with_cursor():
+    """Testa a paginação por cursor entre canais, sem repetir nem perder notificações, e os filtros de canal e data."""
+    now = time.time()
+    email = [await create_notification(status="FALHA_ENVIO_FINAL", received_at=now - i) for i in range(3)]
+    sms = [await create_notification(status="FALHA_ENVIO_FINAL", channel="sms", received_at=now - 0.5 - i) for i in range(2)]
+
+    seen, cursor = [], None
+    while True:
+        entries, cursor = await storage.list_by_status("FALHA_ENVIO_FINAL", limit=2, cursor=cursor)
+        assert len(entries) <= 2
+        seen.extend(trace_id for trace_id, _, _ in entries)
+        if cursor is None:
+            break
+    assert seen == [email[0], sms[0], email[1], sms[1], email[2]]
+
+    entries, _ = await storage.list_by_status("FALHA_ENVIO_FINAL", channel="sms")
+    assert [trace_id for trace_id, _, _ in entries] == sms
+    entries, _ = await storage.list_by_status("FALHA_ENVIO_FINAL", since=now - 1.2)
+    assert [trace_id for trace_id, _, _ in entries] == [email[0], sms[0], email[1]]
+    with pytest.raises(ValueError):
+        await storage.list_by_status("FALHA_ENVIO_FINAL", cursor="invalido")
+
+
+@pytest.mark.asyncio
+async def test_indexes_skip_expired_records(mocker):
+    """Testa que entradas de registros já expirados pelo TTL do status não aparecem nas listagens nem nas contagens."""
+    mocker.patch.object(settings, "NOTIFICATION_INFLIGHT_TTL_SECONDS", 60)
+    await create_notification(received_at=time.time() - 120)
+    current = await create_notification()
+
+    entries, _ = await storage.list_by_status("RECEBIDO")
+    assert [trace_id for trace_id, _, _ in entries] == [current]
+    assert await storage.status_counts() == {"RECEBIDO": {"email": 1}}
+
+
+@pytest.mark.asyncio
+async def test_list_by_message_id_returns_every_trace_id():
+    """Testa o índice mensagemId -> traceIds, do mais recente ao mais antigo, com o status atual."""
+    mensagem_id = str(uuid.uuid4())
+    first = await create_notification(mensagem_id=mensagem_id, received_at=time.time() - 10)
+    second = await create_notification(mensagem_id=mensagem_id)
+    await storage.set_status(second, "ENVIADO_SUCESSO")
+
+    entries, next_cursor = await storage.list_by_message_id(mensagem_id)
+
+    assert [trace_id for trace_id, _ in entries] == [second, first]
+    assert next_cursor is None
+    assert await storage.get_statuses([second, first, str(uuid.uuid4())]) == [
+        ("ENVIADO_SUCESSO", "email"),
+        ("RECEBIDO", "email"),
+        None,
+    ]
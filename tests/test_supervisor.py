@@ -0,0 +1,166 @@
+import pytest
+from app.core.config import settings
+from app.supervisor import WorkerSupervisor, build_process_specs
+
+
+class FakeProcess:
+    """Processo falso controlado pelo teste."""
+
+    pids = iter(range(1000, 2000))
+
+    def __init__(self, target, args, kwargs, name):
+        self.args = args
+        self.kwargs = kwargs
+        self.pid = None
+        self.exitcode = None
+        self.alive = False
+        self.terminated = False
+
+    def start(self):
+        self.pid = next(self.pids)
+        self.alive = True
+
+    def is_alive(self):
+        return self.alive
+
+    def crash(self, exitcode=1):
+        self.alive = False
+        self.exitcode = exitcode
+
+    def terminate(self):
+        self.terminated = True
+        self.crash(0)
+
+    def join(self, timeout=None):
+        pass
+
+
+def test_build_process_specs():
+    """Testa a divisão das filas entre processos compartilhados e dedicados."""
+    queues = ["entrada", "validacao", "dlq"]
+
+    assert build_process_specs(queues, processes=2) == [(queues, None), (queues, None)]
+    assert build_process_specs(queues, processes=2, queue_processes={"validacao": 3}) == [
+        (["validacao"], None), (["validacao"], None), (["validacao"], None),
+        (["entrada", "dlq"], None), (["entrada", "dlq"], None),
+    ]
+
+
+def test_build_process_specs_splits_shards_round_robin(mocker):
+    """Testa que os processos de um mesmo grupo de filas dividem os shards em vez de consumir todos."""
+    entrada, validacao, dlq = settings.NOTIFICATION_INPUT_QUEUE, settings.NOTIFICATION_VALIDATION_QUEUE, settings.NOTIFICATION_DLQ
+    mocker.patch.object(settings, "QUEUE_SHARDS", {entrada: 4, validacao: 2})
+
+    assert build_process_specs([entrada, dlq], processes=2) == [([entrada, dlq], [0, 2]), ([entrada, dlq], [1, 3])]
+    assert build_process_specs([entrada, dlq], processes=2, shards=[1, 2, 3]) == [([entrada, dlq], [1, 3]), ([entrada, dlq], [2])]
+    assert build_process_specs([validacao, dlq], processes=1, queue_processes={validacao: 3}) == [
+        ([validacao], [0]), ([validacao], [1]), ([validacao], [0]),
+        ([dlq], None),
+    ]
+
+
+def test_build_process_specs_rejects_shards_out_of_range(mocker):
+    """Testa que um shard inexistente nas filas do grupo é rejeitado em vez de ignorado."""
+    entrada, validacao, dlq = settings.NOTIFICATION_INPUT_QUEUE, settings.NOTIFICATION_VALIDATION_QUEUE, settings.NOTIFICATION_DLQ
+    mocker.patch.object(settings, "QUEUE_SHARDS", {entrada: 4, validacao: 2})
+
+    with pytest.raises(ValueError):
+        build_process_specs([entrada, dlq], processes=2, shards=[1, 4])
+    with pytest.raises(ValueError):
+        build_process_specs([validacao], processes=1, shards=[-1])
+    # Shards of the most sharded queue of the group are valid, and unsharded queues ignore claims
+    assert build_process_specs([entrada, validacao], processes=1, shards=[3]) == [([entrada, validacao], [3])]
+    assert build_process_specs([dlq], processes=1, shards=[5]) == [([dlq], None)]
+
+
+def test_supervisor_passes_each_child_its_shards():
+    """Testa que cada processo filho recebe apenas os seus shards."""
+    supervisor = WorkerSupervisor([(["entrada"], [0, 2]), (["entrada"], [1, 3])], target=None, target_kwargs={"shards": None}, process_factory=FakeProcess)
+    supervisor.start()
+
+    assert [worker.process.kwargs["shards"] for worker in supervisor.workers] == [[0, 2], [1, 3]]
+
+
+def test_supervisor_restarts_crashed_children(mocker):
+    """Testa que processos filhos que morrem são reiniciados após o backoff."""
+    mocker.patch.object(settings, "WORKER_RESTART_BACKOFF_SECONDS", 0)
+    supervisor = WorkerSupervisor([(["entrada"], None), (["validacao"], None)], target=None, target_kwargs={"prefetch": 5}, process_factory=FakeProcess)
+    supervisor.start()
+    crashed = supervisor.workers[1].process
+    assert crashed.args == ("validacao",)
+    assert crashed.kwargs == {"prefetch": 5}
+
+    crashed.crash()
+    assert supervisor.health()["status"] == "degraded"
+
+    supervisor.check_children()
+
+    worker = supervisor.workers[1]
+    assert worker.process is not crashed
+    assert worker.process.is_alive()
+    assert worker.restarts == 1
+    health = supervisor.health()
+    assert health["status"] == "ok"
+    assert health["alive"] == health["total"] == 2
+
+
+def test_supervisor_does_not_restart_clean_exits():
+    """Testa que um filho que sai com código 0 não é reiniciado e que o supervisor para quando todos saíram."""
+    supervisor = WorkerSupervisor([(["entrada"], None), (["validacao"], None)], target=None, process_factory=FakeProcess)
+    supervisor.start()
+    first, second = (worker.process for worker in supervisor.workers)
+
+    first.crash(0)
+    supervisor.check_children()
+
+    assert supervisor.workers[0].process is first
+    assert supervisor.workers[0].restarts == 0
+    assert supervisor.health()["processes"][0]["finished"] is True
+    assert not supervisor.stopping
+    second.crash(0)
+    supervisor.check_children()
+    assert supervisor.stopping
+
+
+def test_supervisor_health_reports_crash_loops(mocker):
+    """Testa que a saúde aponta o filho em crash loop, mesmo vivo entre as falhas, até ele ficar estável."""
+    mocker.patch.object(settings, "WORKER_RESTART_BACKOFF_SECONDS", 0)
+    mocker.patch.object(settings, "WORKER_CRASH_LOOP_FAILURES", 3)
+    supervisor = WorkerSupervisor([(["entrada"], None)], target=None, process_factory=FakeProcess)
+    supervisor.start()
+
+    for _ in range(3):
+        supervisor.workers[0].process.crash()
+        supervisor.check_children()
+
+    health = supervisor.health()
+    assert health["alive"] == 1
+    assert health["status"] == "degraded"
+    assert health["restarts"] == 3 and health["crash_looping"] == 1
+    assert health["processes"][0]["consecutive_failures"] == 3
+
+    mocker.patch.object(settings, "WORKER_RESTART_RESET_SECONDS", 0)
+    supervisor.check_children()
+    assert supervisor.health()["status"] == "ok"
+
+
+def test_supervisor_does_not_restart_while_stopping():
+    supervisor = WorkerSupervisor([(["entrada"], None)], target=None, process_factory=FakeProcess)
+    supervisor.start()
+    process = supervisor.workers[0].process
+
+    supervisor.stop()
+    supervisor.shutdown()
+    supervisor.check_children()
+
+    assert process.terminated
+    assert supervisor.workers[0].process is process
+    assert supervisor.workers[0].restarts == 0
+
+
+def test_supervisor_offsets_metrics_port_per_child():
+    """Testa que cada processo filho expõe /metrics em sua própria porta."""
+    supervisor = WorkerSupervisor([(["entrada"], None), (["validacao"], None)], target=None, target_kwargs={"metrics_port": 9100}, process_factory=FakeProcess)
+    supervisor.start()
+
+    assert [worker.process.kwargs["metrics_port"] for worker in supervisor.workers] == [9100, 9101]
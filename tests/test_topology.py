@@ -0,0 +1,60 @@
+import uuid
+import pytest
+from app.bench import run_benchmark
+from app.core.codec import codec_for_content_type
+from app.core.config import settings
+from app.services.memory_broker import InMemoryRabbitMQService
+from app.services.topology import check_shards, declare_stage, publish_batch_to_stage, publish_to_stage, shard_queues
+
+INPUT = settings.NOTIFICATION_INPUT_QUEUE
+
+
+def test_shard_queues_follow_settings_and_claimed_shards(mocker):
+    """Testa os nomes das filas de shard, a seleção de shards e as filas que não podem ser fragmentadas."""
+    mocker.patch.object(settings, "QUEUE_SHARDS", {INPUT: 4, settings.NOTIFICATION_RETRY_QUEUE: 4})
+
+    assert shard_queues(INPUT) == [f"{INPUT}.shard.{n}" for n in range(4)]
+    assert shard_queues(INPUT, [1, 3]) == [f"{INPUT}.shard.1", f"{INPUT}.shard.3"]
+    assert shard_queues(f"{INPUT}.alta") == [f"{INPUT}.alta"]
+    assert shard_queues(settings.NOTIFICATION_RETRY_QUEUE) == [settings.NOTIFICATION_RETRY_QUEUE]
+    check_shards([INPUT], [0, 3])
+    with pytest.raises(ValueError):
+        check_shards([INPUT], [2, 4])
+
+
+@pytest.mark.asyncio
+async def test_sharded_stage_keeps_each_trace_id_on_one_shard(mocker):
+    """Testa que o exchange de hash consistente distribui por traceId e mantém cada traceId em um único shard."""
+    mocker.patch.object(settings, "QUEUE_SHARDS", {INPUT: 4})
+    broker = InMemoryRabbitMQService()
+    await declare_stage(broker, INPUT)
+    messages = [{"traceId": str(uuid.uuid4())} for _ in range(40)]
+
+    assert await publish_batch_to_stage(broker, messages, INPUT) == [None] * 40
+    for message in messages[:10]:
+        await publish_to_stage(broker, message, INPUT)
+
+    shards = {}
+    for queue_name in shard_queues(INPUT):
+        for delivered in broker.broker_queues[queue_name].messages:
+            trace_id = codec_for_content_type(delivered.content_type).decode(delivered.body)["traceId"]
+            shards.setdefault(trace_id, set()).add(queue_name)
+    assert sum(len(broker.broker_queues[q].messages) for q in shard_queues(INPUT)) == 50
+    assert all(len(queues) == 1 for queues in shards.values())
+    assert len({q for queues in shards.values() for q in queues}) > 1
+    await broker.close()
+
+
+@pytest.mark.asyncio
+async def test_benchmark_runs_with_sharded_stages(mocker):
+    """Testa o pipeline completo com as etapas de entrada, validação e envio fragmentadas."""
+    mocker.patch.object(settings, "QUEUE_SHARDS", {
+        INPUT: 3,
+        settings.NOTIFICATION_VALIDATION_QUEUE: 2,
+        f"{settings.NOTIFICATION_CHANNEL_QUEUE_PREFIX}email": 2,
+    })
+
+    result = await run_benchmark(count=40, seed=3, batch_size=10)
+
+    assert sum(result["final_statuses"].values()) == 40
+    assert set(result["final_statuses"]) <= {"ENVIADO_SUCESSO", "DLQ_RECEIVED"}
@@ -1,16 +1,32 @@
 import pytest
+import pytest_asyncio
 import json
+import msgpack
 from unittest.mock import AsyncMock, MagicMock
-from app.worker import process_message
+import asyncio
+from app.worker import process_message, limit_concurrency, resolve_consumer_limits, parse_queue_overrides, InFlightTracker
 from app.services.rabbitmq import RabbitMQService
 from app.tasks.message_tasks import (
     process_initial_notification,
     process_retry_notification,
     process_final_notification,
+    process_channel_notification,
     process_dlq_message,
 )
+from app.core import metrics, storage
+from app.core.dedup import processed_set
+from app.services.dispatcher import close_dispatchers
+from app.core.exceptions import PublishNackError
 from app.core.config import settings
 
+@pytest_asyncio.fixture(autouse=True)
+async def clean_storage():
+    """Limpa o armazenamento usado pela deduplicação do process_message e fecha o cliente do event loop do teste."""
+    await storage.clear_storage()
+    yield
+    await close_dispatchers()
+    await storage.close()
+
 @pytest.fixture
 def mock_rabbitmq_service():
     """Fixture para mockar RabbitMQService."""
@@ -26,6 +42,7 @@ def mock_incoming_message():
     mock_context_manager.__aenter__.return_value = None
     mock_context_manager.__aexit__.return_value = None
     message.process.return_value = mock_context_manager
+    message.headers = {}
     return message
 
 @pytest.mark.asyncio
@@ -40,7 +57,7 @@ async def test_process_message_success(mock_incoming_message, mock_rabbitmq_serv
     await process_message(mock_incoming_message, mock_task_func, mock_rabbitmq_service)
 
     mock_incoming_message.process.assert_called_once()
-    mock_task_func.assert_called_once_with(test_data, mock_rabbitmq_service)
+    mock_task_func.assert_called_once_with(test_data, mock_rabbitmq_service, headers={})
 
 @pytest.mark.asyncio
 async def test_process_message_error_handling(mock_incoming_message, mock_rabbitmq_service, mocker):
@@ -58,10 +75,70 @@ async def test_process_message_error_handling(mock_incoming_message, mock_rabbit
     await process_message(mock_incoming_message, mock_task_func, mock_rabbitmq_service)
 
     mock_incoming_message.process.assert_called_once()
-    mock_task_func.assert_called_once_with(test_data, mock_rabbitmq_service)
+    mock_task_func.assert_called_once_with(test_data, mock_rabbitmq_service, headers={})
     mock_logger_error.assert_called_once()
     assert "Error processing message" in mock_logger_error.call_args[0][0]
 
+@pytest.mark.asyncio
+async def test_process_message_records_stage_metrics(mock_incoming_message, mock_rabbitmq_service):
+    """Testa que a duração e o resultado de cada etapa são contabilizados."""
+    mock_incoming_message.body = json.dumps({"traceId": "789"}).encode()
+
+    async def metrics_stage(data, rabbitmq_service, headers=None):
+        raise Exception("Simulated task error")
+
+    await process_message(mock_incoming_message, metrics_stage, mock_rabbitmq_service)
+
+    sample = metrics.REGISTRY.get_sample_value
+    assert sample("notification_stage_messages_total", {"stage": "metrics_stage", "outcome": "error"}) == 1
+    assert sample("notification_stage_messages_total", {"stage": "metrics_stage", "outcome": "success"}) == 0
+    assert sample("notification_stage_in_flight", {"stage": "metrics_stage"}) == 0
+    assert sample("notification_stage_duration_seconds_count", {"stage": "metrics_stage"}) == 1
+
+@pytest.mark.asyncio
+async def test_process_message_decodes_by_content_type(mock_incoming_message, mock_rabbitmq_service):
+    """Testa que o consumidor decodifica conforme o content_type declarado."""
+    test_data = {"traceId": "987"}
+    mock_incoming_message.body = msgpack.packb(test_data)
+    mock_incoming_message.content_type = "application/msgpack"
+    mock_task_func = AsyncMock()
+
+    await process_message(mock_incoming_message, mock_task_func, mock_rabbitmq_service)
+
+    mock_task_func.assert_called_once_with(test_data, mock_rabbitmq_service, headers={})
+
+@pytest.mark.asyncio
+async def test_process_message_requeues_when_next_hop_is_not_confirmed(mock_incoming_message, mock_rabbitmq_service):
+    """Testa que a mensagem volta para a fila quando o broker não confirma a próxima etapa."""
+    mock_incoming_message.body = json.dumps({"traceId": "654"}).encode()
+    mock_incoming_message.nack = AsyncMock()
+    mock_task_func = AsyncMock(side_effect=PublishNackError("nack"))
+
+    await process_message(mock_incoming_message, mock_task_func, mock_rabbitmq_service)
+
+    mock_incoming_message.nack.assert_awaited_once_with(requeue=True)
+
+@pytest.mark.asyncio
+async def test_process_message_skips_already_processed_delivery(mock_incoming_message, mock_rabbitmq_service, mocker):
+    """Testa que uma reentrega de uma etapa já concluída é confirmada sem executar a etapa de novo."""
+    trace_id = "dedup-1"
+    await storage.set_notification(trace_id, {"traceId": trace_id, "conteudoMensagem": "Uma vez", "status": "RECEBIDO"})
+    mock_incoming_message.body = json.dumps({"traceId": trace_id}).encode()
+    mock_incoming_message.content_type = "application/json"
+    calls = []
+
+    async def stage_once(data, rabbitmq_service, headers=None):
+        calls.append(data)
+
+    await process_message(mock_incoming_message, stage_once, mock_rabbitmq_service)
+    processed_set.clear()  # a reentrega pode cair em outro worker
+    await process_message(mock_incoming_message, stage_once, mock_rabbitmq_service)
+    mock_incoming_message.headers = {"x-retry-attempt": 2}
+    await process_message(mock_incoming_message, stage_once, mock_rabbitmq_service)
+
+    assert len(calls) == 2
+    assert metrics.REGISTRY.get_sample_value("notification_stage_messages_total", {"stage": "stage_once", "outcome": "duplicate"}) == 1
+
 @pytest.mark.asyncio
 async def test_process_message_invalid_json(mock_incoming_message, mock_rabbitmq_service, mocker):
     """Testa o tratamento de mensagem com JSON inválido."""
@@ -75,8 +152,231 @@ async def test_process_message_invalid_json(mock_incoming_message, mock_rabbitmq
     mock_incoming_message.process.assert_called_once() # Message should still be processed/acked
     mock_task_func.assert_not_called() # Task function should not be called
     mock_logger_error.assert_called_once()
-    assert "Error processing message" in mock_logger_error.call_args[0][0]
-    assert "Expecting value" in mock_logger_error.call_args[0][0] # More specific to JSONDecodeError message
+    # Logged with lazy formatting: the message is only built when the record is emitted
+    logged = mock_logger_error.call_args[0][0] % mock_logger_error.call_args[0][1:]
+    assert "Error processing message" in logged
+    assert "Expecting value" in logged # More specific to JSONDecodeError message
+
+@pytest.mark.asyncio
+async def test_process_final_notification_routes_to_channel_queue(mock_rabbitmq_service, mocker):
+    """Testa que a validação aguarda o armazenamento e encaminha para a fila do canal."""
+    mock_set_status = mocker.patch('app.tasks.message_tasks.storage.set_status', new_callable=AsyncMock)
+
+    await process_final_notification({"traceId": "789", "channel": "push"}, mock_rabbitmq_service)
+
+    assert [call.args for call in mock_set_status.await_args_list] == [("789", "Validating/Sending")]
+    assert mock_set_status.await_args.kwargs == {"unless": storage.TERMINAL_STATUSES}
+    mock_rabbitmq_service.publish_message.assert_awaited_once_with(
+        {"traceId": "789", "channel": "push"},
+        routing_key="fila.notificacao.envio.push",
+        exchange_name="fila.notificacao.envio.push_exchange",
+    )
+
+@pytest.mark.asyncio
+async def test_process_final_notification_routes_high_priority_to_its_lane(mock_rabbitmq_service, mocker):
+    """Testa que notificações de prioridade alta seguem pela fila da faixa alta do canal."""
+    mocker.patch('app.tasks.message_tasks.storage.set_status', new_callable=AsyncMock)
+    data = {"traceId": "792", "channel": "sms", "prioridade": "alta"}
+
+    await process_final_notification(data, mock_rabbitmq_service)
+
+    mock_rabbitmq_service.publish_message.assert_awaited_once_with(
+        data,
+        routing_key="fila.notificacao.envio.sms.alta",
+        exchange_name="fila.notificacao.envio.sms.alta_exchange",
+    )
+
+@pytest.mark.asyncio
+async def test_process_channel_notification_records_end_to_end_time(mock_rabbitmq_service, mocker):
+    """Testa o envio pelo provedor do canal e a medição do tempo entre RECEBIDO e o status terminal."""
+    mock_set_status = mocker.patch('app.tasks.message_tasks.storage.set_status', new_callable=AsyncMock, return_value=True)
+    mocker.patch.object(settings, "SIMULATED_LATENCY_SCALE", 0)
+    mocker.patch('app.services.providers.random.random', return_value=0.99)
+    mocker.patch('app.core.metrics.time.time', return_value=1002.5)
+    labels = {"status": "ENVIADO_SUCESSO", "priority": "normal"}
+    count = metrics.REGISTRY.get_sample_value("notification_end_to_end_seconds_count", labels) or 0
+    total = metrics.REGISTRY.get_sample_value("notification_end_to_end_seconds_sum", labels) or 0
+
+    await process_channel_notification({"traceId": "790", "channel": "push", "recebidoEm": 1000.0}, mock_rabbitmq_service)
+
+    assert mock_set_status.await_args.args == ("790", "ENVIADO_SUCESSO")
+    assert metrics.REGISTRY.get_sample_value("notification_end_to_end_seconds_count", labels) == count + 1
+    assert metrics.REGISTRY.get_sample_value("notification_end_to_end_seconds_sum", labels) == pytest.approx(total + 2.5)
+
+@pytest.mark.asyncio
+async def test_process_channel_notification_sends_provider_failures_to_dlq(mock_rabbitmq_service, mocker):
+    """Testa que uma falha do provedor marca FALHA_ENVIO_FINAL e envia a mensagem para a DLQ."""
+    mock_set_status = mocker.patch('app.tasks.message_tasks.storage.set_status', new_callable=AsyncMock, return_value=True)
+    mocker.patch.object(settings, "SIMULATED_LATENCY_SCALE", 0)
+    mocker.patch('app.services.providers.random.random', return_value=0.0)
+
+    await process_channel_notification({"traceId": "791", "channel": "sms"}, mock_rabbitmq_service)
+
+    assert mock_set_status.await_args.args == ("791", "FALHA_ENVIO_FINAL")
+    assert mock_rabbitmq_service.publish_message.await_args.args[1] == settings.NOTIFICATION_DLQ
+
+@pytest.mark.asyncio
+async def test_process_channel_notification_sends_transport_errors_to_dlq(mock_rabbitmq_service, mocker):
+    """Testa que um erro de transporte do provedor (ex.: conexão perdida) é tratado como falha de envio e vai para a DLQ."""
+    mock_set_status = mocker.patch('app.tasks.message_tasks.storage.set_status', new_callable=AsyncMock, return_value=True)
+    mocker.patch('app.services.providers.FakeProvider.send_batch', new_callable=AsyncMock, side_effect=ConnectionError("connection reset"))
+
+    await process_channel_notification({"traceId": "792", "channel": "email"}, mock_rabbitmq_service)
+
+    assert mock_set_status.await_args.args == ("792", "FALHA_ENVIO_FINAL")
+    assert mock_rabbitmq_service.publish_message.await_args.args[1] == settings.NOTIFICATION_DLQ
+
+@pytest.mark.asyncio
+async def test_process_message_passes_retry_headers(mock_incoming_message, mock_rabbitmq_service, mocker):
+    """Testa que os headers da mensagem chegam à função da etapa."""
+    test_data = {"traceId": "321"}
+    mock_incoming_message.body = json.dumps(test_data).encode()
+    mock_incoming_message.headers = {"x-retry-attempt": 2}
+    mock_task_func = AsyncMock()
+
+    await process_message(mock_incoming_message, mock_task_func, mock_rabbitmq_service)
+
+    mock_task_func.assert_called_once_with(test_data, mock_rabbitmq_service, headers={"x-retry-attempt": 2})
+
+@pytest.mark.asyncio
+async def test_process_initial_notification_schedules_delayed_retry(mock_rabbitmq_service, mocker):
+    """Testa que a falha inicial agenda o retry na fila de atraso, sem dormir no consumidor."""
+    mocker.patch('app.tasks.message_tasks.storage.set_status', new_callable=AsyncMock)
+    mocker.patch('app.tasks.message_tasks.random.random', return_value=0.0)
+    mock_sleep = mocker.patch('app.tasks.message_tasks.asyncio.sleep', new_callable=AsyncMock)
+    data = {"traceId": "111"}
+
+    await process_initial_notification(data, mock_rabbitmq_service)
+
+    mock_sleep.assert_not_called()
+    mock_rabbitmq_service.publish_message.assert_called_once()
+    call = mock_rabbitmq_service.publish_message.call_args
+    assert call.args[1] == f"{settings.NOTIFICATION_RETRY_QUEUE}.delay.1"
+    assert call.kwargs["headers"] == {"x-retry-attempt": 1}
+    assert 0 < call.kwargs["expiration"] <= settings.RETRY_BACKOFF_BASE_SECONDS
+
+@pytest.mark.asyncio
+async def test_process_retry_notification_reschedules_until_max_attempts(mock_rabbitmq_service, mocker):
+    """Testa o backoff por tentativa e o envio para a DLQ ao esgotar as tentativas."""
+    mock_set_status = mocker.patch('app.tasks.message_tasks.storage.set_status', new_callable=AsyncMock)
+    mocker.patch('app.tasks.message_tasks.random.random', return_value=0.0)
+    data = {"traceId": "222"}
+
+    await process_retry_notification(data, mock_rabbitmq_service, headers={"x-retry-attempt": 1})
+    call = mock_rabbitmq_service.publish_message.call_args
+    assert call.args[1] == f"{settings.NOTIFICATION_RETRY_QUEUE}.delay.2"
+    assert call.kwargs["headers"] == {"x-retry-attempt": 2}
+
+    mock_rabbitmq_service.publish_message.reset_mock()
+    await process_retry_notification(data, mock_rabbitmq_service, headers={"x-retry-attempt": settings.RETRY_MAX_ATTEMPTS})
+    call = mock_rabbitmq_service.publish_message.call_args
+    assert call.args[1] == settings.NOTIFICATION_DLQ
+    assert mock_set_status.await_args.args == ("222", "FALHA_FINAL_REPROCESSAMENTO")
+
+def test_resolve_consumer_limits_precedence(mocker):
+    """Testa a precedência entre configurações globais, por fila e da linha de comando."""
+    mocker.patch.object(settings, "WORKER_DEFAULT_PREFETCH", 10)
+    mocker.patch.object(settings, "WORKER_DEFAULT_CONCURRENCY", 5)
+    mocker.patch.object(settings, "WORKER_QUEUE_PREFETCH", {settings.NOTIFICATION_DLQ: 1})
+    mocker.patch.object(settings, "WORKER_QUEUE_CONCURRENCY", {})
+
+    assert resolve_consumer_limits(settings.NOTIFICATION_INPUT_QUEUE) == (10, 5)
+    assert resolve_consumer_limits(settings.NOTIFICATION_DLQ) == (1, 5)
+    assert resolve_consumer_limits(settings.NOTIFICATION_DLQ, prefetch=50) == (50, 5)
+    assert resolve_consumer_limits(
+        settings.NOTIFICATION_VALIDATION_QUEUE,
+        prefetch=50,
+        concurrency=20,
+        queue_prefetch={settings.NOTIFICATION_VALIDATION_QUEUE: 200},
+    ) == (200, 20)
+
+def test_resolve_consumer_limits_keeps_explicit_zero(mocker):
+    """Testa que um 0 explícito (prefetch ilimitado) não é tratado como ausente, e que concorrência 0 é rejeitada."""
+    mocker.patch.object(settings, "WORKER_DEFAULT_PREFETCH", 10)
+    mocker.patch.object(settings, "WORKER_DEFAULT_CONCURRENCY", 5)
+    mocker.patch.object(settings, "WORKER_QUEUE_PREFETCH", {settings.NOTIFICATION_DLQ: 1})
+    mocker.patch.object(settings, "WORKER_QUEUE_CONCURRENCY", {})
+
+    assert resolve_consumer_limits(settings.NOTIFICATION_DLQ, prefetch=0) == (0, 5)
+    assert resolve_consumer_limits(settings.NOTIFICATION_DLQ, prefetch=50, queue_prefetch={settings.NOTIFICATION_DLQ: 0}) == (0, 5)
+    with pytest.raises(ValueError):
+        resolve_consumer_limits(settings.NOTIFICATION_DLQ, concurrency=0)
+
+def test_resolve_consumer_limits_fills_dispatch_batches(mocker):
+    """Testa que as filas de envio por canal recebem por padrão prefetch e concorrência suficientes para encher um lote do despachante."""
+    mocker.patch.object(settings, "WORKER_DEFAULT_PREFETCH", 10)
+    mocker.patch.object(settings, "WORKER_DEFAULT_CONCURRENCY", 10)
+    mocker.patch.object(settings, "WORKER_QUEUE_PREFETCH", {})
+    mocker.patch.object(settings, "WORKER_QUEUE_CONCURRENCY", {})
+    mocker.patch.object(settings, "DISPATCH_BATCH_SIZE", 50)
+    warning = mocker.patch("app.worker.logger.warning")
+
+    assert resolve_consumer_limits(settings.NOTIFICATION_INPUT_QUEUE) == (10, 10)
+    assert resolve_consumer_limits(f"{settings.NOTIFICATION_CHANNEL_QUEUE_PREFIX}email") == (50, 50)
+    warning.assert_not_called()
+    assert resolve_consumer_limits(f"{settings.NOTIFICATION_CHANNEL_QUEUE_PREFIX}email", concurrency=20) == (50, 20)
+    warning.assert_called_once()
+
+def test_parse_queue_overrides():
+    assert parse_queue_overrides(["fila.notificacao.dlq=1", "fila.notificacao.validacao=64"]) == {
+        "fila.notificacao.dlq": 1,
+        "fila.notificacao.validacao": 64,
+    }
+    assert parse_queue_overrides(None) == {}
+
+@pytest.mark.asyncio
+async def test_limit_concurrency_caps_in_flight_handlers():
+    """Testa que o número de handlers simultâneos respeita o limite da fila."""
+    in_flight = 0
+    peak = 0
+
+    async def handler(message):
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+
+    limited = limit_concurrency(handler, 2)
+    await asyncio.gather(*(limited(MagicMock()) for _ in range(6)))
+
+    assert peak == 2
+
+@pytest.mark.asyncio
+async def test_in_flight_tracker_drains_running_handlers():
+    """Testa que o desligamento aguarda as mensagens em processamento."""
+    tracker = InFlightTracker()
+    finished = []
+
+    async def handler(message):
+        await asyncio.sleep(0.01)
+        finished.append(message)
+
+    tracked = tracker.wrap(handler)
+    tasks = [asyncio.create_task(tracked(n)) for n in range(3)]
+    await asyncio.sleep(0)
+
+    assert await tracker.drain(timeout=1) == 0
+    assert sorted(finished) == [0, 1, 2]
+    await asyncio.gather(*tasks)
 
 # You can add more specific tests for each task function if needed,
 # but the focus here is on the worker's message processing logic.
+
+@pytest.mark.asyncio
+async def test_process_dlq_message_keeps_failure_history(mock_rabbitmq_service, mocker):
+    """Testa que a DLQ guarda a mensagem com o motivo e o histórico das falhas de cada etapa."""
+    mocker.patch('app.tasks.message_tasks.storage.set_status', new_callable=AsyncMock, return_value=True)
+    mocker.patch('app.tasks.message_tasks.random.random', return_value=0.0)
+    data = {"traceId": "333", "mensagemId": "m-333", "channel": "email"}
+
+    await process_initial_notification(data, mock_rabbitmq_service)
+    await process_retry_notification(data, mock_rabbitmq_service, headers={"x-retry-attempt": settings.RETRY_MAX_ATTEMPTS})
+    await process_dlq_message(mock_rabbitmq_service.publish_message.await_args.args[0], mock_rabbitmq_service)
+
+    [entry] = await storage.get_dead_letters(["333"])
+    assert entry["status"] == "FALHA_FINAL_REPROCESSAMENTO"
+    assert entry["etapa"] == "process_retry_notification"
+    assert entry["tentativas"] == 2
+    assert [failure["status"] for failure in entry["historico"]] == ["FALHA_PROCESSAMENTO_INICIAL", "FALHA_FINAL_REPROCESSAMENTO"]
+    assert entry["mensagem"]["mensagemId"] == "m-333"
@@ -0,0 +1,137 @@
+import asyncio
+import pytest
+from app.core.write_behind import StatusWriteBuffer
+
+
+class RecordingFlush:
+    """Função de flush falsa que registra os lotes recebidos."""
+
+    def __init__(self, fail_times: int = 0):
+        self.batches = []
+        self.fail_times = fail_times
+
+    async def __call__(self, batch):
+        if self.fail_times:
+            self.fail_times -= 1
+            raise ConnectionError("Redis indisponível")
+        self.batches.append(batch)
+
+
+@pytest.mark.asyncio
+async def test_write_behind_coalesces_per_trace_id():
+    """Testa que apenas o último status de cada traceId é gravado."""
+    flush = RecordingFlush()
+    buffer = StatusWriteBuffer(flush, max_batch_size=100, flush_interval=60, max_pending=100)
+
+    await buffer.put("a", ["RECEBIDO", ""])
+    await buffer.put("b", ["RECEBIDO", ""])
+    await buffer.put("a", ["ENVIADO_SUCESSO", ""])
+    await buffer.flush()
+
+    assert flush.batches == [[("a", ["ENVIADO_SUCESSO", ""]), ("b", ["RECEBIDO", ""])]]
+    assert buffer.stats["writes"] == 3
+    assert buffer.stats["coalesced"] == 1
+    assert buffer.stats["last_batch_size"] == 2
+
+
+@pytest.mark.asyncio
+async def test_write_behind_checks_conditions_against_pending_status():
+    """Testa que um RECEBIDO atrasado não substitui um status terminal pendente."""
+    flush = RecordingFlush()
+    buffer = StatusWriteBuffer(flush, max_batch_size=100, flush_interval=60, max_pending=100)
+
+    assert await buffer.put("a", ["ENVIADO_SUCESSO", "unless", "DLQ_RECEIVED"]) is True
+    assert await buffer.put("a", ["RECEBIDO", "unless", "ENVIADO_SUCESSO"]) is False
+    assert await buffer.put("b", ["RECEBIDO", "if", "X"]) is True
+    assert await buffer.put("b", ["PROCESSADO_INTERMEDIARIO", "if", "RECEBIDO"]) is True
+    await buffer.flush()
+
+    assert flush.batches == [[
+        ("a", ["ENVIADO_SUCESSO", "unless", "DLQ_RECEIVED"]),
+        ("b", ["PROCESSADO_INTERMEDIARIO", "if", "X"]),
+    ]]
+
+
+@pytest.mark.asyncio
+async def test_write_behind_flushes_on_batch_size():
+    """Testa o flush automático ao atingir o tamanho do lote."""
+    flush = RecordingFlush()
+    buffer = StatusWriteBuffer(flush, max_batch_size=2, flush_interval=60, max_pending=100)
+    buffer.start()
+
+    await buffer.put("a", ["RECEBIDO", ""])
+    await buffer.put("b", ["RECEBIDO", ""])
+    await asyncio.sleep(0.01)
+
+    assert flush.batches == [[("a", ["RECEBIDO", ""]), ("b", ["RECEBIDO", ""])]]
+    await buffer.close()
+
+
+@pytest.mark.asyncio
+async def test_write_behind_applies_backpressure():
+    """Testa que escritores aguardam quando o buffer está cheio."""
+    flush = RecordingFlush()
+    buffer = StatusWriteBuffer(flush, max_batch_size=10, flush_interval=60, max_pending=1)
+
+    await buffer.put("a", ["RECEBIDO", ""])
+    blocked = asyncio.create_task(buffer.put("b", ["RECEBIDO", ""]))
+    await asyncio.sleep(0.01)
+    assert not blocked.done()
+
+    await buffer.flush()
+    await asyncio.wait_for(blocked, timeout=1)
+    assert buffer.pending == 1
+
+
+@pytest.mark.asyncio
+async def test_write_behind_close_forces_flush_and_retries_failures():
+    """Testa que o fechamento grava tudo, mesmo após falha de flush."""
+    flush = RecordingFlush(fail_times=1)
+    buffer = StatusWriteBuffer(flush, max_batch_size=10, flush_interval=60, max_pending=10)
+
+    await buffer.put("a", ["RECEBIDO", ""])
+    await buffer.flush()
+    assert buffer.stats["flush_errors"] == 1
+    assert buffer.pending == 1
+
+    await buffer.close()
+    assert flush.batches == [[("a", ["RECEBIDO", ""])]]
+    assert buffer.pending == 0
+
+
+@pytest.mark.asyncio
+async def test_write_behind_failed_batch_respects_max_pending():
+    """Testa que um lote com falha volta à frente dos novos status sem passar de max_pending, e que o excedente é contabilizado."""
+    flush = RecordingFlush(fail_times=1)
+    buffer = StatusWriteBuffer(flush, max_batch_size=2, flush_interval=60, max_pending=3)
+    await buffer.put("a", ["RECEBIDO", ""])
+    await buffer.put("b", ["RECEBIDO", ""])
+    original_flush_batch = buffer._flush_batch
+
+    async def fail_after_new_writes(batch):
+        # Writers fill the room freed by the batch while it is being flushed
+        await buffer.put("c", ["RECEBIDO", ""])
+        await buffer.put("d", ["RECEBIDO", ""])
+        await original_flush_batch(batch)
+
+    buffer._flush_batch = fail_after_new_writes
+    await buffer.flush()
+
+    assert buffer.pending == 3
+    assert list(buffer._pending) == ["a", "c", "d"]
+    assert buffer.stats["dropped_writes"] == 1
+
+
+@pytest.mark.asyncio
+async def test_write_behind_close_counts_writes_it_could_not_flush(caplog):
+    """Testa que o fechamento registra e contabiliza os status que não puderam ser gravados."""
+    flush = RecordingFlush(fail_times=2)
+    buffer = StatusWriteBuffer(flush, max_batch_size=10, flush_interval=60, max_pending=10)
+    await buffer.put("a", ["RECEBIDO", ""])
+    await buffer.flush()
+
+    await buffer.close()
+
+    assert buffer.pending == 0
+    assert buffer.stats["dropped_writes"] == 1
+    assert "could not be flushed on close" in caplog.text